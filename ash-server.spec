@@ -16,10 +16,13 @@ block_cipher = None
 # Check if model file exists
 model_path = os.path.join(spec_dir, 'models', 'qwen2.5-coder-3b-instruct-q4_k_m.gguf')
 cli_tools_path = os.path.join(spec_dir, 'ash', 'cli_tools_kb.json')
+fast_path_rules_path = os.path.join(spec_dir, 'ash', 'fast_path_rules.json')
 
 datas = []
 if os.path.exists(cli_tools_path):
     datas.append(('ash/cli_tools_kb.json', 'ash'))
+if os.path.exists(fast_path_rules_path):
+    datas.append(('ash/fast_path_rules.json', 'ash'))
 if os.path.exists(model_path):
     datas.append(('models/qwen2.5-coder-3b-instruct-q4_k_m.gguf', 'models'))
 
@@ -1,23 +1,50 @@
 package main
 
 import (
+	"bufio"
+	"bytes"
+	"crypto/rand"
+	"encoding/hex"
 	"encoding/json"
 	"flag"
 	"fmt"
+	"io"
 	"io/ioutil"
 	"net/http"
 	"net/url"
 	"os"
+	"path/filepath"
+	"strconv"
+	"strings"
+	"syscall"
 	"time"
 )
 
+// acceptMark starts a coproc line reporting an accepted command: "\x1fquery\x1fcommand"
+const acceptMark = "\x1f"
+
+// traceMark starts a coproc query line carrying the shell's trace id: "\x1e<trace id>\x1e<query>"
+const traceMark = "\x1e"
+
+// coprocReady is the first line a coproc writes, so the shell knows it is up without sleeping
+const coprocReady = "ash-coproc ready"
+
+// Trace file shared with client.py and the server (ASH_TRACE=1, see scripts/ash_trace.py)
+const (
+	traceMaxBytes = 5 * 1024 * 1024
+	traceBackups  = 3
+)
+
 type GenerateResponse struct {
 	Command string `json:"command"`
 }
 
 type HealthResponse struct {
-	Status string `json:"status"`
-	Model  string `json:"model"`
+	Status   string  `json:"status"`
+	Model    string  `json:"model"`
+	State    string  `json:"state"`
+	Progress float64 `json:"progress"`
+	Error    string  `json:"error"`
 }
 
 func pingServer(serverURL string) {
@@ -49,21 +76,361 @@ func pingServer(serverURL string) {
 	fmt.Printf("✅ Pong! Server is running (model: %s)\n", healthResp.Model)
 }
 
+// waitForServer polls /health until the server can serve requests: its model is
+// ready, or unloaded and reloaded on demand (servers without a state are ready)
 func waitForServer(serverURL string, timeoutSeconds int) {
 	endpoint := fmt.Sprintf("%s/health", serverURL)
 	start := time.Now()
+	lastState := ""
 	for {
 		resp, err := http.Get(endpoint)
-		if err == nil && resp.StatusCode == 200 {
-			defer resp.Body.Close()
-			fmt.Println("✅ ash server is alive!")
-			return
+		if err == nil {
+			body, readErr := ioutil.ReadAll(resp.Body)
+			resp.Body.Close()
+			var healthResp HealthResponse
+			if readErr == nil && resp.StatusCode == 200 && json.Unmarshal(body, &healthResp) == nil {
+				switch healthResp.State {
+				case "", "ready", "unloaded":
+					fmt.Println("✅ ash server is alive!")
+					return
+				case "failed":
+					fmt.Fprintf(os.Stderr, "❌ ash server failed to load its model: %s\n", healthResp.Error)
+					os.Exit(1)
+				default:
+					if healthResp.State != lastState {
+						fmt.Printf("⏳ Model %s... (%.0f%%)\n", healthResp.State, healthResp.Progress*100)
+						lastState = healthResp.State
+					}
+				}
+			}
 		}
 		if time.Since(start) > time.Duration(timeoutSeconds)*time.Second {
 			fmt.Fprintf(os.Stderr, "❌ Timed out waiting for ash server to come alive (%d seconds)\n", timeoutSeconds)
 			os.Exit(1)
 		}
-		time.Sleep(1 * time.Second)
+		time.Sleep(200 * time.Millisecond)
+	}
+}
+
+// acceptedEntry is one line of ~/.ashell/accepted.log: a command the user ran for a
+// query, or after a compaction by client.py, the count of such runs ("n")
+type acceptedEntry struct {
+	Query   string  `json:"q"`
+	Command string  `json:"c"`
+	Time    float64 `json:"t"`
+	Count   int     `json:"n,omitempty"`
+}
+
+// acceptedStore holds the accepted-command log in memory, keyed by normalized query.
+// client.py also indexes the log in SQLite and compacts it; the log stays complete
+// either way, so reading it is enough here.
+type acceptedStore struct {
+	path     string
+	size     int64
+	header   []byte
+	commands map[string]map[string]*acceptedEntry
+}
+
+func newAcceptedStore() *acceptedStore {
+	home, _ := os.UserHomeDir()
+	return &acceptedStore{path: filepath.Join(home, ".ashell", "accepted.log")}
+}
+
+// normalizeQuery matches client.py: whitespace collapsed, trailing punctuation dropped
+func normalizeQuery(query string) string {
+	return strings.TrimRight(strings.Join(strings.Fields(query), " "), "?!. ")
+}
+
+// logHeader is the start of the log's first line, which a compaction replaces
+func logHeader(f *os.File) []byte {
+	header := make([]byte, 64)
+	n, _ := f.ReadAt(header, 0)
+	if i := bytes.IndexByte(header[:n], '\n'); i >= 0 {
+		n = i
+	}
+	return header[:n]
+}
+
+// refresh reads what the log gained since the last call, rereading it all after a compaction
+func (s *acceptedStore) refresh() {
+	info, err := os.Stat(s.path)
+	if err != nil || info.Size() == s.size {
+		return
+	}
+	f, err := os.Open(s.path)
+	if err != nil {
+		return
+	}
+	defer f.Close()
+	header := logHeader(f)
+	if info.Size() < s.size || s.commands == nil || !bytes.Equal(header, s.header) {
+		s.size = 0
+		s.header = header
+		s.commands = map[string]map[string]*acceptedEntry{}
+	}
+	data, err := ioutil.ReadAll(io.NewSectionReader(f, s.size, info.Size()-s.size))
+	if err != nil {
+		return
+	}
+	// A line still being written is read next time
+	end := bytes.LastIndexByte(data, '\n') + 1
+	for _, line := range bytes.Split(data[:end], []byte("\n")) {
+		var entry acceptedEntry
+		if json.Unmarshal(line, &entry) != nil || entry.Query == "" {
+			continue
+		}
+		if entry.Count == 0 {
+			entry.Count = 1
+		}
+		byCommand := s.commands[entry.Query]
+		if byCommand == nil {
+			byCommand = map[string]*acceptedEntry{}
+			s.commands[entry.Query] = byCommand
+		}
+		if known := byCommand[entry.Command]; known != nil {
+			known.Count += entry.Count
+			if entry.Time > known.Time {
+				known.Time = entry.Time
+			}
+		} else {
+			byCommand[entry.Command] = &entry
+		}
+	}
+	s.size += int64(end)
+}
+
+// best returns the entry most often accepted for query, nil when there is none
+func (s *acceptedStore) best(query string) *acceptedEntry {
+	s.refresh()
+	var best *acceptedEntry
+	for _, entry := range s.commands[normalizeQuery(query)] {
+		if best == nil || entry.Count > best.Count || (entry.Count == best.Count && entry.Time > best.Time) {
+			best = entry
+		}
+	}
+	return best
+}
+
+// lookup returns the command most often accepted for query, "" when there is none
+func (s *acceptedStore) lookup(query string) string {
+	if best := s.best(query); best != nil {
+		return best.Command
+	}
+	return ""
+}
+
+// record appends an accepted command to the log (under a shared lock: client.py
+// takes it exclusively while compacting)
+func (s *acceptedStore) record(query, command string) {
+	query, command = normalizeQuery(query), strings.TrimSpace(command)
+	if query == "" || command == "" {
+		return
+	}
+	line, err := json.Marshal(acceptedEntry{Query: query, Command: command, Time: float64(time.Now().UnixNano()) / 1e9})
+	if err != nil {
+		return
+	}
+	if err := os.MkdirAll(filepath.Dir(s.path), 0755); err != nil {
+		return
+	}
+	f, err := os.OpenFile(s.path, os.O_APPEND|os.O_CREATE|os.O_WRONLY, 0644)
+	if err != nil {
+		fmt.Fprintf(os.Stderr, "Error saving accepted command: %v\n", err)
+		return
+	}
+	defer f.Close()
+	syscall.Flock(int(f.Fd()), syscall.LOCK_SH)
+	f.Write(append(line, '\n'))
+}
+
+// localStoreEnabled is false when ASH_LOCAL_STORE=0 (always ask the server)
+func localStoreEnabled() bool {
+	return os.Getenv("ASH_LOCAL_STORE") != "0"
+}
+
+// traceSpan is one line of ~/.ash/traces/trace.jsonl
+type traceSpan struct {
+	Trace string                 `json:"trace"`
+	Name  string                 `json:"name"`
+	TS    float64                `json:"ts"`
+	Dur   float64                `json:"dur"`
+	Proc  string                 `json:"proc"`
+	PID   int                    `json:"pid"`
+	Attrs map[string]interface{} `json:"attrs"`
+}
+
+func tracingEnabled() bool {
+	value := os.Getenv("ASH_TRACE")
+	return value != "" && value != "0"
+}
+
+func newTraceID() string {
+	id := make([]byte, 8)
+	rand.Read(id)
+	return hex.EncodeToString(id)
+}
+
+// newSpan is a span from start until now
+func newSpan(traceID, name string, start time.Time, attrs map[string]interface{}) traceSpan {
+	return traceSpan{Trace: traceID, Name: name, TS: float64(start.UnixNano()) / 1e9, Dur: time.Since(start).Seconds(),
+		Proc: "client", PID: os.Getpid(), Attrs: attrs}
+}
+
+// recordSpans appends spans to the trace file in one write, rotating it once it passed traceMaxBytes
+func recordSpans(spans ...traceSpan) {
+	var data []byte
+	for _, span := range spans {
+		line, err := json.Marshal(span)
+		if err != nil {
+			return
+		}
+		data = append(append(data, line...), '\n')
+	}
+	home, _ := os.UserHomeDir()
+	path := filepath.Join(home, ".ash", "traces", "trace.jsonl")
+	if err := os.MkdirAll(filepath.Dir(path), 0755); err != nil {
+		return
+	}
+	if info, err := os.Stat(path); err == nil && info.Size() >= traceMaxBytes {
+		for i := traceBackups - 1; i > 0; i-- {
+			os.Rename(fmt.Sprintf("%s.%d", path, i), fmt.Sprintf("%s.%d", path, i+1))
+		}
+		os.Rename(path, path+".1")
+	}
+	f, err := os.OpenFile(path, os.O_APPEND|os.O_CREATE|os.O_WRONLY, 0644)
+	if err != nil {
+		return
+	}
+	defer f.Close()
+	f.Write(data)
+}
+
+// getGenerate sends a /generate request, with the trace id when it is traced
+// requestTimeout is the generation timeout (seconds) the client asks the server for
+const requestTimeout = 30
+
+// newGenerateClient waits a little longer than requestTimeout, so the server's 504 arrives first
+func newGenerateClient() *http.Client {
+	return &http.Client{Timeout: (requestTimeout + 2) * time.Second}
+}
+
+// generateURL is the /generate request for query, with the client's timeout
+func generateURL(serverURL, query string) string {
+	return fmt.Sprintf("%s/generate?q=%s&timeout=%d", serverURL, url.QueryEscape(query), requestTimeout)
+}
+
+func getGenerate(client *http.Client, endpoint, traceID string) (*http.Response, error) {
+	req, err := http.NewRequest("GET", endpoint, nil)
+	if err != nil {
+		return nil, err
+	}
+	if traceID != "" {
+		req.Header.Set("X-Ash-Trace", traceID)
+	}
+	return client.Do(req)
+}
+
+// prefetchDelay is the typing pause before a prefetch hint is sent (ASH_PREFETCH_DELAY seconds)
+func prefetchDelay() time.Duration {
+	if seconds, err := strconv.ParseFloat(os.Getenv("ASH_PREFETCH_DELAY"), 64); err == nil {
+		return time.Duration(seconds * float64(time.Second))
+	}
+	return 300 * time.Millisecond
+}
+
+// prefetch asks the server to start generating query in the background
+func prefetch(client *http.Client, serverURL, query, session string) {
+	body, err := json.Marshal(map[string]string{"q": query, "session": session})
+	if err != nil {
+		return
+	}
+	resp, err := client.Post(serverURL+"/prefetch", "application/json", bytes.NewReader(body))
+	if err == nil {
+		ioutil.ReadAll(resp.Body)
+		resp.Body.Close()
+	}
+}
+
+// coprocLoop answers one query per stdin line with exactly one stdout line
+// (the command, or an empty line on failure), reusing one keep-alive connection.
+// Lines starting with a tab are debounced prefetch hints and get no reply, as do
+// accepted-command reports (acceptMark); repeated queries are answered from those.
+// Queries starting with traceMark are traced under the shell's trace id.
+func coprocLoop(serverURL string) {
+	client := newGenerateClient()
+	scanner := bufio.NewScanner(os.Stdin)
+	writer := bufio.NewWriter(os.Stdout)
+	session := strconv.Itoa(os.Getpid())
+	delay := prefetchDelay()
+	tracing := tracingEnabled()
+	var accepted *acceptedStore
+	if localStoreEnabled() {
+		accepted = newAcceptedStore()
+	}
+	var pending *time.Timer
+	writer.WriteString(coprocReady + "\n")
+	writer.Flush()
+	for scanner.Scan() {
+		line := scanner.Text()
+		if pending != nil {
+			// A newer hint or a real query supersedes a hint not sent yet
+			pending.Stop()
+			pending = nil
+		}
+		if strings.HasPrefix(line, "\t") {
+			if hint := strings.TrimSpace(line); hint != "" && (accepted == nil || accepted.lookup(hint) == "") {
+				pending = time.AfterFunc(delay, func() { prefetch(client, serverURL, hint, session) })
+			}
+			continue
+		}
+		if strings.HasPrefix(line, acceptMark) {
+			if parts := strings.SplitN(line[len(acceptMark):], acceptMark, 2); len(parts) == 2 && accepted != nil {
+				accepted.record(parts[0], parts[1])
+			}
+			continue
+		}
+		traceID := ""
+		if tracing {
+			traceID = newTraceID()
+		}
+		if strings.HasPrefix(line, traceMark) {
+			if parts := strings.SplitN(line[len(traceMark):], traceMark, 2); len(parts) == 2 {
+				traceID, line = parts[0], parts[1]
+			}
+		}
+		var spans []traceSpan
+		query := strings.TrimSpace(line)
+		command := ""
+		if query != "" && accepted != nil {
+			lookupStart := time.Now()
+			command = accepted.lookup(query)
+			if traceID != "" {
+				spans = append(spans, newSpan(traceID, "client.local_lookup", lookupStart, map[string]interface{}{"hit": command != ""}))
+			}
+		}
+		if query != "" && command == "" {
+			requestStart := time.Now()
+			status := 0
+			resp, err := getGenerate(client, generateURL(serverURL, query), traceID)
+			if err == nil {
+				// Reading the whole body lets the transport reuse the connection
+				body, readErr := ioutil.ReadAll(resp.Body)
+				resp.Body.Close()
+				status = resp.StatusCode
+				var genResp GenerateResponse
+				if readErr == nil && resp.StatusCode == 200 && json.Unmarshal(body, &genResp) == nil {
+					command = strings.ReplaceAll(genResp.Command, "\n", " ")
+				}
+			}
+			if traceID != "" {
+				spans = append(spans, newSpan(traceID, "client.request", requestStart, map[string]interface{}{"query": query, "status": status}))
+			}
+		}
+		fmt.Fprintln(writer, command)
+		writer.Flush()
+		if len(spans) > 0 {
+			recordSpans(spans...)
+		}
 	}
 }
 
@@ -72,8 +439,24 @@ func main() {
 	ping := flag.Bool("ping", false, "Ping the server to test connectivity")
 	wait := flag.Bool("wait", false, "Wait for the server to come alive before proceeding (up to 30s)")
 	server := flag.String("server", "http://localhost:8765", "ash server URL")
+	coproc := flag.Bool("coproc", false, "Answer one query per stdin line on stdout (shell coprocess mode)")
+	accept := flag.Bool("accept", false, "Record that the command in the second argument was run for the query in the first")
 	flag.Parse()
 
+	if *coproc {
+		coprocLoop(*server)
+		return
+	}
+
+	if *accept {
+		if flag.NArg() != 2 {
+			fmt.Fprintln(os.Stderr, "Usage: ash-client --accept QUERY COMMAND")
+			os.Exit(2)
+		}
+		newAcceptedStore().record(flag.Arg(0), flag.Arg(1))
+		return
+	}
+
 	if *wait {
 		waitForServer(*server, 30)
 		return
@@ -85,13 +468,46 @@ func main() {
 	}
 
 	if flag.NArg() == 0 {
-		fmt.Println("Usage: ash-client [--quiet] [--ping] [--wait] [--server URL] <query>")
+		fmt.Println("Usage: ash-client [--quiet] [--ping] [--wait] [--coproc] [--accept] [--server URL] <query>")
 		os.Exit(1)
 	}
 
 	query := flag.Arg(0)
-	endpoint := fmt.Sprintf("%s/generate?q=%s", *server, url.QueryEscape(query))
-	resp, err := http.Get(endpoint)
+	// The shell passes its trace id, and when it started us, so start-up is traced too
+	traceID := os.Getenv("ASH_TRACE_ID")
+	if traceID == "" && tracingEnabled() {
+		traceID = newTraceID()
+	}
+	requestStart := time.Now()
+	if seconds, err := strconv.ParseFloat(os.Getenv("ASH_TRACE_START"), 64); err == nil && traceID != "" {
+		startedAt := time.Unix(0, int64(seconds*1e9))
+		recordSpans(traceSpan{Trace: traceID, Name: "client.startup", TS: seconds, Dur: requestStart.Sub(startedAt).Seconds(),
+			Proc: "client", PID: os.Getpid(), Attrs: map[string]interface{}{}})
+	}
+	// A command accepted for this query before is answered without the server, as in coproc mode
+	if localStoreEnabled() {
+		local := newAcceptedStore().best(query)
+		if traceID != "" {
+			recordSpans(newSpan(traceID, "client.local_lookup", requestStart, map[string]interface{}{"hit": local != nil}))
+		}
+		if local != nil {
+			if *quiet {
+				fmt.Println(local.Command)
+			} else {
+				fmt.Printf("✅ Command: %s (accepted %dx before)\n", local.Command, local.Count)
+			}
+			return
+		}
+		requestStart = time.Now()
+	}
+	resp, err := getGenerate(newGenerateClient(), generateURL(*server, query), traceID)
+	if traceID != "" {
+		status := 0
+		if err == nil {
+			status = resp.StatusCode
+		}
+		recordSpans(newSpan(traceID, "client.request", requestStart, map[string]interface{}{"query": query, "status": status}))
+	}
 	if err != nil {
 		fmt.Fprintf(os.Stderr, "❌ ash server is not running or unreachable!\n")
 		os.Exit(1)
@@ -1,64 +1,656 @@
 #!/usr/bin/env python3
 """
 ash Client - Fast client that connects to the model server
+
+Only the standard library is used and every request goes over one reused
+keep-alive connection, so a one-shot invocation costs little more than the
+interpreter start-up.
 """
 
 import os
 import sys
 import json
-import requests
 import time
+import fcntl
+import select
+import socket
+import http.client
+from urllib.parse import urlencode, urlparse
 
 # Server configuration
 SERVER_URL = os.environ.get('ash_SERVER_URL', 'http://localhost:8765')
+# Preferred when it exists (see ash-server --socket)
+SOCKET_PATH = os.environ.get(
+    'ASH_SOCKET',
+    os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~/.ash'), 'ash.sock')
+)
+# Deadline sent with every generation; the server abandons it once it passes
+REQUEST_TIMEOUT = 30
+# A little longer, so the server's 504 arrives before the socket gives up
+SOCKET_TIMEOUT = REQUEST_TIMEOUT + 2
+WAIT_TIMEOUT = 30
+# Typing pause before the shell buffer is prefetched (coproc mode)
+PREFETCH_DELAY = float(os.environ.get('ASH_PREFETCH_DELAY', '0.3'))
+# Client state: query history and the commands the user accepted
+ASHELL_DIR = os.path.expanduser('~/.ashell')
+# Starts a coproc line reporting an accepted command (ASCII unit separator)
+ACCEPT_MARK = '\x1f'
+# First line a coproc writes, so the shell knows it is up without sleeping
+COPROC_READY = 'ash-coproc ready'
+# Tracing (ASH_TRACE=1): spans go to the file the server writes too (see scripts/ash_trace.py)
+TRACING = os.environ.get('ASH_TRACE', '0') not in ('', '0')
+TRACE_PATH = os.path.join(os.path.expanduser('~/.ash'), 'traces', 'trace.jsonl')
+TRACE_MAX_BYTES = 5 * 1024 * 1024
+TRACE_BACKUPS = 3
+# Starts a coproc query line carrying the shell's trace id: "\x1e<trace id>\x1e<query>"
+TRACE_MARK = '\x1e'
+# Start of the client.startup span when the shell didn't pass ASH_TRACE_START
+IMPORT_START = time.time()
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
+
+    def __init__(self, socket_path, timeout=SOCKET_TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+def socket_available():
+    """Check if the server's unix socket exists"""
+    return bool(SOCKET_PATH) and os.path.exists(SOCKET_PATH)
+
+class ServerConnection:
+    """
+    Persistent keep-alive connection to the server, over the unix socket when it
+    exists and TCP otherwise. A request that fails because the server closed an idle
+    connection is retried once on a fresh one; timeouts and other errors are not.
+    """
+
+    def __init__(self, timeout=SOCKET_TIMEOUT):
+        self.timeout = timeout
+        self.connection = None
+
+    def _connect(self):
+        if socket_available():
+            try:
+                connection = UnixHTTPConnection(SOCKET_PATH, timeout=self.timeout)
+                connection.connect()
+                return connection
+            except OSError:
+                pass
+        url = urlparse(SERVER_URL)
+        connection = http.client.HTTPConnection(url.hostname or 'localhost', url.port or 80, timeout=self.timeout)
+        connection.connect()
+        return connection
+
+    def request(self, path, params=None, trace_id=None, payload=None):
+        """
+        GET path (POST payload as JSON when given) and return the http.client
+        response with its body unread.
+        Raises OSError / http.client.HTTPException when the server can't be reached.
+        """
+        target = f"{path}?{urlencode(params)}" if params else path
+        headers = {'X-Ash-Trace': trace_id} if trace_id else {}
+        method, body = 'GET', None
+        if payload is not None:
+            method, body = 'POST', json.dumps(payload).encode()
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            reused = self.connection is not None
+            if not reused:
+                self.connection = self._connect()
+            try:
+                self.connection.request(method, target, body=body, headers=headers)
+                return self.connection.getresponse()
+            except (BrokenPipeError, ConnectionResetError):
+                # A keep-alive connection the server closed fails before any response
+                # (RemoteDisconnected is a ConnectionResetError); only that is retried
+                self.close()
+                if attempt or not reused:
+                    raise
+            except (OSError, http.client.HTTPException):
+                # Timeouts included: the server may still be generating, don't ask twice
+                self.close()
+                raise
+
+    def get(self, path, params=None, trace_id=None):
+        """
+        GET path, returning (status, parsed JSON body or None).
+        Raises OSError / http.client.HTTPException when the server can't be reached.
+        """
+        return self._read(self.request(path, params, trace_id))
+
+    def post(self, path, payload, trace_id=None):
+        """
+        POST payload as JSON to path, returning (status, parsed JSON body or None).
+        Raises OSError / http.client.HTTPException when the server can't be reached.
+        """
+        return self._read(self.request(path, trace_id=trace_id, payload=payload))
+
+    def _read(self, response):
+        body = response.read()
+        if response.will_close:
+            self.close()
+        return response.status, json.loads(body) if body else None
 
-def check_server():
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+# One connection per client session
+_connection = ServerConnection()
+
+def get_health(timeout):
+    """GET /health over a connection of its own, closed afterwards"""
+    connection = ServerConnection(timeout=timeout)
+    try:
+        return connection.get('/health')
+    finally:
+        connection.close()
+
+def server_endpoint():
+    """Where the client is talking to, for messages"""
+    return SOCKET_PATH if socket_available() else SERVER_URL
+
+def check_server(timeout=1, verbose=True):
     """Check if the server is running"""
     try:
-        response = requests.get(f"{SERVER_URL}/health", timeout=1)
-        if response.status_code == 200:
-            data = response.json()
-            print(f"✅ Connected to ash server (model: {data.get('model', 'unknown')})")
-            return True
-    except requests.exceptions.RequestException:
-        pass
+        status, data = get_health(timeout)
+    except (OSError, http.client.HTTPException, ValueError):
+        return False
+    if status == 200:
+        if verbose:
+            print(f"✅ Connected to ash server at {server_endpoint()} (model: {(data or {}).get('model', 'unknown')})")
+        return True
     return False
 
-def generate_command(query, debug=False):
-    """Generate command using the server"""
+def report_unreachable():
+    """Explain a failed request, probing /health only now that something went wrong"""
+    if check_server(verbose=False):
+        print("❌ Server is running but the request failed", file=sys.stderr)
+    else:
+        print("❌ ash server is not running!", file=sys.stderr)
+        print("Start the server with: ash-server", file=sys.stderr)
+
+def new_trace_id():
+    return os.urandom(8).hex()
+
+def record_spans(spans):
+    """
+    Append spans ({'trace', 'name', 'ts', 'dur', 'attrs'}) to the trace file as JSON
+    lines, rotating it once it passed TRACE_MAX_BYTES. Only called when tracing.
+    """
+    data = "".join(json.dumps(dict(span, proc='client', pid=os.getpid())) + "\n" for span in spans)
     try:
-        response = requests.get(
-            f"{SERVER_URL}/generate",
-            params={'q': query},
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('command', '')
-        else:
-            print(f"❌ Server error: {response.status_code}")
+        os.makedirs(os.path.dirname(TRACE_PATH), exist_ok=True)
+        if os.path.exists(TRACE_PATH) and os.path.getsize(TRACE_PATH) >= TRACE_MAX_BYTES:
+            for i in range(TRACE_BACKUPS - 1, 0, -1):
+                if os.path.exists(f"{TRACE_PATH}.{i}"):
+                    os.replace(f"{TRACE_PATH}.{i}", f"{TRACE_PATH}.{i + 1}")
+            os.replace(TRACE_PATH, f"{TRACE_PATH}.1")
+        # One O_APPEND write, so lines of concurrent writers don't interleave
+        fd = os.open(TRACE_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data.encode('utf-8'))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def trace_span(trace_id, name, start, end=None, **attrs):
+    return {'trace': trace_id, 'name': name, 'ts': round(start, 6),
+            'dur': round((end or time.time()) - start, 6), 'attrs': attrs}
+
+def accepted_command(query):
+    """Command the user accepted for query before (see AcceptedCommands), or None"""
+    if _accepted is None:
+        return None
+    return _accepted.lookup(query)
+
+def generate_command(query, debug=False, trace_id=None):
+    """Generate command using the server; with a trace_id the request is traced as client.request"""
+    start_time = time.time()
+    status = None
+    try:
+        status, data = _connection.get('/generate', {'q': query, 'timeout': REQUEST_TIMEOUT}, trace_id)
+    except socket.timeout:
+        print("❌ Request timed out", file=sys.stderr)
+        return None
+    except (OSError, http.client.HTTPException):
+        report_unreachable()
+        return None
+    except ValueError as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        return None
+    finally:
+        if trace_id:
+            record_spans([trace_span(trace_id, 'client.request', start_time, query=query, status=status)])
+
+    if status == 200:
+        return (data or {}).get('command', '')
+    print(f"❌ Server error: {status}", file=sys.stderr)
+    return None
+
+def read_events(lines, on_token=None, start_time=None):
+    """
+    Consume server-sent event lines from /generate/stream.
+
+    Returns:
+        dict: The final 'done' frame with client-side 'client_ttft' and
+              'client_total' added, or None on error
+    """
+    start_time = start_time or time.time()
+    first_token_time = None
+    event = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            event = None
+            continue
+        if line.startswith('event:'):
+            event = line[len('event:'):].strip()
+            continue
+        if not line.startswith('data:'):
+            continue
+        data = json.loads(line[len('data:'):])
+        if event == 'done':
+            data['client_ttft'] = (first_token_time or time.time()) - start_time
+            data['client_total'] = time.time() - start_time
+            return data
+        if event == 'error':
+            print(f"❌ Server error: {data.get('error')}", file=sys.stderr)
             return None
-            
-    except requests.exceptions.Timeout:
-        print("❌ Request timed out")
+        if first_token_time is None:
+            first_token_time = time.time()
+        if on_token:
+            on_token(data.get('token', ''))
+    print("❌ Stream ended unexpectedly", file=sys.stderr)
+    return None
+
+def generate_command_stream(query, on_token=None, trace_id=None):
+    """
+    Generate command using the server's streaming endpoint.
+
+    Args:
+        query (str): Natural language query
+        on_token (callable): Called with each piece of the command as it arrives
+        trace_id (str): Trace the request (as client.request) under this id
+
+    Returns:
+        dict: Final frame ({'command', 'source', 'time_to_first_token', 'total_time', ...})
+              with client-side 'client_ttft' and 'client_total' added, or None on error
+    """
+    start_time = time.time()
+    status = None
+    try:
+        response = _connection.request('/generate/stream', {'q': query, 'timeout': REQUEST_TIMEOUT}, trace_id)
+        status = response.status
+        try:
+            if response.status != 200:
+                response.read()
+                print(f"❌ Server error: {response.status}", file=sys.stderr)
+                return None
+            lines = (raw.decode('utf-8') for raw in iter(response.readline, b''))
+            return read_events(lines, on_token, start_time)
+        finally:
+            # The stream ends by closing the connection
+            _connection.close()
+    except socket.timeout:
+        print("❌ Request timed out", file=sys.stderr)
         return None
-    except requests.exceptions.ConnectionError:
-        print("❌ Could not connect to server")
+    except (OSError, http.client.HTTPException):
+        report_unreachable()
         return None
-    except Exception as e:
-        print(f"❌ Error: {e}")
+    except ValueError as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
         return None
+    finally:
+        if trace_id:
+            record_spans([trace_span(trace_id, 'client.request', start_time, query=query, status=status, stream=True)])
+
+def print_streamed_command(query, trace_id=None):
+    """Print a command as it streams in, followed by its timings"""
+    def on_token(piece):
+        sys.stdout.write(piece)
+        sys.stdout.flush()
+
+    result = generate_command_stream(query, on_token=on_token, trace_id=trace_id)
+    if result:
+        print(f" (first token {result['client_ttft']:.2f}s, total {result['client_total']:.2f}s, {result.get('source', 'model')})")
+    else:
+        print("❌ Failed to generate command")
+    return result
+
+def ping_server():
+    """--ping: report whether the server answers, exit status 0 if it does"""
+    try:
+        status, data = get_health(2)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        print(f"❌ Ping failed: {e}", file=sys.stderr)
+        return 1
+    if status != 200:
+        print(f"❌ Server responded with status code: {status}", file=sys.stderr)
+        return 1
+    print(f"✅ Pong! Server is running (model: {(data or {}).get('model', 'unknown')})")
+    return 0
+
+def wait_for_server(timeout=WAIT_TIMEOUT):
+    """
+    --wait: poll until the server can serve requests (its model is ready, or
+    unloaded and reloaded on demand), exit status 0 if it could within timeout
+    """
+    deadline = time.time() + timeout
+    last_state = None
+    while True:
+        try:
+            status, data = get_health(1)
+        except (OSError, http.client.HTTPException, ValueError):
+            status, data = None, None
+        if status == 200:
+            # Servers without readiness reporting are ready once they answer
+            state = (data or {}).get('state', 'ready')
+            if state in ('ready', 'unloaded'):
+                print("✅ ash server is alive!")
+                return 0
+            if state == 'failed':
+                print(f"❌ ash server failed to load its model: {data.get('error')}", file=sys.stderr)
+                return 1
+            if state != last_state:
+                print(f"⏳ Model {state}... ({data.get('progress', 0):.0%})")
+                last_state = state
+        if time.time() > deadline:
+            print(f"❌ Timed out waiting for ash server to come alive ({timeout} seconds)", file=sys.stderr)
+            return 1
+        time.sleep(0.2)
+
+def coproc_lines(fd, timeout):
+    """
+    Lines read from fd; yields None whenever no complete line arrived within
+    timeout() seconds (None waits forever). Ends at EOF.
+    """
+    buffer = b""
+    while True:
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            yield line.decode('utf-8', errors='replace')
+        ready, _, _ = select.select([fd], [], [], timeout())
+        if not ready:
+            yield None
+            continue
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return
+        buffer += chunk
+
+def coproc_loop():
+    """
+    Long-lived mode for shell integration (ash.zsh runs it as a zsh coproc).
+    Writes COPROC_READY, then reads one query per line on stdin and answers each
+    with exactly one line on stdout: the command, or an empty line when none
+    could be generated.
+
+    A line starting with a tab is a prefetch hint (the buffer while the user is
+    still typing) and gets no reply. Hints are debounced: only one that stayed
+    the latest for PREFETCH_DELAY seconds is sent to the server.
+
+    A line starting with ACCEPT_MARK is "query<ACCEPT_MARK>command": the user ran
+    the suggested command. It gets no reply either and goes into the local store,
+    which answers repeated queries without the server.
+
+    A query line starting with TRACE_MARK carries the shell's trace id; it is
+    traced under that id (as are all queries when ASH_TRACE is set here).
+    """
+    connection = ServerConnection()
+    session = str(os.getpid())
+    pending = None  # (query, send at)
+
+    def timeout():
+        return max(pending[1] - time.time(), 0) if pending else None
+
+    sys.stdout.write(COPROC_READY + '\n')
+    sys.stdout.flush()
+    for line in coproc_lines(sys.stdin.fileno(), timeout):
+        if line is None or line.startswith('\t'):
+            if line is not None:
+                query = line.strip()
+                pending = (query, time.time() + PREFETCH_DELAY) if query else None
+            elif pending:
+                try:
+                    if accepted_command(pending[0]) is None:
+                        connection.post('/prefetch', {'q': pending[0], 'session': session})
+                except (OSError, http.client.HTTPException, ValueError):
+                    pass
+                pending = None
+            continue
+        if line.startswith(ACCEPT_MARK):
+            query, _, command = line[1:].partition(ACCEPT_MARK)
+            if _accepted is not None:
+                _accepted.record(query, command)
+            continue
 
-def interactive_shell():
+        # A real query supersedes any hint not sent yet
+        pending = None
+        trace_id = new_trace_id() if TRACING else None
+        if line.startswith(TRACE_MARK):
+            trace_id, _, line = line[1:].partition(TRACE_MARK)
+        query = line.strip()
+        lookup_start = time.time()
+        local = accepted_command(query) if query else None
+        spans = [trace_span(trace_id, 'client.local_lookup', lookup_start, hit=bool(local))] if trace_id else []
+        command = local['command'] if local else ""
+        if query and not local:
+            request_start = time.time()
+            status = None
+            try:
+                status, data = connection.get('/generate', {'q': query, 'timeout': REQUEST_TIMEOUT}, trace_id)
+                if status == 200 and data:
+                    command = data.get('command', '')
+            except (OSError, http.client.HTTPException, ValueError):
+                pass
+            if trace_id:
+                spans.append(trace_span(trace_id, 'client.request', request_start, query=query, status=status))
+        # Exactly one line per query keeps the shell in sync
+        sys.stdout.write(command.replace('\n', ' ') + '\n')
+        sys.stdout.flush()
+        if spans:
+            record_spans(spans)
+    connection.close()
+
+def normalize_query(query):
+    """
+    Lookup key of a query: server.normalize_query, which the client can't import
+    without loading the server's dependencies (client.go has its own copy too)
+    """
+    return " ".join(query.split()).rstrip("?!. ")
+
+class AcceptedCommands:
+    """
+    Commands the user ran as suggested, by query: (query -> command, count, last used).
+
+    Accepting a command appends one JSON line to an append-only log, which any
+    number of shells can do at once. Lookups read a SQLite index keyed by
+    (query, command) after folding in whatever the log gained since the last
+    lookup. Once the log has grown COMPACT_BYTES past its last compaction, the
+    index is trimmed to the max_entries most recently used commands and the log
+    rewritten as one line per remaining command (with its count), so the log
+    alone stays a complete record. The rewritten log starts with a
+    {"compacted": time} line, which is how the Go client (it reads only the
+    log) notices the rewrite.
+    """
+
+    COMPACT_BYTES = 256 * 1024
+
+    def __init__(self, directory=ASHELL_DIR, max_entries=100000):
+        self.directory = directory
+        self.log_path = os.path.join(directory, 'accepted.log')
+        self.db_path = os.path.join(directory, 'accepted.db')
+        self.max_entries = max_entries
+        self._db = None
+        # (inode, size, mtime) of the log when it was last known to be folded in
+        self._synced_log = None
+        # sqlite3 is imported on first use; until then only OSError can occur
+        self._db_errors = (OSError,)
+
+    def _connect(self):
+        if self._db is None:
+            # Imported here: a query answered by the server never needs it
+            import sqlite3
+            self._db_errors = (OSError, sqlite3.Error)
+            os.makedirs(self.directory, exist_ok=True)
+            db = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            # Readers never wait for a shell that is folding in the log
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS commands (query TEXT NOT NULL, command TEXT NOT NULL, '
+                       'count INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (query, command)) WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self._db = db
+        return self._db
+
+    def _meta(self, db, key):
+        row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def record(self, query, command):
+        """Remember that command was run for query"""
+        key = normalize_query(query)
+        command = command.strip()
+        if not key or not command:
+            return
+        line = json.dumps({'q': key, 'c': command, 't': time.time()}) + '\n'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                # Shared: appends don't exclude each other, only a compaction rewriting the log
+                fcntl.flock(f, fcntl.LOCK_SH)
+                f.write(line)
+        except OSError as e:
+            print(f"Error saving accepted command: {e}", file=sys.stderr)
+
+    def sync(self):
+        """Fold the log lines the index hasn't seen into it, compacting the log when it grew enough"""
+        try:
+            st = os.stat(self.log_path)
+        except OSError:
+            return
+        # Unchanged since the last sync: skip the database round-trip
+        if (st.st_ino, st.st_size, st.st_mtime_ns) == self._synced_log:
+            return
+        size = st.st_size
+        db = self._connect()
+        if size == self._meta(db, 'log_offset'):
+            self._synced_log = (st.st_ino, st.st_size, st.st_mtime_ns)
+            return
+        with open(self.log_path, 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # Another shell may have folded it in (or compacted it) meanwhile
+            offset = self._meta(db, 'log_offset')
+            if offset > size:
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            rows = []
+            for raw in data[:end].splitlines():
+                try:
+                    entry = json.loads(raw)
+                    rows.append((entry['q'], entry['c'], entry.get('n', 1), entry['t']))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue
+            # Under the exclusive lock nobody is mid-append: a partial last line is from a crash
+            compact = offset + len(data) >= self._meta(db, 'log_compacted') + self.COMPACT_BYTES
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany('INSERT INTO commands VALUES (?, ?, ?, ?) ON CONFLICT (query, command) DO UPDATE '
+                               'SET count = count + excluded.count, last_used = max(last_used, excluded.last_used)',
+                               rows)
+                new_offset = offset + end
+                if compact:
+                    db.execute('DELETE FROM commands WHERE (query, command) IN (SELECT query, command FROM commands '
+                               'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+                    snapshot = json.dumps({'compacted': time.time()}).encode('utf-8') + b'\n' + b''.join(
+                        json.dumps({'q': query, 'c': command, 't': last_used, 'n': count}).encode('utf-8') + b'\n'
+                        for query, command, count, last_used in db.execute(
+                            'SELECT query, command, count, last_used FROM commands ORDER BY last_used'))
+                    # In place, so appenders waiting on this file's lock append after the snapshot
+                    f.seek(0)
+                    f.write(snapshot)
+                    f.truncate()
+                    new_offset = len(snapshot)
+                    db.execute("INSERT OR REPLACE INTO meta VALUES ('log_compacted', ?)", (new_offset,))
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('log_offset', ?)", (new_offset,))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            # Appends wait for the lock, so the log still ends where the fold did unless it ended mid-line
+            st = os.fstat(f.fileno())
+            if st.st_size == new_offset:
+                self._synced_log = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def lookup(self, query):
+        """
+        The command most often accepted for query.
+
+        Returns:
+            dict: {'command': str, 'count': int}, or None when there is none
+        """
+        key = normalize_query(query)
+        if not key:
+            return None
+        try:
+            self.sync()
+            row = self._connect().execute(
+                'SELECT command, count FROM commands WHERE query = ? ORDER BY count DESC, last_used DESC LIMIT 1',
+                (key,)).fetchone()
+        except self._db_errors:
+            return None
+        return {'command': row[0], 'count': row[1]} if row else None
+
+    def complete(self, prefix, limit=10):
+        """
+        Accepted (query, command, count) whose query starts with prefix, most used first
+        """
+        key = normalize_query(prefix)
+        try:
+            self.sync()
+            return self._connect().execute(
+                'SELECT query, command, count FROM commands WHERE query >= ? AND query < ? '
+                'ORDER BY count DESC, last_used DESC LIMIT ?', (key, key + '\U0010ffff', limit)).fetchall()
+        except self._db_errors:
+            return []
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        self._synced_log = None
+
+# Consulted before the server unless --no-local is given (or ASH_LOCAL_STORE=0)
+_accepted = AcceptedCommands() if os.environ.get('ASH_LOCAL_STORE', '1') != '0' else None
+
+def save_history(query):
+    """Append a query to ~/.ashell/history"""
+    history_file = os.path.join(ASHELL_DIR, 'history')
+    try:
+        os.makedirs(os.path.dirname(history_file), exist_ok=True)
+        with open(history_file, 'a', encoding='utf-8') as f:
+            f.write(query + '\n')
+    except Exception as e:
+        print(f"Error saving query to history: {e}", file=sys.stderr)
+
+def interactive_shell(stream=True):
     """Interactive shell mode"""
     print("ash Client - Interactive Shell. Type 'exit' or 'quit' to leave.")
-    print("Make sure the server is running with: python ash_server.py")
-    
-    history_file = os.path.expanduser('~/.ashell/history')
-    history_dir = os.path.dirname(history_file)
-    os.makedirs(history_dir, exist_ok=True)
-    
+    if not check_server():
+        print("⚠️  ash server is not reachable yet. Start it with: ash-server")
+
     try:
         while True:
             try:
@@ -66,88 +658,122 @@ def interactive_shell():
             except (EOFError, KeyboardInterrupt):
                 print("\nExiting ash client.")
                 break
-                
+
             if query.lower() in ("exit", "quit"):
                 print("Exiting ash client.")
                 break
-                
+
             if not query:
                 continue
-                
-            # Save to history
-            try:
-                with open(history_file, 'a', encoding='utf-8') as f:
-                    f.write(query + '\n')
-            except Exception as e:
-                print(f"Error saving query to history: {e}")
-            
+
+            save_history(query)
+
+            local = accepted_command(query)
+            if local:
+                print(f"{local['command']} (accepted {local['count']}x before)")
+                continue
+
             # Generate command
+            trace_id = new_trace_id() if TRACING else None
+            if stream:
+                print_streamed_command(query, trace_id)
+                continue
+
             start_time = time.time()
-            response = generate_command(query)
+            response = generate_command(query, trace_id=trace_id)
             end_time = time.time()
-            
+
             if response:
                 print(f"{response} (generated in {end_time - start_time:.2f}s)")
             else:
                 print("❌ Failed to generate command")
-                
+
     except Exception as e:
         print(f"Shell error: {e}")
+    finally:
+        _connection.close()
+
+def print_accepted(prefix):
+    """--history: accepted commands whose query starts with prefix, most used first"""
+    store = _accepted or AcceptedCommands()
+    for query, command, count in store.complete(prefix):
+        print(f"{query}\t{command}\t{count}")
+    return 0
 
 def main():
-    start_total = time.time()
+    global _accepted
+    args = sys.argv[1:]
+    if '--no-local' in args:
+        # Always ask the server
+        _accepted = None
+        args = [arg for arg in args if arg != '--no-local']
+    if '--coproc' in args:
+        coproc_loop()
+        return
+    if args[:1] == ['--accept']:
+        # ash-client --accept QUERY COMMAND: the user ran COMMAND for QUERY
+        if len(args) != 3:
+            print("Usage: ash-client --accept QUERY COMMAND", file=sys.stderr)
+            sys.exit(2)
+        (_accepted or AcceptedCommands()).record(args[1], args[2])
+        return
+    if args[:1] == ['--history']:
+        sys.exit(print_accepted(" ".join(args[1:])))
+    if '--ping' in args:
+        sys.exit(ping_server())
+    if '--wait' in args:
+        sys.exit(wait_for_server())
+
     # Check for quiet mode flag
-    quiet_mode = '--quiet' in sys.argv
-    if quiet_mode:
-        sys.argv.remove('--quiet')
-    
-    # Check if server is running (skip in quiet mode)
-    if not quiet_mode and not check_server():
-        print("❌ ash server is not running!")
-        print("Start the server with: python ash_server.py")
-        print("Or run in background: nohup python ash_server.py > qsh_server.log 2>&1 &")
-        sys.exit(1)
-    
-    if len(sys.argv) > 1:
-        # Single command mode
-        query = " ".join(sys.argv[1:])
-        
-        # Save query to history (skip in quiet mode)
-        if not quiet_mode:
-            history_file = os.path.expanduser('~/.ashell/history')
-            history_dir = os.path.dirname(history_file)
-            os.makedirs(history_dir, exist_ok=True)
-            try:
-                with open(history_file, 'a', encoding='utf-8') as f:
-                    f.write(query + '\n')
-            except Exception as e:
-                print(f"Error saving query to history: {e}")
-        
-        # Generate command
-        start_time = time.time()
-        response = generate_command(query)
-        end_time = time.time()
-        
-        if response:
-            if quiet_mode:
-                print(response)  # Only print the command
-            else:
-                print(f"{response} (generated in {end_time - start_time:.2f}s)")
+    quiet_mode = '--quiet' in args
+    # Streaming is the default for interactive use; --no-stream waits for the full command
+    stream_mode = '--no-stream' not in args and not quiet_mode
+    args = [arg for arg in args if arg not in ('--quiet', '--stream', '--no-stream')]
+
+    if not args:
+        # Interactive mode
+        interactive_shell(stream=stream_mode)
+        return
+
+    # Single command mode
+    query = " ".join(args)
+    if not quiet_mode:
+        save_history(query)
+
+    # The shell passes its trace id, and when it started us, so start-up is traced too
+    trace_id = os.environ.get('ASH_TRACE_ID') or (new_trace_id() if TRACING else None)
+    if trace_id:
+        try:
+            started_at = float(os.environ.get('ASH_TRACE_START') or IMPORT_START)
+        except ValueError:
+            started_at = IMPORT_START
+        lookup_start = time.time()
+        local = accepted_command(query)
+        record_spans([trace_span(trace_id, 'client.startup', started_at, lookup_start),
+                      trace_span(trace_id, 'client.local_lookup', lookup_start, hit=bool(local))])
+    else:
+        local = accepted_command(query)
+    if local:
+        print(local['command'] if quiet_mode else f"{local['command']} (accepted {local['count']}x before)")
+        return
+
+    if stream_mode:
+        result = print_streamed_command(query, trace_id)
+        sys.exit(0 if result else 1)
+
+    start_time = time.time()
+    response = generate_command(query, trace_id=trace_id)
+    end_time = time.time()
+
+    if response:
+        if quiet_mode:
+            print(response)  # Only print the command
         else:
-            if not quiet_mode:
-                print("❌ Failed to generate command")
+            print(f"{response} (generated in {end_time - start_time:.2f}s)")
     else:
-        # Interactive mode
-        interactive_shell()
-    start_request = time.time()
-    # (Assume the main client logic sends a request to the server here)
-    # For example, if using requests.get/post:
-    # response = requests.get(...)
-    # ...
-    end_request = time.time()
-    print(f"[ash-client] Request time: {end_request - start_request:.2f}s")
-    end_total = time.time()
-    print(f"[ash-client] Total time: {end_total - start_total:.2f}s")
+        if not quiet_mode:
+            print("❌ Failed to generate command")
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
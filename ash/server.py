@@ -7,25 +7,41 @@ import os
 import sys
 import json
 import time
+import re
+import bisect
+import queue
+import select
+import shlex
+import socket
 import signal
+import socketserver
+import hashlib
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import zlib
+import ctypes
+from collections import OrderedDict, Counter, deque
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
 # Load CLI tools knowledge base
-def get_cli_tools_kb_path():
-    """Get the CLI tools KB path, handling both regular and PyInstaller environments"""
+def get_data_path(filename):
+    """Get the path of a bundled data file, handling both regular and PyInstaller environments"""
     if getattr(sys, 'frozen', False):
         # Running as PyInstaller executable
         base_path = sys._MEIPASS
-        embedded_path = os.path.join(base_path, 'ash', 'cli_tools_kb.json')
+        embedded_path = os.path.join(base_path, 'ash', filename)
         if os.path.exists(embedded_path):
             return embedded_path
     
     # Fallback to default path
-    default_path = os.path.join(os.path.dirname(__file__), 'cli_tools_kb.json')
+    default_path = os.path.join(os.path.dirname(__file__), filename)
     return default_path
 
+def get_cli_tools_kb_path():
+    """Get the CLI tools KB path, handling both regular and PyInstaller environments"""
+    return get_data_path('cli_tools_kb.json')
+
 CLI_TOOLS_KB_PATH = get_cli_tools_kb_path()
 try:
     with open(CLI_TOOLS_KB_PATH, 'r', encoding='utf-8') as f:
@@ -36,13 +52,20 @@ except Exception as e:
 
 # Local model imports
 try:
-    from llama_cpp import Llama
+    from llama_cpp import Llama, LogitsProcessorList, StoppingCriteriaList
+    from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
     LOCAL_MODEL_AVAILABLE = True
 except ImportError:
     LOCAL_MODEL_AVAILABLE = False
     # Don't exit immediately - let the main function handle this
     pass
 
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
 # Local quantized model path
 def get_model_path():
     """Get the model path, handling both regular and PyInstaller environments"""
@@ -68,148 +91,3533 @@ def get_model_path():
     default_path = 'models/qwen2.5-coder-3b-instruct-q4_k_m.gguf'
     return default_path
 
-MODEL_PATH = get_model_path()
+MODEL_PATH = get_model_path()
+
+DEFAULT_PORT = 8765
+
+# Unix domain socket (per-user, so no port collisions between users on one host)
+DEFAULT_SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~/.ash'), 'ash.sock')
+
+# Longest a request waits for a worker before giving up
+REQUEST_TIMEOUT = 120
+
+# Seconds without a request before a worker unloads its model
+DEFAULT_IDLE_UNLOAD = 3600
+
+# Most queries accepted by one POST /generate/batch
+MAX_BATCH_QUERIES = 256
+
+# Per-user state directory (shared with the Homebrew installation)
+ASH_HOME = os.path.expanduser('~/.ash')
+DEFAULT_CACHE_PATH = os.path.join(ASH_HOME, 'cache', 'responses.json')
+DEFAULT_SEMANTIC_CACHE_PATH = os.path.join(ASH_HOME, 'cache', 'semantic.npz')
+PREFIX_STATE_DIR = os.path.join(ASH_HOME, 'kvcache')
+DEFAULT_MODELS_DIR = os.path.join(ASH_HOME, 'models')
+SESSION_STATE_DIR = os.path.join(ASH_HOME, 'sessions')
+# Spans of traced requests, written by the clients and the server (see scripts/ash_trace.py)
+TRACE_PATH = os.path.join(ASH_HOME, 'traces', 'trace.jsonl')
+# Accepted X-Ash-Trace ids
+TRACE_ID_PATTERN = re.compile(r'[0-9A-Za-z_-]{1,64}')
+
+# Static part of the prompt. Its evaluated KV state is snapshotted once and
+# reused for every request, so only the query tail needs prompt evaluation.
+PROMPT_PREFIX = """You translate natural language to terminal commands. Return only the command, no explanations.
+
+Examples:
+"""
+
+# Few-shot examples for when retrieval finds none (no KB index, or retrieval_k=0)
+FALLBACK_EXAMPLES = """User: Show hidden files
+Command: ls -a
+
+User: Find .txt files
+Command: find . -name "*.txt"
+
+"""
+
+QUERY_TEMPLATE = """User: {query}
+Command:"""
+
+# Most tokens generated for one command
+MAX_COMMAND_TOKENS = 100
+
+# GBNF grammar for --constrained decoding: one line holding a shell command, i.e.
+# words (plain, escaped or quoted) joined by pipes, &&, || and ;. The newline
+# that completes it ends generation, so nothing after the command is decoded.
+SHELL_COMMAND_GRAMMAR = r'''
+root     ::= [ \t]* list [ \t]* "\n"
+list     ::= pipeline ([ \t]* ("&&" | "||" | ";") [ \t]* pipeline)* ([ \t]* "&")?
+pipeline ::= command ([ \t]* "|" [ \t]* command)*
+command  ::= word ([ \t]+ word)*
+word     ::= part+
+part     ::= [^ \t\n'"`\\|&;] | "\\" [^\n] | ">&" [0-9-] | "&>" | squoted | dquoted
+squoted  ::= "'" [^'\n]* "'"
+dquoted  ::= "\"" ([^"\\\n] | "\\" [^\n])* "\""
+'''
+
+def first_line(text):
+    """First line of generated text, without leading whitespace"""
+    return text.lstrip().split('\n')[0]
+
+def normalize_query(query):
+    """
+    Key of a query for the caches and the fast path: whitespace collapsed and
+    trailing punctuation dropped, case kept (client.py's accepted-command store
+    mirrors this, as it can't import the server)
+    """
+    return " ".join(query.split()).rstrip("?!. ")
+
+def file_fingerprint(path, chunk_size=4 * 1024 * 1024):
+    """Cheap content hash of a (large) file: size plus its first and last chunks"""
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    digest.update(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(size - chunk_size, chunk_size))
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+# First line of a saved llama state file: its JSON header names this format
+STATE_FILE_FORMAT = 'ash-llama-state'
+STATE_FILE_VERSION = 1
+
+def write_llama_state(path, state):
+    """
+    Save a llama-cpp LlamaState as a JSON header line followed by the raw bytes of
+    its input ids, scores and context state. Unlike a pickle, reading one back
+    can't run code, so files in a shared directory are safe to load.
+
+    Args:
+        path (str): File to write (replaced atomically)
+        state (LlamaState): State to save
+    """
+    input_ids = np.ascontiguousarray(state.input_ids)
+    scores = np.ascontiguousarray(state.scores)
+    header = {
+        'format': STATE_FILE_FORMAT,
+        'version': STATE_FILE_VERSION,
+        'n_tokens': int(state.n_tokens),
+        'seed': int(state.seed),
+        'input_ids': {'dtype': input_ids.dtype.str, 'shape': list(input_ids.shape)},
+        'scores': {'dtype': scores.dtype.str, 'shape': list(scores.shape)},
+        'llama_state_size': int(state.llama_state_size),
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(input_ids.tobytes())
+            f.write(scores.tobytes())
+            f.write(bytes(state.llama_state)[:state.llama_state_size])
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def read_llama_state(path):
+    """
+    Load a state saved by write_llama_state.
+
+    Returns:
+        LlamaState: The saved state
+
+    Raises:
+        ValueError: The file is not a complete state in this format
+    """
+    from llama_cpp import LlamaState
+
+    def array(f, spec):
+        dtype = np.dtype(spec['dtype'])
+        if dtype.kind not in 'iuf':
+            raise ValueError(f"Unexpected array type {spec['dtype']}")
+        shape = tuple(int(n) for n in spec['shape'])
+        size = int(np.prod(shape)) * dtype.itemsize
+        data = f.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated state file")
+        return np.frombuffer(data, dtype=dtype).reshape(shape).copy()
+
+    with open(path, 'rb') as f:
+        try:
+            header = json.loads(f.readline(4096))
+        except ValueError:
+            raise ValueError("Not a saved llama state")
+        if not isinstance(header, dict) or header.get('format') != STATE_FILE_FORMAT \
+                or header.get('version') != STATE_FILE_VERSION:
+            raise ValueError("Not a saved llama state of this version")
+        input_ids = array(f, header['input_ids'])
+        scores = array(f, header['scores'])
+        size = int(header['llama_state_size'])
+        llama_state = f.read(size)
+        if len(llama_state) != size or f.read(1):
+            raise ValueError("State file size does not match its header")
+    return LlamaState(input_ids=input_ids, scores=scores, n_tokens=int(header['n_tokens']),
+                      llama_state=llama_state, llama_state_size=size, seed=int(header['seed']))
+
+def model_cache_path(path, model_path):
+    """
+    Per-model variant of a cache file, so the pools of different models never
+    load or overwrite each other's persisted cache.
+
+    Args:
+        path (str): Cache file, e.g. ~/.ash/cache/responses.json
+        model_path (str): The model the cache answers for
+
+    Returns:
+        str: path with a hash of the model path before its extension
+    """
+    digest = hashlib.sha256(os.path.abspath(model_path).encode('utf-8')).hexdigest()[:12]
+    root, ext = os.path.splitext(path)
+    return f"{root}-{digest}{ext}"
+
+class Metrics:
+    """
+    Process-wide counters and fixed-bucket histograms, rendered in the Prometheus
+    text format by /metrics.
+
+    Every thread records into its own shard (a flat list of numbers), so recording
+    takes no lock; only a thread's first recording registers its shard. A scrape
+    sums the shards and folds those of finished threads into a retired total.
+    """
+
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    SOURCES = ('fast_path', 'cache', 'semantic_cache', 'prefetch', 'model', 'error')
+    # name -> (help, label values or None); all in seconds
+    HISTOGRAMS = {
+        'queue_wait': ("Time a generation waited for a worker", None),
+        'prepare': ("Example retrieval, prompt building and KV state restore time", None),
+        'tokenize': ("Prompt tokenization time", None),
+        'prompt_eval': ("Prompt evaluation time, until the first generated token", None),
+        'decode': ("Token generation time after the first token", None),
+        'serialize': ("Time to encode and write a generation response", None),
+        'request': ("Total /generate request time by answer source", SOURCES),
+    }
+    # name -> (help, label values or None)
+    COUNTERS = {
+        'requests': ("Generation requests by answer source", SOURCES),
+        'prompt_tokens': ("Prompt tokens of model generations", None),
+        'prompt_tokens_evaluated': ("Prompt tokens evaluated (not reused from the KV cache)", None),
+        'completion_tokens': ("Generated tokens", None),
+    }
+    # Gauges moved up and down with inc(); name -> help
+    LEVELS = {
+        'in_flight_requests': "Generation requests being served",
+    }
+
+    def __init__(self):
+        self._offsets = {}  # (name, label) -> first slot
+        size = 0
+        for name, (_, labels) in self.HISTOGRAMS.items():
+            for label in labels or (None,):
+                self._offsets[(name, label)] = size
+                # A count per bucket, one for +Inf, then the sum
+                size += len(self.LATENCY_BUCKETS) + 2
+        for name, (_, labels) in self.COUNTERS.items():
+            for label in labels or (None,):
+                self._offsets[(name, label)] = size
+                size += 1
+        for name in self.LEVELS:
+            self._offsets[(name, None)] = size
+            size += 1
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, shard)
+        self._retired = [0] * size
+        self._compact_at = 64
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = [0] * self._size
+            with self._lock:
+                if len(self._shards) >= self._compact_at:
+                    self._compact()
+                    self._compact_at = max(64, 2 * len(self._shards))
+                self._shards.append((threading.current_thread(), shard))
+            self._local.shard = shard
+        return shard
+
+    def _compact(self):
+        """Fold the shards of finished threads into the retired total (lock held)"""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for i, value in enumerate(shard):
+                    self._retired[i] += value
+        self._shards = live
+
+    def observe(self, name, seconds, label=None):
+        """Record a duration in histogram name"""
+        shard = self._shard()
+        offset = self._offsets[(name, label)]
+        shard[offset + bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+        shard[offset + len(self.LATENCY_BUCKETS) + 1] += seconds
+
+    def inc(self, name, amount=1, label=None):
+        """Add amount to counter or level name"""
+        self._shard()[self._offsets[(name, label)]] += amount
+
+    def totals(self):
+        """Sum of all shards"""
+        with self._lock:
+            self._compact()
+            totals = list(self._retired)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+    def _sum(self, totals, name):
+        """Sum of the observations of an unlabelled histogram"""
+        return totals[self._offsets[(name, None)] + len(self.LATENCY_BUCKETS) + 1]
+
+    def render(self, gauges=(), counters=()):
+        """
+        Prometheus text exposition of all metrics.
+
+        Args:
+            gauges (iterable): Extra (name, help, value) gauges sampled at scrape time
+            counters (iterable): Extra (name, help, value) counters kept elsewhere
+        """
+        totals = self.totals()
+        lines = []
+        for name, (help_text, labels) in self.HISTOGRAMS.items():
+            metric = f"ash_{name}_seconds"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for label in labels or (None,):
+                offset = self._offsets[(name, label)]
+                selector = f'source="{label}",' if label else ""
+                cumulative = 0
+                for i, bound in enumerate(self.LATENCY_BUCKETS + (float('inf'),)):
+                    cumulative += totals[offset + i]
+                    le = "+Inf" if bound == float('inf') else f"{bound:g}"
+                    lines.append(f'{metric}_bucket{{{selector}le="{le}"}} {cumulative}')
+                selector = f'{{source="{label}"}}' if label else ""
+                lines.append(f"{metric}_sum{selector} {totals[offset + len(self.LATENCY_BUCKETS) + 1]:.6f}")
+                lines.append(f"{metric}_count{selector} {cumulative}")
+        for name, (help_text, labels) in self.COUNTERS.items():
+            metric = f"ash_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for label in labels or (None,):
+                selector = f'{{source="{label}"}}' if label else ""
+                lines.append(f"{metric}{selector} {totals[self._offsets[(name, label)]]}")
+        for name, help_text, value in counters:
+            metric = f"ash_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        levels = [(name, help_text, totals[self._offsets[(name, None)]]) for name, help_text in self.LEVELS.items()]
+        decode_time = self._sum(totals, 'decode')
+        prompt_eval_time = self._sum(totals, 'prompt_eval')
+        rates = [
+            ('decode_tokens_per_second', "Generated tokens per second of decode time",
+             totals[self._offsets[('completion_tokens', None)]] / decode_time if decode_time else 0.0),
+            ('prompt_tokens_per_second', "Evaluated prompt tokens per second of prompt evaluation time",
+             totals[self._offsets[('prompt_tokens_evaluated', None)]] / prompt_eval_time if prompt_eval_time else 0.0),
+        ]
+        for name, help_text, value in levels + rates + list(gauges):
+            metric = f"ash_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value:g}" if isinstance(value, float) else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+# Shared by every pool and handler in the process
+METRICS = Metrics()
+
+class TraceLog:
+    """
+    Spans of traced requests, appended as JSON lines to a size-rotated file
+    (path, path.1 .. path.<backups>) that the clients append to as well.
+
+    A span is {"trace", "name", "ts", "dur", "proc", "pid", "attrs"} with ts the
+    wall clock start and dur in seconds. Requests are traced when the client
+    sends an X-Ash-Trace id, or all of them with ash-server --trace; untraced
+    requests never get here.
+    """
+
+    def __init__(self, path=TRACE_PATH, max_bytes=5 * 1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.trace_all = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_id():
+        return os.urandom(8).hex()
+
+    @staticmethod
+    def span(trace_id, name, start, duration, **attrs):
+        return {'trace': trace_id, 'name': name, 'ts': round(start, 6), 'dur': round(max(duration, 0.0), 6),
+                'proc': 'server', 'pid': os.getpid(), 'attrs': attrs}
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def write(self, spans):
+        """Append spans, rotating the file first once it passed max_bytes"""
+        data = "".join(json.dumps(span) + "\n" for span in spans).encode('utf-8')
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    self._rotate()
+                # One O_APPEND write per request, so spans of concurrent writers don't interleave
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                print(f"⚠️  Failed to write trace: {e}")
+
+    def generation_spans(self, trace_id, result):
+        """
+        Spans of a pool result's model generation: queue wait, then its stages
+        back to back from when a worker picked it up. Empty for answers that
+        involved no generation (caches).
+        """
+        if 'started_at' not in result:
+            return []
+        timings = result.get('timings', {})
+        spans = [self.span(trace_id, 'server.queue_wait', result['started_at'] - result['queue_wait'],
+                           result['queue_wait'], prefetched=bool(result.get('prefetched')))]
+        start = result['started_at']
+        for stage in ('prepare', 'tokenize', 'prompt_eval', 'decode'):
+            if stage in timings:
+                attrs = {}
+                if stage == 'prompt_eval':
+                    attrs = {'prompt_tokens': result.get('prompt_tokens'),
+                             'evaluated': result.get('prompt_tokens_evaluated')}
+                elif stage == 'decode':
+                    attrs = {'completion_tokens': result.get('completion_tokens')}
+                spans.append(self.span(trace_id, f'server.{stage}', start, timings[stage], **attrs))
+                start += timings[stage]
+        return spans
+
+# Shared by every handler in the process
+TRACES = TraceLog()
+
+def process_rss_bytes():
+    """Resident set size of this process, or its peak where the current one isn't available"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return 0
+
+class ResponseCache:
+    """
+    Bounded LRU cache of query -> command responses.
+
+    Entries are evicted least-recently-used first once either the entry count
+    or the approximate byte size exceeds its limit, and expire after ttl seconds.
+    When persist_path is set the cache is loaded from and saved to that file so
+    answers survive server restarts.
+    """
+
+    # Rough per-entry bookkeeping overhead used for the byte budget
+    ENTRY_OVERHEAD = 64
+
+    def __init__(self, max_entries=1024, max_bytes=1024 * 1024, ttl=7 * 24 * 3600,
+                 persist_path=None, namespace=None, save_every=32):
+        """
+        Initialize the response cache.
+
+        Args:
+            max_entries (int): Maximum number of cached responses
+            max_bytes (int): Maximum approximate size of keys and values in bytes
+            ttl (float): Seconds before an entry expires (0 disables expiry)
+            persist_path (str): JSON file to persist the cache to, or None
+            namespace (str): Identifies the model; a persisted cache for a different model is ignored
+            save_every (int): Save to disk after this many new entries
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.namespace = namespace
+        self.save_every = save_every
+        self._entries = OrderedDict()  # key -> (value, created_at)
+        self._bytes = 0
+        self._dirty = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.persist_path:
+            self.load()
+
+    def _entry_size(self, key, value):
+        return len(key.encode('utf-8')) + len(value.encode('utf-8')) + self.ENTRY_OVERHEAD
+
+    def _expired(self, created_at, now):
+        return self.ttl > 0 and now - created_at > self.ttl
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= self._entry_size(key, value)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def get(self, query):
+        """Return the cached command for query, or None"""
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[1], time.time()):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, query):
+        """Whether query has a live entry (not counted as a hit, recency unchanged)"""
+        with self._lock:
+            entry = self._entries.get(normalize_query(query))
+            return entry is not None and not self._expired(entry[1], time.time())
+
+    def put(self, query, value):
+        """Cache value as the response for query"""
+        key = normalize_query(query)
+        if not key or not value:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.time())
+            self._bytes += self._entry_size(key, value)
+            self._evict()
+            self._dirty += 1
+            should_save = self.persist_path and self._dirty >= self.save_every
+        if should_save:
+            self.save()
+
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._dirty += 1
+
+    def load(self):
+        """Load persisted entries, skipping expired ones and other models' caches"""
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"⚠️  Ignoring unreadable response cache {self.persist_path}: {e}")
+            return
+        if data.get('namespace') != self.namespace:
+            return
+        now = time.time()
+        with self._lock:
+            for key, value, created_at in data.get('entries', []):
+                if self._expired(created_at, now):
+                    continue
+                self._entries[key] = (value, created_at)
+                self._bytes += self._entry_size(key, value)
+            self._evict()
+
+    def save(self):
+        """Atomically write the cache to persist_path"""
+        if not self.persist_path:
+            return
+        with self._lock:
+            entries = [[key, value, created_at] for key, (value, created_at) in self._entries.items()]
+            self._dirty = 0
+        data = {'namespace': self.namespace, 'entries': entries}
+        tmp_path = f"{self.persist_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.persist_path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.persist_path)
+        except Exception as e:
+            print(f"⚠️  Failed to save response cache: {e}")
+
+    def stats(self):
+        """Return cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+class Session:
+    """One client's conversation: its turns so far and the KV state the last one left behind"""
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.turns = []  # (query, command), oldest first
+        self.examples = None  # Few-shot examples retrieved for the first turn, reused after
+        self.state = None  # llama state after the last generated turn, None when spilled or never saved
+        self.state_key = None  # ASHModel.session_key() of the model the state belongs to
+        self.state_bytes = 0
+        self.spill_path = None
+        self.last_used = time.time()
+
+class SessionStore:
+    """
+    Per-session conversation history and saved llama KV states, so a follow-up
+    query only evaluates the tokens it adds to the conversation.
+
+    States held in memory are bounded by memory_budget bytes: the least recently
+    used ones (and any idle for spill_after seconds) are written to spill_dir and
+    read back on the session's next turn. Sessions idle for ttl seconds are
+    forgotten, along with their spilled state.
+    """
+
+    def __init__(self, memory_budget=256 * 1024 * 1024, ttl=1800, spill_after=300, max_sessions=1024,
+                 max_turns=16, spill_dir=SESSION_STATE_DIR):
+        """
+        Initialize the session store.
+
+        Args:
+            memory_budget (int): Maximum bytes of KV state kept in memory
+            ttl (float): Seconds without a request before a session is forgotten (0 never)
+            spill_after (float): Seconds without a request before a state is spilled to disk (0 never)
+            max_sessions (int): Maximum number of sessions, least recently used forgotten first
+            max_turns (int): Turns of history kept per session
+            spill_dir (str): Directory for spilled states (files are removed on close())
+        """
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.spill_after = spill_after
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.spill_dir = spill_dir
+        self._sessions = OrderedDict()  # session id -> Session, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.spills = 0
+        self.restores = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def state_size(state):
+        """Approximate bytes held by a llama state"""
+        return (len(state.llama_state) + getattr(state.scores, 'nbytes', 0)
+                + getattr(state.input_ids, 'nbytes', 0))
+
+    def _spill_path(self, session_id):
+        digest = hashlib.sha256(session_id.encode('utf-8')).hexdigest()[:24]
+        return os.path.join(self.spill_dir, f"{os.getpid()}-{digest}.state")
+
+    def _drop_state(self, session):
+        if session.state is not None:
+            self._bytes -= session.state_bytes
+        if session.spill_path and os.path.exists(session.spill_path):
+            os.remove(session.spill_path)
+        session.state = None
+        session.state_key = None
+        session.state_bytes = 0
+        session.spill_path = None
+
+    def _forget(self, session_id):
+        self._drop_state(self._sessions.pop(session_id))
+
+    def _spill(self, session):
+        """Move session's state from memory to disk (dropped if it can't be written)"""
+        path = self._spill_path(session.id)
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            write_llama_state(path, session.state)
+            session.spill_path = path
+            self.spills += 1
+        except Exception as e:
+            print(f"⚠️  Dropping session state, spilling it failed: {e}")
+            session.state_key = None
+        self._bytes -= session.state_bytes
+        session.state = None
+
+    def _maintain(self, keep=None):
+        """Expire idle sessions, then spill states until memory fits the budget (lock held)"""
+        now = time.time()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if self.ttl > 0 and now - session.last_used > self.ttl:
+                self.expired += 1
+            elif len(self._sessions) > self.max_sessions:
+                self.evictions += 1
+            else:
+                break
+            self._forget(session_id)
+        for session in self._sessions.values():
+            if session is keep or session.state is None:
+                continue
+            idle = self.spill_after > 0 and now - session.last_used > self.spill_after
+            if idle or self._bytes > self.memory_budget:
+                self._spill(session)
+
+    def has_turns(self, session_id):
+        """Whether the session exists and has history, i.e. a query continues a conversation"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session is not None and bool(session.turns)
+
+    def checkout(self, session_id):
+        """
+        The session (created when new) with its state back in memory, ready for
+        its next turn.
+        """
+        with self._lock:
+            self._maintain()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(session_id)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            if session.state is None and session.spill_path:
+                try:
+                    state = read_llama_state(session.spill_path)
+                    os.remove(session.spill_path)
+                    session.spill_path = None
+                    session.state = state
+                    self._bytes += session.state_bytes
+                    self.restores += 1
+                except Exception as e:
+                    print(f"⚠️  Ignoring unreadable session state {session.spill_path}: {e}")
+                    self._drop_state(session)
+                self._maintain(keep=session)
+            return session
+
+    def record(self, session_id, query, command, state=None, state_key=None, examples=None):
+        """
+        Append a turn to the session's history. A new state replaces the saved one;
+        without one (cached or fast path answers) the old state stays, being a prefix
+        of the conversation still.
+
+        Returns:
+            int: Number of turns in the session
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(session_id)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            session.turns.append((query, command))
+            del session.turns[:-self.max_turns]
+            if session.examples is None:
+                session.examples = examples
+            if state is not None:
+                self._drop_state(session)
+                session.state = state
+                session.state_key = state_key
+                session.state_bytes = self.state_size(state)
+                self._bytes += session.state_bytes
+            self._maintain(keep=session)
+            return len(session.turns)
+
+    def close(self):
+        """Forget every session and delete the spilled states"""
+        with self._lock:
+            for session_id in list(self._sessions):
+                self._forget(session_id)
+
+    def stats(self):
+        """Return session counters"""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "states_in_memory": sum(1 for s in self._sessions.values() if s.state is not None),
+                "states_spilled": sum(1 for s in self._sessions.values() if s.spill_path),
+                "memory_bytes": self._bytes,
+                "memory_budget": self.memory_budget,
+                "spills": self.spills,
+                "restores": self.restores,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
+
+DEFAULT_KB_INDEX_DIR = os.path.join(ASH_HOME, 'cache')
+
+class KBIndex:
+    """
+    BM25 index over the CLI tools knowledge base used to pick few-shot examples per query.
+
+    Postings are stored term-major in CSR form (indptr, doc_ids, weights) with the
+    BM25 weight of every (term, document) pair precomputed, so a query is a handful
+    of vectorized scatter-adds plus an argpartition regardless of KB size.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9_+-]*")
+    STOPWORDS = frozenset("a an and the to of in on for from with by or is are be it this that all my me".split())
+
+    def __init__(self, vocab, indptr, doc_ids, weights, n_docs, kb_hash=""):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+        self.kb_hash = kb_hash
+
+    @classmethod
+    def tokenize(cls, text):
+        """Lowercase word tokens without stopwords"""
+        return [t for t in cls.TOKEN_RE.findall(text.lower()) if t not in cls.STOPWORDS]
+
+    @staticmethod
+    def kb_hash_of(kb):
+        return hashlib.sha256(json.dumps(kb, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def document_text(cls, entry):
+        parts = [entry.get('use_case', ''), entry.get('description', ''), entry.get('best_tool', '')]
+        parts.extend(entry.get('examples', []))
+        return " ".join(parts)
+
+    @classmethod
+    def build(cls, kb):
+        """Build the index from a list of KB entries"""
+        postings = {}  # term -> {doc_id: tf}
+        doc_lengths = []
+        for doc_id, entry in enumerate(kb):
+            tokens = cls.tokenize(cls.document_text(entry))
+            doc_lengths.append(len(tokens))
+            for token in tokens:
+                tfs = postings.setdefault(token, {})
+                tfs[doc_id] = tfs.get(doc_id, 0) + 1
+
+        n_docs = len(kb)
+        lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avg_length = float(lengths.mean()) if n_docs else 1.0
+        vocab = {}
+        indptr = [0]
+        doc_ids = []
+        tfs_flat = []
+        dfs = []
+        for term in sorted(postings):
+            vocab[term] = len(vocab)
+            docs = postings[term]
+            doc_ids.extend(docs.keys())
+            tfs_flat.extend(docs.values())
+            dfs.append(len(docs))
+            indptr.append(len(doc_ids))
+
+        indptr = np.asarray(indptr, dtype=np.int32)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        tf = np.asarray(tfs_flat, dtype=np.float32)
+        df = np.asarray(dfs, dtype=np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        norm = cls.K1 * (1 - cls.B + cls.B * lengths[doc_ids] / max(avg_length, 1e-6)) if n_docs else tf
+        weights = (np.repeat(idf, np.diff(indptr)) * tf * (cls.K1 + 1) / (tf + norm)).astype(np.float32)
+        return cls(vocab, indptr, doc_ids, weights, n_docs, kb_hash=cls.kb_hash_of(kb))
+
+    def save(self, path):
+        """Write the index as a compressed .npz artifact"""
+        terms = sorted(self.vocab, key=self.vocab.get)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            terms=np.asarray("\n".join(terms)),
+            indptr=self.indptr,
+            doc_ids=self.doc_ids,
+            weights=self.weights,
+            n_docs=np.asarray(self.n_docs),
+            kb_hash=np.asarray(self.kb_hash)
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save()"""
+        with np.load(path, allow_pickle=False) as data:
+            terms_blob = str(data['terms'])
+            terms = terms_blob.split("\n") if terms_blob else []
+            return cls(
+                {term: i for i, term in enumerate(terms)},
+                data['indptr'],
+                data['doc_ids'],
+                data['weights'],
+                int(data['n_docs']),
+                kb_hash=str(data['kb_hash'])
+            )
+
+    @classmethod
+    def load_or_build(cls, kb, index_dir=DEFAULT_KB_INDEX_DIR):
+        """Load the artifact for this KB content, building and saving it if missing"""
+        kb_hash = cls.kb_hash_of(kb)
+        path = os.path.join(index_dir, f"kb_index-{kb_hash[:16]}.npz") if index_dir else None
+        if path and os.path.exists(path):
+            try:
+                index = cls.load(path)
+                if index.kb_hash == kb_hash:
+                    return index
+            except Exception as e:
+                print(f"⚠️  Rebuilding unreadable KB index {path}: {e}")
+        index = cls.build(kb)
+        if path:
+            try:
+                index.save(path)
+            except Exception as e:
+                print(f"⚠️  Failed to save KB index: {e}")
+        return index
+
+    def search(self, query, k=3):
+        """Return [(doc_id, score)] of the k best matching KB entries, best first"""
+        rows = [self.vocab[t] for t in set(self.tokenize(query)) if t in self.vocab]
+        if not rows or self.n_docs == 0:
+            return []
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for row in rows:
+            start, end = self.indptr[row], self.indptr[row + 1]
+            # doc_ids are unique within a posting list, so fancy-index add is safe
+            scores[self.doc_ids[start:end]] += self.weights[start:end]
+        k = min(k, self.n_docs)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > 0]
+
+class HashingEmbedder:
+    """
+    Model-free fallback embedder: KB-style word tokens and their character
+    trigrams hashed into a fixed-size unit vector. Catches rewordings that share
+    words (plurals, word order, filler words), not synonyms.
+    """
+
+    name = "hashing-v1"
+    default_threshold = 0.8
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in KBIndex.tokenize(text):
+            vector[zlib.crc32(word.encode('utf-8')) % self.dim] += 1.0
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                vector[zlib.crc32(padded[i:i + 3].encode('utf-8')) % self.dim] += 0.5
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+class GGUFEmbedder:
+    """Sentence embeddings from a small GGUF embedding model (e.g. all-MiniLM-L6-v2) run by llama.cpp"""
+
+    default_threshold = 0.9
+
+    def __init__(self, model_path, n_threads=2, verbose=False):
+        self.name = f"gguf:{os.path.basename(model_path)}"
+        self.llm = Llama(model_path=model_path, embedding=True, n_ctx=512, n_threads=n_threads, verbose=verbose)
+        self.dim = self.llm.n_embd()
+        # One llama context, called from every request thread
+        self._lock = threading.Lock()
+
+    def embed(self, text):
+        with self._lock:
+            output = self.llm.embed(text)
+        vector = np.asarray(output, dtype=np.float32)
+        if vector.ndim == 2:
+            # Model without a pooling layer: one embedding per token
+            vector = vector.mean(axis=0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+class VectorIndex:
+    """
+    Inner-product index over unit vectors with a fixed number of slots.
+
+    Vectors are stored in contiguous per-list blocks so a search is a few
+    matrix-vector products without gathering rows. Until train_size vectors are
+    stored there is a single list, searched exhaustively. Then spherical k-means
+    splits them into n_lists inverted lists and a search only scores the n_probe
+    lists whose centroids are closest to the query (IVF), keeping lookups under a
+    millisecond at 100k entries. New vectors join the list of their nearest centroid.
+    """
+
+    def __init__(self, dim, capacity, n_lists=None, n_probe=8, train_size=None):
+        """
+        Args:
+            dim (int): Vector dimension
+            capacity (int): Number of slots
+            n_lists (int): Inverted lists once trained (default: about sqrt(capacity))
+            n_probe (int): Lists scored per search
+            train_size (int): Stored vectors that trigger training (default: 8 per list)
+        """
+        self.dim = dim
+        self.capacity = capacity
+        self.n_lists = n_lists or int(np.clip(np.sqrt(capacity), 16, 1024))
+        self.n_probe = min(n_probe, self.n_lists)
+        self.train_size = train_size or 8 * self.n_lists
+        self.used = np.zeros(capacity, dtype=bool)
+        self.slot_list = np.full(capacity, -1, dtype=np.int32)
+        self.slot_pos = np.full(capacity, -1, dtype=np.int32)
+        self.centroids = None
+        self._set_blocks([np.zeros((0, dim), dtype=np.float32)], [np.zeros(0, dtype=np.int64)])
+        self._free = list(range(capacity - 1, -1, -1))
+        self.count = 0
+
+    def _set_blocks(self, vectors, slots):
+        """Replace the lists' storage with the given per-list vectors and slots"""
+        self.blocks = []
+        self.block_slots = []
+        self.sizes = []
+        for label, (block, block_slots) in enumerate(zip(vectors, slots)):
+            size = len(block)
+            storage = np.zeros((max(16, size * 3 // 2), self.dim), dtype=np.float32)
+            storage[:size] = block
+            slot_storage = np.zeros(len(storage), dtype=np.int64)
+            slot_storage[:size] = block_slots
+            self.blocks.append(storage)
+            self.block_slots.append(slot_storage)
+            self.sizes.append(size)
+            self.slot_list[block_slots] = label
+            self.slot_pos[block_slots] = np.arange(size, dtype=np.int32)
+
+    def add(self, vector):
+        """Store vector in a free slot and return the slot"""
+        slot = self._free.pop()
+        label = int(np.argmax(self.centroids @ vector)) if self.centroids is not None else 0
+        size = self.sizes[label]
+        if size == len(self.blocks[label]):
+            grown = len(self.blocks[label]) * 3 // 2 + 16
+            self.blocks[label] = np.concatenate([self.blocks[label], np.zeros((grown - size, self.dim), dtype=np.float32)])
+            self.block_slots[label] = np.concatenate([self.block_slots[label], np.zeros(grown - size, dtype=np.int64)])
+        self.blocks[label][size] = vector
+        self.block_slots[label][size] = slot
+        self.sizes[label] = size + 1
+        self.slot_list[slot] = label
+        self.slot_pos[slot] = size
+        self.used[slot] = True
+        self.count += 1
+        if self.centroids is None and self.count >= self.train_size and self.capacity > self.train_size:
+            self.train()
+        return slot
+
+    def remove(self, slot):
+        """Free slot"""
+        label, pos = self.slot_list[slot], self.slot_pos[slot]
+        last = self.sizes[label] - 1
+        if pos != last:
+            # Move the list's last vector into the hole
+            moved = self.block_slots[label][last]
+            self.blocks[label][pos] = self.blocks[label][last]
+            self.block_slots[label][pos] = moved
+            self.slot_pos[moved] = pos
+        self.sizes[label] = last
+        self.slot_list[slot] = -1
+        self.slot_pos[slot] = -1
+        self.used[slot] = False
+        self._free.append(slot)
+        self.count -= 1
+
+    def get(self, slots):
+        """Stored vectors of slots"""
+        slots = np.asarray(slots, dtype=np.int64)
+        vectors = np.empty((len(slots), self.dim), dtype=np.float32)
+        for i, slot in enumerate(slots.tolist()):
+            vectors[i] = self.blocks[self.slot_list[slot]][self.slot_pos[slot]]
+        return vectors
+
+    def stored(self):
+        """(slots, vectors) of everything stored"""
+        slots = np.concatenate([block_slots[:size] for block_slots, size in zip(self.block_slots, self.sizes)])
+        vectors = np.concatenate([block[:size] for block, size in zip(self.blocks, self.sizes)])
+        return slots, vectors
+
+    def train(self, iterations=8, sample_size=None, seed=0):
+        """Cluster the stored vectors (a sample of them) into n_lists lists"""
+        slots, vectors = self.stored()
+        rng = np.random.default_rng(seed)
+        sample_size = sample_size or 16 * self.n_lists
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), sample_size), replace=False)]
+        centroids = sample[rng.choice(len(sample), min(self.n_lists, len(sample)), replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # An empty cluster keeps its old centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        self.set_centroids(centroids)
+
+    def set_centroids(self, centroids, assignment=None):
+        """
+        Regroup the stored vectors into one list per centroid.
+
+        Args:
+            centroids (np.ndarray): Unit vectors, one per list
+            assignment (dict): Known list of each slot (e.g. from disk); the others
+                go to their nearest centroid
+        """
+        centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        slots, vectors = self.stored()
+        labels = np.empty(len(slots), dtype=np.int64)
+        for start in range(0, len(slots), 8192):
+            labels[start:start + 8192] = np.argmax(vectors[start:start + 8192] @ centroids.T, axis=1)
+        if assignment:
+            for i, slot in enumerate(slots.tolist()):
+                label = assignment.get(slot)
+                if label is not None and 0 <= label < len(centroids):
+                    labels[i] = label
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(len(centroids) + 1))
+        self.centroids = centroids
+        self.n_lists = len(centroids)
+        self.n_probe = min(self.n_probe, self.n_lists)
+        self._set_blocks([vectors[order[bounds[i]:bounds[i + 1]]] for i in range(self.n_lists)],
+                         [slots[order[bounds[i]:bounds[i + 1]]] for i in range(self.n_lists)])
+
+    def search(self, vector, k=1):
+        """Return [(slot, similarity)] of up to k nearest stored vectors, best first"""
+        if self.count == 0:
+            return []
+        if self.centroids is None:
+            probed = [0]
+        else:
+            probed = np.argpartition(-(self.centroids @ vector), self.n_probe - 1)[:self.n_probe].tolist()
+        scores = []
+        slots = []
+        for label in probed:
+            size = self.sizes[label]
+            if size:
+                scores.append(self.blocks[label][:size] @ vector)
+                slots.append(self.block_slots[label][:size])
+        if not scores:
+            return []
+        scores = np.concatenate(scores)
+        slots = np.concatenate(slots)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(slots[i]), float(scores[i])) for i in top]
+
+class SemanticCache:
+    """
+    Cache of answered queries looked up by meaning: a query whose nearest
+    previously answered query (by embedding) is at least `threshold` cosine
+    similar gets that query's command.
+
+    Near neighbours often differ in exactly the part that matters ("delete
+    foo.txt" vs "delete bar.txt"), so a hit is also rejected when the cached
+    command copied a word the new query doesn't have, or the new query has a
+    literal (path, number, flag, ...) the cached one doesn't. Bounded to
+    max_entries with least-recently-used eviction, and persisted as .npz.
+    """
+
+    TOKEN_RE = re.compile(r"[\w.~/@:+-]+")
+    LITERAL_RE = re.compile(r"[\d./~@:_-]")
+
+    def __init__(self, embedder, threshold=None, max_entries=100000, persist_path=None,
+                 namespace=None, n_probe=8, save_every=64):
+        """
+        Args:
+            embedder (HashingEmbedder | GGUFEmbedder): Turns a query into a unit vector
+            threshold (float): Minimum cosine similarity of a hit (default: the embedder's)
+            max_entries (int): Maximum number of cached queries
+            persist_path (str): .npz file to persist the cache to, or None
+            namespace (str): Identifies the model; a persisted cache for a different
+                model or embedder is ignored
+            n_probe (int): Inverted lists scored per lookup
+            save_every (int): Save to disk after this many new entries
+        """
+        self.embedder = embedder
+        self.threshold = threshold if threshold is not None else embedder.default_threshold
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self.namespace = f"{namespace}|{embedder.name}"
+        self.save_every = save_every
+        self.index = VectorIndex(embedder.dim, max_entries, n_probe=n_probe)
+        self._queries = [None] * max_entries
+        self._commands = [None] * max_entries
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._slots = OrderedDict()  # normalized query -> slot, least recently used first
+        self._dirty = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+        self.lookup_time = 0.0
+        if self.persist_path:
+            self.load()
+
+    @classmethod
+    def tokens(cls, text):
+        return {token.strip('.,-').lower() for token in cls.TOKEN_RE.findall(text)} - {''}
+
+    def compatible(self, query, cached_query, command):
+        """Whether command, answered for cached_query, also answers query"""
+        words = self.tokens(query)
+        cached_words = self.tokens(cached_query)
+        # Words the cached answer copied from its query must be in the new one too
+        if (cached_words & self.tokens(command)) - words:
+            return False
+        return all(word in cached_words for word in words if self.LITERAL_RE.search(word))
+
+    def get(self, query):
+        """
+        Look up query.
+
+        Returns:
+            dict: {'command', 'query' (the cached neighbour), 'similarity'}, or None
+        """
+        vector = self.embedder.embed(normalize_query(query))
+        with self._lock:
+            start = time.perf_counter()
+            match = self.index.search(vector, k=1)
+            self.lookup_time += time.perf_counter() - start
+            if not match or match[0][1] < self.threshold:
+                self.misses += 1
+                return None
+            slot, similarity = match[0]
+            if not self.compatible(query, self._queries[slot], self._commands[slot]):
+                self.rejected += 1
+                self.misses += 1
+                return None
+            self._slots.move_to_end(self._queries[slot])
+            self._last_used[slot] = time.time()
+            self.hits += 1
+            return {'command': self._commands[slot], 'query': self._queries[slot], 'similarity': similarity}
+
+    def put(self, query, command):
+        """Remember command as the answer to query"""
+        key = normalize_query(query)
+        if not key or not command:
+            return
+        vector = self.embedder.embed(key)
+        with self._lock:
+            self._insert(key, command, vector, time.time())
+            self._dirty += 1
+            should_save = self.persist_path and self._dirty >= self.save_every
+        if should_save:
+            self.save()
+
+    def _insert(self, key, command, vector, last_used):
+        """Store an entry and return its slot (call with self._lock held)"""
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self.index.remove(slot)
+        if self.index.count >= self.max_entries:
+            # Evict the least recently used entry
+            _, slot = self._slots.popitem(last=False)
+            self.index.remove(slot)
+            self.evictions += 1
+        slot = self.index.add(vector)
+        self._slots[key] = slot
+        self._queries[slot] = key
+        self._commands[slot] = command
+        self._last_used[slot] = last_used
+        return slot
+
+    def load(self):
+        """Load persisted entries (and index centroids) unless they belong to another model or embedder"""
+        try:
+            with np.load(self.persist_path, allow_pickle=False) as data:
+                if str(data['namespace']) != self.namespace:
+                    return
+                vectors = data['vectors']
+                queries = data['queries'].tolist()
+                commands = data['commands'].tolist()
+                last_used = data['last_used']
+                centroids = data['centroids'] if 'centroids' in data else None
+                assignment = data['assignment'] if 'assignment' in data else None
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"⚠️  Ignoring unreadable semantic cache {self.persist_path}: {e}")
+            return
+        # Most recently used last, so eviction drops the oldest
+        order = np.argsort(last_used)[-self.max_entries:]
+        trained = centroids is not None and centroids.shape[1] == self.index.dim
+        with self._lock:
+            if trained:
+                # Skip training while loading, the saved lists are restored below
+                self.index.train_size = self.max_entries + 1
+            slots = [self._insert(queries[i], commands[i], vectors[i], float(last_used[i])) for i in order.tolist()]
+            if trained:
+                known = dict(zip(slots, assignment[order].tolist())) if assignment is not None else None
+                self.index.set_centroids(centroids, known)
+                self.index.train_size = 8 * self.index.n_lists
+        print(f"✅ Loaded semantic cache ({len(order)} entries) from {self.persist_path}")
+
+    def save(self):
+        """Atomically write the cache to persist_path"""
+        if not self.persist_path:
+            return
+        with self._lock:
+            slots = np.flatnonzero(self.index.used)
+            vectors = self.index.get(slots)
+            queries = np.asarray([self._queries[slot] for slot in slots.tolist()], dtype=str)
+            commands = np.asarray([self._commands[slot] for slot in slots.tolist()], dtype=str)
+            last_used = self._last_used[slots].copy()
+            centroids = self.index.centroids
+            assignment = self.index.slot_list[slots].copy()
+            self._dirty = 0
+        arrays = {'namespace': np.asarray(self.namespace), 'vectors': vectors, 'queries': queries,
+                  'commands': commands, 'last_used': last_used}
+        if centroids is not None:
+            arrays['centroids'] = centroids
+            arrays['assignment'] = assignment
+        tmp_path = f"{self.persist_path}.{os.getpid()}.tmp.npz"
+        try:
+            os.makedirs(os.path.dirname(self.persist_path), exist_ok=True)
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, self.persist_path)
+        except Exception as e:
+            print(f"⚠️  Failed to save semantic cache: {e}")
+
+    def stats(self):
+        """Return cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "embedder": self.embedder.name,
+                "threshold": self.threshold,
+                "entries": self.index.count,
+                "hits": self.hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "avg_lookup_ms": round(self.lookup_time / lookups * 1000, 4) if lookups else 0.0,
+                "inverted_lists": self.index.n_lists if self.index.centroids is not None else 0,
+            }
+
+FAST_PATH_RULES_PATH = get_data_path('fast_path_rules.json')
+USER_RULES_PATH = os.path.join(ASH_HOME, 'rules.json')
+
+class FastPathResolver:
+    """
+    Deterministic resolver that answers high-confidence queries without the model.
+
+    Rules come from fast_path_rules.json, the user's ~/.ash/rules.json (which takes
+    precedence) and argument-free KB examples. Two kinds are supported:
+
+    - intents: {"command": ..., "phrases": [...]} matched by character trigram
+      similarity (Dice coefficient) through an inverted trigram index
+    - patterns: {"pattern": ..., "command": ...} regular expressions matched against
+      the whole query, where {name:type} placeholders capture an argument slot that
+      is substituted into the command as {name}
+    """
+
+    SLOT_TYPES = {
+        'path': r"[\w.~/*+@%-]+",
+        'host': r"(?:[\w.-]+@)?[\w-]+(?:\.[\w-]+)*",
+        'url': r"(?:https?|ftp)://\S+",
+        'word': r"[\w.-]+",
+        'number': r"\d+",
+    }
+    SLOT_RE = re.compile(r"\{(\w+):(\w+)\}")
+    SAFE_ARG_RE = re.compile(r"[\w.~/*+@%:=,-]+")
+    PATTERN_CONFIDENCE = 0.9
+    # Applied per query word that does not appear in the matched phrase
+    UNKNOWN_WORD_PENALTY = 0.9
+
+    def __init__(self, rules, kb=None, threshold=0.85):
+        """
+        Initialize the resolver.
+
+        Args:
+            rules (list): Rule sets ({"intents": [...], "patterns": [...]}), highest precedence first
+            kb (list): CLI tools KB entries; argument-free examples become intents
+            threshold (float): Minimum confidence to answer without the model
+        """
+        self.threshold = threshold
+        self.phrases = []  # (phrase, command, words, trigram count)
+        self.trigram_index = {}
+        self.patterns = []  # (compiled regex, command template, confidence)
+        self.lookups = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+
+        for rule_set in rules:
+            for intent in rule_set.get('intents', []):
+                for phrase in intent.get('phrases', []):
+                    self._add_phrase(phrase, intent['command'])
+            for rule in rule_set.get('patterns', []):
+                try:
+                    self.patterns.append((
+                        self._compile(rule['pattern']),
+                        rule['command'],
+                        rule.get('confidence', self.PATTERN_CONFIDENCE)
+                    ))
+                except (KeyError, re.error) as e:
+                    print(f"⚠️  Skipping invalid fast-path rule {rule}: {e}")
+        for entry in kb or []:
+            examples = entry.get('examples', [])
+            if examples and self._is_argument_free(examples[0]):
+                self._add_phrase(entry.get('use_case', ''), examples[0])
+
+    @classmethod
+    def from_files(cls, paths, kb=None, threshold=0.85):
+        """Build a resolver from rule files, highest precedence first; missing files are skipped"""
+        rules = []
+        for path in paths:
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    rules.append(json.load(f))
+            except Exception as e:
+                print(f"⚠️  Failed to load fast-path rules {path}: {e}")
+        return cls(rules, kb=kb, threshold=threshold)
+
+    @staticmethod
+    def trigrams(text):
+        padded = f"  {text.lower()} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def _is_argument_free(command):
+        """True for commands made only of a tool, subcommands and flags (no files, hosts, ...)"""
+        return all(not any(c in token for c in "./*@:") for token in command.split())
+
+    def _compile(self, pattern):
+        def expand(match):
+            name, slot_type = match.groups()
+            return f"(?P<{name}>{self.SLOT_TYPES[slot_type]})"
+        return re.compile(self.SLOT_RE.sub(expand, pattern), re.IGNORECASE)
+
+    def _add_phrase(self, phrase, command):
+        phrase = normalize_query(phrase).lower()
+        if not phrase:
+            return
+        grams = self.trigrams(phrase)
+        phrase_id = len(self.phrases)
+        self.phrases.append((phrase, command, set(phrase.split()), len(grams)))
+        for gram in grams:
+            self.trigram_index.setdefault(gram, []).append(phrase_id)
+
+    @classmethod
+    def shell_arg(cls, value):
+        """Quote a slot value unless it is a plain word, path, glob or host"""
+        return value if cls.SAFE_ARG_RE.fullmatch(value) else shlex.quote(value)
+
+    def _match_intent(self, query):
+        grams = self.trigrams(query)
+        overlaps = Counter()
+        for gram in grams:
+            overlaps.update(self.trigram_index.get(gram, ()))
+        best = None
+        words = query.lower().split()
+        for phrase_id, overlap in overlaps.items():
+            phrase, command, phrase_words, n_grams = self.phrases[phrase_id]
+            confidence = 2 * overlap / (len(grams) + n_grams)
+            confidence *= self.UNKNOWN_WORD_PENALTY ** sum(1 for w in words if w not in phrase_words)
+            if best is None or confidence > best['confidence']:
+                best = {'command': command, 'confidence': confidence, 'rule': phrase}
+        return best
+
+    def _match_pattern(self, query):
+        for regex, template, confidence in self.patterns:
+            match = regex.fullmatch(query)
+            if match:
+                slots = {k: self.shell_arg(v) for k, v in match.groupdict().items() if v is not None}
+                try:
+                    command = template.format(**slots)
+                except (KeyError, IndexError):
+                    continue
+                return {'command': command, 'confidence': confidence, 'rule': regex.pattern}
+        return None
+
+    def resolve(self, query):
+        """
+        Resolve a query without the model.
+
+        Returns:
+            dict: {'command', 'confidence', 'rule'} when the best match clears the
+                  threshold, otherwise None
+        """
+        query = normalize_query(query)
+        best = None
+        for candidate in (self._match_intent(query), self._match_pattern(query)):
+            if candidate and (best is None or candidate['confidence'] > best['confidence']):
+                best = candidate
+        hit = best is not None and best['confidence'] >= self.threshold
+        with self._lock:
+            self.lookups += 1
+            if hit:
+                self.hits += 1
+        return best if hit else None
+
+    def stats(self):
+        """Return fast-path counters"""
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "intents": len(self.phrases),
+                "patterns": len(self.patterns),
+                "threshold": self.threshold,
+            }
+
+class GrammarConstraint:
+    """
+    Logits processor for greedy decoding restricted to a GBNF grammar.
+
+    llama-cpp's own grammar sampler matches every vocabulary token against the
+    grammar at each step. This asks the grammar about the top_k candidates only,
+    and about the whole vocabulary only when none of them fits, so a model that
+    mostly writes valid commands pays for a few dozen checks per token. It picks
+    the token itself (the best candidate the grammar accepts), leaves only that
+    one in the logits for the greedy sampler and advances the grammar with it.
+    Call reset() before each completion.
+    """
+
+    TOKEN_DATA = np.dtype([('id', np.intc), ('logit', np.single), ('p', np.single)]) if NUMPY_AVAILABLE else None
+
+    def __init__(self, llm, grammar, top_k=32):
+        """
+        Args:
+            llm (Llama): Loaded model whose vocabulary the grammar is matched against
+            grammar (str): GBNF grammar with a root rule
+            top_k (int): Candidates checked before falling back to the whole vocabulary
+        """
+        import llama_cpp
+        self._llama_cpp = llama_cpp
+        self.top_k = top_k
+        vocab = getattr(llm._model, 'vocab', None) or llm._model.model
+        self.sampler = llama_cpp.llama_sampler_init_grammar(vocab, grammar.encode('utf-8'), b"root")
+        if not self.sampler:
+            raise Exception("Grammar failed to parse")
+        self.steps = 0
+        self.full_checks = 0
+
+    def reset(self):
+        """Back to the grammar's root, for a new completion"""
+        self._llama_cpp.llama_sampler_reset(self.sampler)
+
+    def _check(self, ids, logits):
+        """Logits of candidates ids, -inf where the grammar rejects them"""
+        llama_cpp = self._llama_cpp
+        candidates = np.zeros(len(ids), dtype=self.TOKEN_DATA)
+        candidates['id'] = ids
+        candidates['logit'] = logits[ids]
+        array = llama_cpp.llama_token_data_array(
+            data=candidates.ctypes.data_as(ctypes.POINTER(llama_cpp.llama_token_data)),
+            size=len(ids), selected=-1, sorted=False)
+        llama_cpp.llama_sampler_apply(self.sampler, ctypes.byref(array))
+        return candidates['logit']
+
+    def __call__(self, input_ids, logits):
+        self.steps += 1
+        k = min(self.top_k, len(logits) - 1)
+        top = np.argpartition(-logits, k)[:k]
+        top = top[np.argsort(-logits[top], kind='stable')]
+        valid = np.flatnonzero(np.isfinite(self._check(top, logits)))
+        if len(valid):
+            token = int(top[valid[0]])
+        else:
+            self.full_checks += 1
+            checked = self._check(np.arange(len(logits), dtype=np.intc), logits)
+            if not np.isfinite(checked).any():
+                return logits
+            token = int(np.argmax(checked))
+        self._llama_cpp.llama_sampler_accept(self.sampler, token)
+        constrained = np.full_like(logits, -np.inf)
+        constrained[token] = logits[token]
+        return constrained
+
+    def close(self):
+        if self.sampler:
+            self._llama_cpp.llama_sampler_free(self.sampler)
+            self.sampler = None
+
+    def stats(self):
+        """How often the top_k candidates held no valid token"""
+        return {"steps": self.steps, "full_vocab_checks": self.full_checks, "top_k": self.top_k}
+
+class SpeculativeDraft:
+    """
+    Draft model for llama-cpp speculative decoding (Llama(draft_model=...)).
+
+    Llama calls the draft with the tokens so far and verifies the proposed
+    continuation in one batched eval, keeping the longest prefix it would have
+    generated itself. The next call's input shows how much of the previous
+    proposal survived, which is counted here for the acceptance rate and sets
+    the length of the next proposal: two tokens longer after a fully accepted
+    one, one shorter after a rejection, so a draft that keeps missing costs a
+    single token per step. Subclasses implement draft(), proposing up to
+    draft_length tokens.
+    """
+
+    kind = None
+
+    def __init__(self, num_pred_tokens=8):
+        """
+        Args:
+            num_pred_tokens (int): Maximum tokens proposed per call
+        """
+        self.num_pred_tokens = num_pred_tokens
+        self.draft_length = num_pred_tokens
+        self.calls = 0
+        self.proposed = 0
+        self.verified = 0
+        self.accepted = 0
+        self._last_len = None
+        self._last_draft = []
+
+    def draft(self, input_ids):
+        """Proposed continuation of input_ids (token list, may be empty)"""
+        raise NotImplementedError
+
+    def __call__(self, input_ids, **kwargs):
+        input_ids = np.asarray(input_ids, dtype=np.intc)
+        n = len(input_ids)
+        if self._last_len is not None and n > self._last_len:
+            # The main model kept `accepted` drafted tokens, then sampled one of its own
+            accepted = n - self._last_len - 1
+            if accepted <= len(self._last_draft) and \
+                    list(input_ids[self._last_len:self._last_len + accepted]) == self._last_draft[:accepted]:
+                self.verified += len(self._last_draft)
+                self.accepted += accepted
+                if accepted == len(self._last_draft):
+                    self.draft_length = min(self.draft_length + 2, self.num_pred_tokens)
+                else:
+                    self.draft_length = max(self.draft_length - 1, 1)
+        tokens = list(self.draft(input_ids))[:self.draft_length]
+        self._last_len = n
+        self._last_draft = tokens
+        self.calls += 1
+        self.proposed += len(tokens)
+        return np.array(tokens, dtype=np.intc)
+
+    def close(self):
+        pass
+
+    def stats(self):
+        """Draft counters; acceptance_rate is over proposals the main model has verified"""
+        return {
+            "kind": self.kind,
+            "num_pred_tokens": self.num_pred_tokens,
+            "draft_length": self.draft_length,
+            "calls": self.calls,
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": round(self.accepted / self.verified, 4) if self.verified else None,
+        }
+
+class PromptLookupDraft(SpeculativeDraft):
+    """
+    Prompt-lookup drafting: find an earlier occurrence of the last few tokens and
+    propose what followed it. Commands mostly copy filenames, hosts and flags from
+    the query or the retrieved examples in the prompt; when the prompt has no
+    match, the tokenized cli_tools_kb.json examples are searched.
+
+    The prompt search is llama-cpp's LlamaPromptLookupDecoding; this wraps it for
+    the KB fallback and for SpeculativeDraft's acceptance counting and adaptive
+    draft length, which the upstream class doesn't have.
+    """
+
+    kind = "prompt-lookup"
+
+    def __init__(self, num_pred_tokens=8, max_ngram_size=3):
+        """
+        Args:
+            num_pred_tokens (int): Maximum tokens proposed per call
+            max_ngram_size (int): Longest suffix matched (shorter ones are tried next)
+        """
+        super().__init__(num_pred_tokens)
+        self.max_ngram_size = max_ngram_size
+        self.corpus_index = {}
+
+    def set_corpus(self, token_lists):
+        """Index the continuations of every n-gram in token_lists (the KB examples)"""
+        index = {}
+        for tokens in token_lists:
+            for n in range(1, self.max_ngram_size + 1):
+                for start in range(len(tokens) - n):
+                    index[tuple(tokens[start:start + n])] = tokens[start + n:start + n + self.num_pred_tokens]
+        self.corpus_index = index
+
+    def draft(self, input_ids):
+        tokens = LlamaPromptLookupDecoding.find_candidate_pred_tokens(
+            input_ids, self.max_ngram_size, self.num_pred_tokens)
+        if len(tokens):
+            return tokens.tolist()
+        for n in range(min(self.max_ngram_size, len(input_ids)), 0, -1):
+            continuation = self.corpus_index.get(tuple(input_ids[-n:].tolist()))
+            if continuation:
+                return continuation
+        return []
+
+class GGUFDraft(SpeculativeDraft):
+    """
+    Draft with a small GGUF model sharing the main model's vocabulary: it decodes
+    draft_length tokens greedily, reusing its KV cache for the common prefix of calls.
+    """
+
+    kind = "draft-model"
+
+    def __init__(self, model_path, n_ctx=2048, n_threads=8, num_pred_tokens=8, verbose=False):
+        """
+        Args:
+            model_path (str): Path to the draft GGUF
+            n_ctx (int): Context size, as for the main model
+            n_threads (int): Threads used for drafting
+            num_pred_tokens (int): Maximum tokens proposed per call
+            verbose (bool): Whether llama.cpp logs
+        """
+        import llama_cpp
+        super().__init__(num_pred_tokens)
+        self.model_path = model_path
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, verbose=verbose)
+        self.eos = self.llm.token_eos()
+        self.n_vocab = self.llm.n_vocab()
+        self._get_logits_ith = llama_cpp.llama_get_logits_ith
+
+    def next_token(self):
+        """Greedy next token after the last evaluated one"""
+        # Llama.scores is only filled with logits_all, which would compute them for every prompt token
+        logits = np.ctypeslib.as_array(self._get_logits_ith(self.llm.ctx, -1), shape=(self.n_vocab,))
+        return int(np.argmax(logits))
+
+    def draft(self, input_ids):
+        llm = self.llm
+        # Keep the KV cells of the prefix this draft has already seen (eval drops the rest)
+        llm.n_tokens = Llama.longest_token_prefix(llm._input_ids, input_ids[:-1])
+        llm.eval(input_ids[llm.n_tokens:].tolist())
+        tokens = []
+        while len(tokens) < self.draft_length:
+            token = self.next_token()
+            if token == self.eos:
+                break
+            tokens.append(token)
+            if b"\n" in llm.detokenize([token]) or len(tokens) == self.draft_length:
+                # The command ends at the newline; nothing after it is kept
+                break
+            llm.eval([token])
+        return tokens
+
+    def close(self):
+        close = getattr(self.llm, 'close', None)
+        if close is not None:
+            close()
+
+class ASHModel:
+    """
+    ASH Model class for handling model loading and command generation.
+    This class can be used independently of the HTTP server.
+    """
+    
+    # Share of load_progress reached at the end of each loading step
+    PREFAULT_PROGRESS = 0.8
+    WEIGHTS_PROGRESS = 0.85
+    PREFIX_PROGRESS = 0.95
+
+    def __init__(self, model_path=None, n_ctx=2048, n_threads=8, n_batch=512, verbose=False,
+                 response_cache=None, use_cache=True, kb_index=None, retrieval_k=3,
+                 example_token_budget=160, use_mlock=False, prefault=True, constrained=False,
+                 prompt_lookup=False, draft_model_path=None, draft_tokens=8):
+        """
+        Initialize the ASH Model.
+        
+        Args:
+            model_path (str): Path to the model file. If None, uses default path.
+            n_ctx (int): Context window size (reduced for faster inference)
+            n_threads (int): Number of threads to use (increased for better performance)
+            n_batch (int): Maximum prompt tokens evaluated per llama_decode call
+            verbose (bool): Whether to enable verbose output
+            response_cache (ResponseCache): Cache of previous responses. If None, an
+                in-memory cache is created when use_cache is True.
+            use_cache (bool): Whether to cache generated commands
+            kb_index (KBIndex): Retrieval index over the KB. If None, one is loaded or
+                built when NumPy is available.
+            retrieval_k (int): Number of KB entries to draw few-shot examples from (0 disables)
+            example_token_budget (int): Maximum prompt tokens spent on retrieved examples
+            use_mlock (bool): Lock the weights in RAM while loaded so they are never paged out
+            prefault (bool): Read the GGUF into the page cache before loading it
+            constrained (bool): Restrict output to SHELL_COMMAND_GRAMMAR, ending at the first newline
+            prompt_lookup (bool): Speculative decoding with drafts looked up in the prompt and KB examples
+            draft_model_path (str): Speculative decoding with this small GGUF as the draft model
+            draft_tokens (int): Maximum tokens drafted per speculative step
+        """
+        self.model_path = model_path or get_model_path()
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.n_batch = n_batch
+        self.verbose = verbose
+        self.model = None
+        self.cli_tools_kb = CLI_TOOLS_KB
+        if response_cache is None and use_cache:
+            response_cache = ResponseCache(namespace=os.path.basename(self.model_path))
+        self.response_cache = response_cache
+        if kb_index is None and retrieval_k > 0 and NUMPY_AVAILABLE:
+            kb_index = KBIndex.load_or_build(self.cli_tools_kb)
+        self.kb_index = kb_index
+        self.retrieval_k = retrieval_k
+        self.example_token_budget = example_token_budget
+        self.prefix_tokens = None
+        self.prefix_state = None
+        self.prompt_stats = {"requests": 0, "prompt_tokens": 0, "prompt_tokens_evaluated": 0}
+        self._stats_lock = threading.Lock()
+        self.use_mlock = use_mlock
+        self.prefault = prefault
+        self.constrained = constrained
+        self.grammar = None
+        self.prompt_lookup = prompt_lookup
+        self.draft_model_path = draft_model_path
+        self.draft_tokens = draft_tokens
+        self.draft = None
+        # unloaded -> loading -> warming -> ready (or failed), back to unloaded on unload()
+        self.state = "unloaded"
+        self.load_progress = 0.0
+        self.load_error = None
+        self.load_time = None
+        self.loads = 0
+        
+    def load(self):
+        """Load the model"""
+        if not LOCAL_MODEL_AVAILABLE:
+            raise Exception("llama-cpp-python not available. Install with: pip install llama-cpp-python")
+        
+        if not os.path.exists(self.model_path):
+            raise Exception(f"Model not found at: {self.model_path}")
+        
+        print(f'🤖 Loading local model: {self.model_path}')
+        self.state = "loading"
+        self.load_progress = 0.0
+        self.load_error = None
+        start_time = time.time()
+        try:
+            if self.prefault:
+                self.prefault_weights()
+            self.draft = self.create_draft()
+            self.model = Llama(
+                model_path=self.model_path,
+                n_ctx=self.n_ctx,
+                n_threads=self.n_threads,
+                n_batch=self.n_batch,
+                use_mlock=self.use_mlock,
+                verbose=self.verbose,
+                **({'draft_model': self.draft} if self.draft is not None else {})
+            )
+            end_time = time.time()
+            print(f"✅ Local model loaded successfully in {end_time - start_time:.2f} seconds!")
+            if isinstance(self.draft, PromptLookupDraft):
+                self.draft.set_corpus([
+                    self.model.tokenize(f" {example}\n".encode('utf-8'), add_bos=False)
+                    for entry in self.cli_tools_kb for example in entry.get('examples', [])
+                ])
+            if self.constrained and self.grammar is None:
+                try:
+                    self.grammar = GrammarConstraint(self.model, SHELL_COMMAND_GRAMMAR)
+                    print("✅ Output constrained to a single-line shell command grammar")
+                except Exception as e:
+                    print(f"⚠️  Grammar-constrained decoding unavailable (non-critical): {e}")
+            self.state = "warming"
+            self.load_progress = self.WEIGHTS_PROGRESS
+            
+            # Evaluate the static prompt prefix once (or restore it from disk)
+            try:
+                self.prepare_prefix_state()
+            except Exception as e:
+                print(f"⚠️  Prompt prefix caching failed (non-critical): {e}")
+                self.prefix_state = None
+            self.load_progress = self.PREFIX_PROGRESS
+            
+            # Warm up the model with a dummy inference to reduce first command latency
+            print("🔥 Warming up model...")
+            warmup_start = time.time()
+            try:
+                self.model(self.build_prompt("test"), **dict(self.decode_options(), max_tokens=10))
+                warmup_end = time.time()
+                print(f"✅ Model warmed up in {warmup_end - warmup_start:.2f} seconds!")
+            except Exception as e:
+                print(f"⚠️  Warm-up failed (non-critical): {e}")
+            
+            self.load_time = time.time() - start_time
+            self.loads += 1
+            self.load_progress = 1.0
+            self.state = "ready"
+            return self.model
+        except Exception as e:
+            self.model = None
+            if self.draft is not None:
+                self.draft.close()
+                self.draft = None
+            self.state = "failed"
+            self.load_error = str(e)
+            raise Exception(f"Failed to load model: {e}")
+    
+    def prefault_weights(self, chunk_size=8 * 1024 * 1024):
+        """
+        Read the GGUF once so its pages are in the page cache before llama.cpp mmaps
+        it: the warm-up then doesn't fault them in from disk one by one, and a reload
+        after an idle unload usually finds them still cached. Advances load_progress.
+        """
+        size = os.path.getsize(self.model_path)
+        buffer = bytearray(chunk_size)
+        done = 0
+        with open(self.model_path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                done += n
+                self.load_progress = self.PREFAULT_PROGRESS * done / max(size, 1)
+    
+    def create_draft(self):
+        """Draft model for speculative decoding, None when disabled or the draft GGUF fails to load"""
+        if self.draft_model_path:
+            try:
+                draft = GGUFDraft(self.draft_model_path, n_ctx=self.n_ctx, n_threads=self.n_threads,
+                                  num_pred_tokens=self.draft_tokens, verbose=self.verbose)
+                print(f"✅ Speculative decoding with draft model {os.path.basename(self.draft_model_path)}")
+                return draft
+            except Exception as e:
+                print(f"⚠️  Draft model unavailable, decoding without it (non-critical): {e}")
+                return None
+        if self.prompt_lookup:
+            print("✅ Speculative decoding with prompt lookup")
+            return PromptLookupDraft(num_pred_tokens=self.draft_tokens)
+        return None
+    
+    def ensure_loaded(self):
+        """Load the model unless it is already loaded"""
+        if self.model is None:
+            self.load()
+    
+    def unload(self):
+        """
+        Free the model's context, KV cache and compute buffers. The mmap'd weights
+        become ordinary page cache the kernel may reclaim; load() brings it all back.
+        """
+        if self.model is None:
+            return
+        close = getattr(self.model, 'close', None)
+        if close is not None:
+            close()
+        self.model = None
+        if self.draft is not None:
+            self.draft.close()
+            self.draft = None
+        if self.grammar is not None:
+            # Bound to the unloaded model's vocabulary
+            self.grammar.close()
+            self.grammar = None
+        self.prefix_state = None
+        self.state = "unloaded"
+        self.load_progress = 0.0
+        print(f"💤 Unloaded idle model {os.path.basename(self.model_path)}")
+    
+    def prefix_state_paths(self):
+        """
+        Candidate snapshot paths for the prompt prefix state, keyed by model and prompt hash.
+        The first is next to the GGUF, the second is the fallback under ~/.ash.
+        """
+        model_hash = file_fingerprint(self.model_path)[:16]
+        prompt_key = f"{PROMPT_PREFIX}|n_ctx={self.n_ctx}|{getattr(sys.modules.get('llama_cpp'), '__version__', '')}"
+        if self.draft is not None:
+            # Speculative decoding keeps the logits of every position, which changes the state layout
+            prompt_key += f"|draft={self.draft.kind}"
+        prompt_hash = hashlib.sha256(prompt_key.encode('utf-8')).hexdigest()[:16]
+        name = f"{os.path.basename(self.model_path)}.prefix-{model_hash}-{prompt_hash}.state"
+        return [
+            os.path.join(os.path.dirname(os.path.abspath(self.model_path)), name),
+            os.path.join(PREFIX_STATE_DIR, name),
+        ]
+    
+    def prepare_prefix_state(self):
+        """Capture the KV state of PROMPT_PREFIX, loading a saved snapshot when one exists"""
+        self.prefix_tokens = self.model.tokenize(PROMPT_PREFIX.encode('utf-8'), special=True)
+        paths = self.prefix_state_paths()
+        
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            try:
+                state = read_llama_state(path)
+                self.model.load_state(state)
+                if list(self.model._input_ids) == list(self.prefix_tokens):
+                    self.prefix_state = state
+                    print(f"✅ Restored prompt prefix state ({len(self.prefix_tokens)} tokens) from {path}")
+                    return
+            except Exception as e:
+                print(f"⚠️  Ignoring unusable prefix state {path}: {e}")
+        
+        start_time = time.time()
+        self.model.reset()
+        self.model.eval(self.prefix_tokens)
+        self.prefix_state = self.save_state()
+        print(f"✅ Evaluated prompt prefix ({len(self.prefix_tokens)} tokens) in {time.time() - start_time:.2f} seconds")
+        
+        for path in paths:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_llama_state(path, self.prefix_state)
+                print(f"💾 Saved prompt prefix state to {path}")
+                return
+            except OSError:
+                # Model directory may be read-only (e.g. bundled executable), try the next location
+                continue
+    
+    def count_tokens(self, text):
+        """Number of model tokens in text (estimated before the model is loaded)"""
+        if self.model is None:
+            return len(text) // 4 + 1
+        return len(self.model.tokenize(text.encode('utf-8'), add_bos=False))
+    
+    def retrieve_examples(self, query):
+        """
+        Few-shot examples for query from the best matching KB entries.
+        Examples are added best entry first until example_token_budget is spent.
+        """
+        if self.kb_index is None or self.retrieval_k <= 0:
+            return ""
+        block = ""
+        used = 0
+        for doc_id, _ in self.kb_index.search(query, k=self.retrieval_k):
+            entry = self.cli_tools_kb[doc_id]
+            examples = entry.get('examples', [])
+            if not examples:
+                continue
+            example = QUERY_TEMPLATE.format(query=entry.get('use_case', '')) + f" {examples[0]}\n\n"
+            cost = self.count_tokens(example)
+            if used + cost > self.example_token_budget:
+                break
+            block += example
+            used += cost
+        return block
+    
+    def build_prompt(self, query, turns=(), examples=None):
+        """
+        Build the prompt: static prefix, retrieved examples (FALLBACK_EXAMPLES
+        when there are none), earlier turns of the session, then the query.
+        examples defaults to those retrieved for query.
+        """
+        if examples is None:
+            examples = self.retrieve_examples(query)
+        examples = examples or FALLBACK_EXAMPLES
+        history = "".join(QUERY_TEMPLATE.format(query=q) + f" {command}\n\n" for q, command in turns)
+        return PROMPT_PREFIX + examples + history + QUERY_TEMPLATE.format(query=query)
+    
+    def session_key(self):
+        """Identifies the KV state layout; a session state only loads into a model with the same key"""
+        return f"{self.model_path}|n_ctx={self.n_ctx}|draft={self.draft.kind if self.draft is not None else ''}"
+    
+    def save_state(self):
+        """
+        The model's llama state with its scores trimmed: the full buffer is n_batch x
+        n_vocab floats (~300 MB for Qwen's vocabulary), but only sampling reads the
+        logits and it re-evaluates at least the last prompt token first, so one row
+        is enough (load_state broadcasts it over the rest)
+        """
+        state = self.model.save_state()
+        state.scores = state.scores[:1].copy()
+        return state
+
+    def save_session_state(self):
+        """KV state after the last generation, for the session's next turn to continue from"""
+        return self.save_state()
+    
+    def restore_prefix_state(self, session=None):
+        """
+        Make sure the model's KV cache starts with the prompt prefix before a request,
+        or with the session's conversation so far when its state was saved.
+        """
+        state = session.state if session is not None and session.state_key == self.session_key() else None
+        if state is not None:
+            n_saved = state.n_tokens
+            if self.model.n_tokens < n_saved or list(self.model._input_ids[:n_saved]) != list(state.input_ids[:n_saved]):
+                self.model.load_state(state)
+            return
+        if self.prefix_state is None:
+            return
+        n_prefix = len(self.prefix_tokens)
+        if self.model.n_tokens >= n_prefix and list(self.model._input_ids[:n_prefix]) == self.prefix_tokens:
+            # llama-cpp reuses the longest matching prefix of its KV cache on its own
+            return
+        self.model.load_state(self.prefix_state)
+    
+    def decode_options(self):
+        """
+        Sampling arguments for one completion: greedy, grammar-constrained if enabled.
+        No stop strings: generate() leaves the stream at the end of the first line,
+        and llama-cpp holds back text that could start a stop string, which would
+        cost a token past the newline.
+        """
+        if self.grammar is not None:
+            self.grammar.reset()
+            return {'max_tokens': MAX_COMMAND_TOKENS, 'temperature': 0.0,
+                    'logits_processor': LogitsProcessorList([self.grammar])}
+        return {'max_tokens': MAX_COMMAND_TOKENS, 'temperature': 0.0}
+    
+    def is_loaded(self):
+        """Check if the model is loaded"""
+        return self.model is not None
+    
+    def generate_command(self, query, use_cache=True):
+        """
+        Generate a command from a natural language query.
+        
+        Args:
+            query (str): Natural language query
+            use_cache (bool): Whether to answer from / store into the response cache
+            
+        Returns:
+            str: Generated command
+        """
+        return self.generate(query, use_cache=use_cache)['command']
+    
+    def generate(self, query, use_cache=True, on_token=None, should_stop=None, session=None):
+        """
+        Generate a command from a natural language query.
+        
+        Args:
+            query (str): Natural language query
+            use_cache (bool): Whether to answer from / store into the response cache
+            on_token (callable): Called with each new piece of the command as it is
+                generated (generation always stops at the end of the first line)
+            should_stop (callable): Polled after every generated token; when it returns
+                True decoding stops and GenerationCancelled is raised
+            session (Session): Conversation query follows up on; its turns go into the
+                prompt and its saved state is loaded, so only new tokens are evaluated
+            
+        Returns:
+            dict: {'command': str, 'cached': bool} plus, when the model ran, token
+                  counts ('prompt_tokens', 'prompt_tokens_evaluated', 'completion_tokens')
+                  and stage 'timings' in seconds ('prepare', 'tokenize', 'prompt_eval', 'decode').
+                  With a session it also has the new 'session_state', its 'state_key'
+                  and the 'examples' used, for SessionStore.record().
+        """
+        turns = list(session.turns) if session is not None else []
+        # A follow-up's answer depends on the conversation, not just the query
+        cache = self.response_cache if use_cache and not turns else None
+        if cache is not None:
+            cached = cache.get(query)
+            if cached is not None:
+                if on_token:
+                    on_token(cached)
+                return {'command': cached, 'cached': True}
+        
+        if not self.is_loaded():
+            raise Exception("Model is not loaded. Call load() first.")
+        
+        # Build the prompt - keeping it short to fit within context window
+        prepare_start = time.perf_counter()
+        examples = session.examples if session is not None else None
+        if examples is None:
+            examples = self.retrieve_examples(query)
+        prompt = self.build_prompt(query, turns, examples)
+        try:
+            self.restore_prefix_state(session)
+            tokenize_start = time.perf_counter()
+            prompt_tokens = self.model.tokenize(prompt.encode('utf-8'), special=True)
+            while turns and len(prompt_tokens) + MAX_COMMAND_TOKENS > self.n_ctx:
+                # Forget the oldest turns rather than overflow the context
+                turns = turns[1:]
+                prompt = self.build_prompt(query, turns, examples)
+                prompt_tokens = self.model.tokenize(prompt.encode('utf-8'), special=True)
+            generate_start = time.perf_counter()
+            # Tokens already in the KV cache are skipped by llama-cpp (it re-evaluates at least one)
+            reused = Llama.longest_token_prefix(self.model._input_ids, prompt_tokens[:-1])
+            evaluated = len(prompt_tokens) - reused
+            first_token_at = []
+
+            def check_stop(input_ids, logits):
+                # Runs after every sampled token; the first call ends prompt evaluation
+                if not first_token_at:
+                    first_token_at.append(time.perf_counter())
+                return should_stop is not None and should_stop()
+            stopping_criteria = StoppingCriteriaList([check_stop])
+            text = ""
+            sent = 0
+            completion_tokens = 0
+            # Streamed even without on_token: each token arrives before it is evaluated,
+            # so leaving at the first newline after the command decodes nothing past it
+            for chunk in self.model(
+                prompt,
+                stopping_criteria=stopping_criteria,
+                stream=True,
+                **self.decode_options()
+            ):
+                choice = chunk['choices'][0]
+                text += choice['text']
+                if choice.get('finish_reason') is None:
+                    # The closing chunk only carries the finish reason
+                    completion_tokens += 1
+                if on_token is not None:
+                    delta = first_line(text)[sent:]
+                    if delta:
+                        on_token(delta)
+                        sent += len(delta)
+                if '\n' in text.lstrip():
+                    break
+            response_text = first_line(text).strip()
+            generate_end = time.perf_counter()
+        except Exception as e:
+            raise Exception(f"Model generation error: {e}")
+        if should_stop is not None and should_stop():
+            # Partial output, don't cache it
+            raise GenerationCancelled()
+        session_state = self.save_session_state() if session is not None else None
+        
+        with self._stats_lock:
+            self.prompt_stats["requests"] += 1
+            self.prompt_stats["prompt_tokens"] += len(prompt_tokens)
+            self.prompt_stats["prompt_tokens_evaluated"] += evaluated
+        if cache is not None:
+            cache.put(query, response_text)
+        result = {
+            'command': response_text,
+            'cached': False,
+            'prompt_tokens': len(prompt_tokens),
+            'prompt_tokens_evaluated': evaluated,
+            'completion_tokens': completion_tokens,
+            'timings': {
+                'prepare': tokenize_start - prepare_start,
+                'tokenize': generate_start - tokenize_start,
+                'prompt_eval': (first_token_at[0] if first_token_at else generate_end) - generate_start,
+                'decode': generate_end - first_token_at[0] if first_token_at else 0.0,
+            }
+        }
+        if session is not None:
+            result.update(session_state=session_state, state_key=self.session_key(), examples=examples)
+        return result
+    
+    def get_model_info(self):
+        """Get information about the loaded model"""
+        if not self.is_loaded():
+            return {
+                "status": "not_loaded",
+                "state": self.state,
+                "load_progress": round(self.load_progress, 3),
+                "load_error": self.load_error,
+            }
+        
+        return {
+            "status": "loaded",
+            "state": self.state,
+            "load_time": round(self.load_time, 3) if self.load_time else None,
+            "loads": self.loads,
+            "use_mlock": self.use_mlock,
+            "constrained": self.grammar.stats() if self.grammar is not None else None,
+            "speculative": self.draft.stats() if self.draft is not None else None,
+            "model_path": self.model_path,
+            "model_size_gb": os.path.getsize(self.model_path) / (1024**3),
+            "n_ctx": self.n_ctx,
+            "n_threads": self.n_threads,
+            "n_batch": self.n_batch,
+            "kb_entries": len(self.cli_tools_kb),
+            "kb_index_terms": len(self.kb_index.vocab) if self.kb_index else 0,
+            "cache": self.response_cache.stats() if self.response_cache else None,
+            "prefix_tokens": len(self.prefix_tokens) if self.prefix_state is not None else 0,
+            "prompt_eval": dict(self.prompt_stats)
+        }
+
+class ServerBusyError(Exception):
+    """Raised when the generation queue is full"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class GenerationCancelled(Exception):
+    """Raised when a generation is cancelled before it finished"""
+
+    def __init__(self, message="Generation cancelled"):
+        super().__init__(message)
+
+class ClientDisconnected(GenerationCancelled):
+    """Raised when the client of a request went away while it waited"""
+
+    def __init__(self):
+        super().__init__("Client disconnected")
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a generation did not finish before its request's deadline"""
+
+# How often a waiting request handler checks whether its client went away
+DISCONNECT_POLL_INTERVAL = 0.05
+
+class GenerationJob:
+    """A queued generation request, completed by a pool worker"""
+
+    def __init__(self, query, priority=0, stream=False, session=None, timeout=None, conversation=None):
+        """
+        Args:
+            query (str): Natural language query
+            priority (int): Lower runs first
+            stream (bool): Collect generated pieces in self.tokens as they are produced
+            session (str): Prefetching client session, None for interactive requests
+            timeout (float): Seconds from now until the job's deadline, None for no deadline
+            conversation (Session): Conversation the query belongs to (see SessionStore)
+        """
+        self.query = query
+        self.priority = priority
+        self.session = session
+        self.conversation = conversation
+        self.on_finish = None
+        self.enqueued_at = time.time()
+        self.deadline = self.enqueued_at + timeout if timeout else None
+        self.started_at = None
+        self.first_token_at = None
+        self.result = None
+        self.error = None
+        self.tokens = queue.Queue() if stream else None
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
+
+    @property
+    def is_prefetch(self):
+        return self.session is not None
+
+    def cancel(self):
+        """Ask the worker to drop the job, or stop decoding it if it already started"""
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def is_expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def should_stop(self):
+        """Whether the worker should abandon the job (cancelled or past its deadline)"""
+        return self.is_cancelled() or self.is_expired()
+
+    def stop_error(self):
+        """The error a job abandoned because of should_stop() finishes with"""
+        if self.is_expired() and not self.is_cancelled():
+            return DeadlineExceeded(f"Generation did not finish within {self.deadline - self.enqueued_at:.1f}s")
+        return GenerationCancelled()
+
+    def on_token(self, piece):
+        """Record a newly generated piece of the command"""
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        if self.tokens is not None:
+            self.tokens.put(piece)
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+        if self.on_finish is not None:
+            self.on_finish(self)
+        if self.tokens is not None:
+            # Wake up a streaming reader
+            self.tokens.put(None)
+
+    def _wait_slice(self, is_disconnected):
+        """
+        Seconds to block for before checking on the job again. Cancels the job and
+        raises once the deadline passed or the client disconnected.
+        """
+        if self._done.is_set():
+            return 0
+        remaining = self.deadline - time.time() if self.deadline else None
+        if remaining is not None and remaining <= 0:
+            # The worker stops on its own once past the deadline
+            raise DeadlineExceeded(f"Generation did not finish within {self.deadline - self.enqueued_at:.1f}s")
+        if is_disconnected is not None:
+            if is_disconnected():
+                self.cancel()
+                raise ClientDisconnected()
+            return DISCONNECT_POLL_INTERVAL if remaining is None else min(remaining, DISCONNECT_POLL_INTERVAL)
+        return remaining
+
+    def iter_tokens(self, is_disconnected=None):
+        """Yield generated pieces until the job finishes (streaming jobs only)"""
+        while True:
+            try:
+                piece = self.tokens.get(timeout=self._wait_slice(is_disconnected))
+            except queue.Empty:
+                continue
+            if piece is None:
+                return
+            yield piece
+
+    def wait(self, is_disconnected=None):
+        """
+        Wait for the job and return its result, raising the worker's error if it failed.
+
+        Args:
+            is_disconnected (callable): Polled while waiting; when it returns True the
+                job is cancelled and ClientDisconnected is raised
+        """
+        while not self._done.wait(self._wait_slice(is_disconnected)):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class WorkerPool:
+    """
+    Pool of ASHModel workers fed from a bounded priority queue.
+
+    Every worker owns an ASHModel (its own llama context and KV cache); the GGUF
+    weights are mmap'd, so the page cache shares them between workers. The response
+    cache is shared and checked before queueing, so cached answers never wait for a
+    worker. When the queue is full submit() raises ServerBusyError instead of blocking.
+
+    Prefetch jobs (commands generated speculatively while the user is still typing)
+    run at PREFETCH_PRIORITY, so queued interactive requests always go first, and a
+    running prefetch is cancelled when an interactive request would otherwise have
+    to wait for it. Their results are kept by exact query in a small LRU.
+
+    Each worker loads its model itself when it starts, so the server can listen
+    while models load (see readiness()), and unloads it again after idle_unload
+    seconds without a job; the next job it picks up reloads it.
+
+    Batches (generate_batch()) run at BATCH_PRIORITY with at most capacity() jobs
+    queued at a time, so they keep every worker busy without filling the queue
+    that interactive requests need.
+
+    Requests with a session id continue that session's conversation: follow-ups
+    skip the caches and prefetches, and the worker resumes from the session's
+    saved KV state (see SessionStore).
+    """
+
+    # Queue priority of prefetch jobs (interactive requests use 0)
+    PREFETCH_PRIORITY = 10
+    # Queue priority of batch jobs: behind interactive requests, ahead of prefetches
+    BATCH_PRIORITY = 5
+
+    def __init__(self, models, max_queue=16, response_cache=None, max_prefetched=256, idle_unload=0,
+                 semantic_cache=None, sessions=None):
+        """
+        Initialize the pool and start one worker thread per model.
+
+        Args:
+            models (list): Loaded ASHModel instances
+            max_queue (int): Maximum number of waiting requests
+            response_cache (ResponseCache): Shared cache consulted before queueing
+            max_prefetched (int): Maximum number of prefetched results kept
+            idle_unload (float): Seconds without a job before a worker unloads its model (0 never)
+            semantic_cache (SemanticCache): Consulted after response_cache misses
+            sessions (SessionStore): Conversation state of session requests, None to ignore session ids
+        """
+        self.models = models
+        self.max_queue = max_queue
+        self.response_cache = response_cache
+        self.semantic_cache = semantic_cache
+        self.sessions = sessions
+        self.successor = None  # Pool that took over (see retire())
+        self.max_prefetched = max_prefetched
+        self.idle_unload = idle_unload
+        self.queue = queue.PriorityQueue(maxsize=max_queue)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._prefetch_jobs = {}  # session -> in-flight prefetch GenerationJob
+        self._prefetched = OrderedDict()  # exact query -> command
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.prefetch_stats = {"submitted": 0, "completed": 0, "cancelled": 0, "hits": 0, "dropped": 0}
+        self._service_time_avg = 1.0
+        self.threads = []
+        for i, model in enumerate(models):
+            thread = threading.Thread(target=self._worker, args=(model,), name=f"ash-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def retry_after(self):
+        """Rough seconds until a queue slot frees up"""
+        backlog = self.queue.qsize() + self.busy
+        return max(1, int(round(self._service_time_avg * backlog / max(len(self.models), 1))))
+
+    def capacity(self):
+        """Number of jobs the pool runs at once"""
+        return len(self.models)
+
+    def submit(self, job):
+        """Queue a job, raising ServerBusyError when the queue is full"""
+        with self._lock:
+            successor = self.successor
+            if successor is None:
+                try:
+                    self.queue.put_nowait((job.priority, next(self._seq), job))
+                    return job
+                except queue.Full:
+                    self.rejected += 1
+        if successor is None:
+            raise ServerBusyError(self.retry_after())
+        # Retired by a model switch: the pool that replaced this one runs the job
+        return successor.submit(job)
+
+    def prefetch(self, query, session):
+        """
+        Start generating query in the background, replacing the session's previous
+        prefetch (which is cancelled).
+
+        Args:
+            query (str): Natural language query, typically the shell buffer so far
+            session (str): Identifies the typing client
+
+        Returns:
+            str: 'ready' when the answer is already known, 'pending' when the same query
+                 is in flight, 'queued', or 'dropped' when the queue is too busy
+        """
+        if self.response_cache is not None and query in self.response_cache:
+            return 'ready'
+        with self._lock:
+            if query in self._prefetched:
+                return 'ready'
+            previous = self._prefetch_jobs.get(session)
+            if previous is not None and previous.query == query:
+                return 'pending'
+            # Leave at least half of the queue to interactive requests
+            if self.queue.qsize() >= self.max_queue // 2:
+                self.prefetch_stats["dropped"] += 1
+                return 'dropped'
+            job = GenerationJob(query, priority=self.PREFETCH_PRIORITY, session=session, timeout=REQUEST_TIMEOUT)
+            job.on_finish = self._prefetch_finished
+            self._prefetch_jobs[session] = job
+            self.prefetch_stats["submitted"] += 1
+        if previous is not None:
+            previous.cancel()
+        try:
+            self.submit(job)
+        except ServerBusyError:
+            with self._lock:
+                if self._prefetch_jobs.get(session) is job:
+                    del self._prefetch_jobs[session]
+                self.prefetch_stats["dropped"] += 1
+            return 'dropped'
+        return 'queued'
+
+    def _prefetch_finished(self, job):
+        with self._lock:
+            if self._prefetch_jobs.get(job.session) is job:
+                del self._prefetch_jobs[job.session]
+            if job.error is None:
+                self.prefetch_stats["completed"] += 1
+                self._prefetched[job.query] = job.result['command']
+                self._prefetched.move_to_end(job.query)
+                while len(self._prefetched) > self.max_prefetched:
+                    self._prefetched.popitem(last=False)
+            elif isinstance(job.error, GenerationCancelled):
+                self.prefetch_stats["cancelled"] += 1
+
+    def _claim_prefetch(self, query, timeout=None, is_disconnected=None):
+        """
+        Result of a prefetch for exactly query: stored, or in flight and already
+        running (waited for under the request's deadline). Returns None when there
+        is none to use.
+        """
+        with self._lock:
+            command = self._prefetched.get(query)
+            if command is not None:
+                self.prefetch_stats["hits"] += 1
+                return {'command': command, 'cached': False, 'prefetched': True}
+            job = next((job for job in self._prefetch_jobs.values() if job.query == query), None)
+        if job is None:
+            return None
+        if job.started_at is None:
+            # Still queued at low priority, generate it as an interactive request instead
+            job.cancel()
+            return None
+        if timeout:
+            # The prefetch now serves this request, so it inherits its deadline
+            job.deadline = min(job.deadline or float('inf'), time.time() + timeout)
+        try:
+            result = dict(job.wait(is_disconnected))
+        except ClientDisconnected:
+            raise
+        except GenerationCancelled:
+            return None
+        with self._lock:
+            self.prefetch_stats["hits"] += 1
+        result['prefetched'] = True
+        return result
+
+    def _preempt_prefetches(self, query):
+        """Cancel running prefetches of other queries when no worker is free for query"""
+        with self._lock:
+            if self.busy < self.capacity():
+                return
+            running = [job for job in self._prefetch_jobs.values()
+                       if job.started_at is not None and job.query != query]
+        for job in running:
+            job.cancel()
+
+    def _cached(self, query):
+        """Cached answer for query, or for a semantically equivalent query; None on a miss"""
+        if self.response_cache is not None:
+            cached = self.response_cache.get(query)
+            if cached is not None:
+                return {'command': cached, 'cached': True}
+        if self.semantic_cache is not None:
+            hit = self.semantic_cache.get(query)
+            if hit is not None:
+                return {'command': hit['command'], 'cached': True,
+                        'similar_query': hit['query'], 'similarity': hit['similarity']}
+        return None
+
+    def _remember(self, query, command):
+        """Store a generated answer in the caches"""
+        if self.response_cache is not None:
+            self.response_cache.put(query, command)
+        if self.semantic_cache is not None:
+            self.semantic_cache.put(query, command)
+
+    def continues_session(self, session):
+        """Whether a query in session follows up on earlier turns (so needs their context)"""
+        return session is not None and self.sessions is not None and self.sessions.has_turns(session)
+
+    def record_turn(self, session, query, result):
+        """
+        Add query's answer to the session's history, with the KV state the worker
+        saved; returns result without the state, with the session's 'turn' count.
+        """
+        result = dict(result)
+        state = result.pop('session_state', None)
+        state_key = result.pop('state_key', None)
+        examples = result.pop('examples', None)
+        if session is not None and self.sessions is not None:
+            result['turn'] = self.sessions.record(session, query, result['command'], state=state,
+                                                  state_key=state_key, examples=examples)
+        return result
+
+    def generate(self, query, use_cache=True, timeout=None, is_disconnected=None, session=None):
+        """
+        Generate a command for query on the next free worker.
+
+        Args:
+            query (str): Natural language query
+            use_cache (bool): Whether to answer from / store into the response cache
+            timeout (float): Seconds until the request's deadline; generation is
+                abandoned and DeadlineExceeded raised when it passes
+            is_disconnected (callable): Polled while waiting; when the client went away
+                generation is abandoned and ClientDisconnected raised
+            session (str): Conversation the query belongs to, None for a standalone query
+
+        Returns:
+            dict: Result of ASHModel.generate(), with 'prefetched' set when it
+                  came from a prefetch and 'turn' when it belongs to a session
+        """
+        conversation = self.sessions.checkout(session) if self.sessions is not None and session is not None else None
+        follow_up = conversation is not None and bool(conversation.turns)
+        result = self._cached(query) if use_cache and not follow_up else None
+        if result is None:
+            if not follow_up:
+                result = self._claim_prefetch(query, timeout, is_disconnected)
+            if result is None:
+                self._preempt_prefetches(query)
+                job = GenerationJob(query, timeout=timeout, conversation=conversation)
+                result = self.submit(job).wait(is_disconnected)
+            if use_cache and not follow_up:
+                self._remember(query, result['command'])
+        if conversation is not None:
+            result = self.record_turn(session, query, result)
+        return result
+
+    def generate_batch(self, queries, use_cache=True, timeout=None, is_disconnected=None):
+        """
+        Generate commands for many queries, pipelined through the workers.
+
+        Cached queries are answered up front and repeated queries are generated once.
+        The rest are submitted as capacity() jobs at a time, refilling the window as
+        jobs finish. Failures are per query: the batch never raises for one of them.
+
+        Args:
+            queries (list): Natural language queries
+            use_cache (bool): Whether to answer from / store into the response cache
+            timeout (float): Seconds until the whole batch's deadline
+            is_disconnected (callable): Polled while waiting; when the client went away
+                the batch is abandoned and ClientDisconnected raised
+
+        Returns:
+            list: For each query, in order, the result dict of ASHModel.generate() or
+                  the exception its generation failed with
+        """
+        deadline = time.time() + timeout if timeout else None
+        results = [None] * len(queries)
+        waiting = OrderedDict()  # query -> indexes answered by its generation
+        for i, query in enumerate(queries):
+            if query in waiting:
+                waiting[query].append(i)
+                continue
+            cached = self._cached(query) if use_cache else None
+            if cached is not None:
+                results[i] = cached
+            else:
+                waiting[query] = [i]
+
+        todo = deque(waiting)
+        window = deque()
+        try:
+            while todo or window:
+                while todo and len(window) < self.capacity():
+                    query = todo[0]
+                    remaining = deadline - time.time() if deadline else None
+                    if remaining is not None and remaining <= 0:
+                        outcome = DeadlineExceeded(f"Batch did not finish within {timeout:.1f}s")
+                    else:
+                        job = GenerationJob(query, priority=self.BATCH_PRIORITY, timeout=remaining)
+                        try:
+                            window.append((query, self.submit(job)))
+                            todo.popleft()
+                            continue
+                        except ServerBusyError as e:
+                            if window:
+                                # Retry once one of our own jobs has finished
+                                break
+                            outcome = e
+                    todo.popleft()
+                    for i in waiting[query]:
+                        results[i] = outcome
+                if not window:
+                    continue
+                query, job = window.popleft()
+                try:
+                    outcome = job.wait(is_disconnected)
+                    if use_cache:
+                        self._remember(query, outcome['command'])
+                except ClientDisconnected:
+                    raise
+                except Exception as e:
+                    outcome = e
+                for i in waiting[query]:
+                    results[i] = outcome
+        finally:
+            # Nobody is waiting for what is left when the batch is abandoned
+            for _, job in window:
+                job.cancel()
+        return results
+
+    def generate_stream(self, query, use_cache=True, timeout=None, is_disconnected=None, session=None):
+        """
+        Generate a command for query, yielding pieces of it as they are produced.
+        The generator's return value (StopIteration.value) is the final result dict.
+        Closing the generator early cancels the generation. Arguments are as for generate().
+        """
+        conversation = self.sessions.checkout(session) if self.sessions is not None and session is not None else None
+        follow_up = conversation is not None and bool(conversation.turns)
+        result = self._cached(query) if use_cache and not follow_up else None
+        if result is None and not follow_up:
+            result = self._claim_prefetch(query, timeout, is_disconnected)
+            if result is not None and use_cache:
+                self._remember(query, result['command'])
+        if result is not None:
+            yield result['command']
+        else:
+            self._preempt_prefetches(query)
+            job = self.submit(GenerationJob(query, stream=True, timeout=timeout, conversation=conversation))
+            try:
+                yield from job.iter_tokens(is_disconnected)
+            finally:
+                # Reader gave up (closed us or raised): free the worker
+                if job.result is None:
+                    job.cancel()
+            result = job.wait()
+            result['first_token_wait'] = job.first_token_at - job.enqueued_at if job.first_token_at else None
+            if use_cache and not follow_up:
+                self._remember(query, result['command'])
+        if conversation is not None:
+            result = self.record_turn(session, query, result)
+        return result
+
+    def _load(self, model):
+        """Load model if needed; returns False (after printing why) if it failed"""
+        try:
+            model.ensure_loaded()
+            return True
+        except Exception as e:
+            print(f"❌ {e}")
+            return False
+
+    def _wait_for_job(self, model):
+        """Next queued job (None means shut down), unloading model while idle"""
+        try:
+            _, _, job = self.queue.get(timeout=self.idle_unload or None)
+        except queue.Empty:
+            # Nobody needed this worker for a while, give its memory back
+            model.unload()
+            _, _, job = self.queue.get()
+        return job
+
+    def _worker(self, model):
+        self._load(model)
+        while True:
+            job = self._wait_for_job(model)
+            if job is None:
+                break
+            if job.should_stop():
+                # Cancelled or expired while queued, never start it
+                error = job.stop_error()
+                job.finish(error=error)
+                with self._lock:
+                    self._count_stopped(error)
+                continue
+            if not self._load(model):
+                job.finish(error=Exception(f"Model failed to load: {model.load_error}"))
+                with self._lock:
+                    self.failed += 1
+                continue
+            job.started_at = time.time()
+            with self._lock:
+                self.busy += 1
+            error = None
+            try:
+                result = model.generate(job.query, use_cache=False,
+                                        on_token=job.on_token if job.tokens is not None else None,
+                                        should_stop=job.should_stop, session=job.conversation)
+                result['queue_wait'] = job.started_at - job.enqueued_at
+                result['started_at'] = job.started_at
+                self._observe(result)
+                job.finish(result=result)
+            except GenerationCancelled:
+                error = job.stop_error()
+                job.finish(error=error)
+            except Exception as e:
+                error = e
+                job.finish(error=e)
+            service_time = time.time() - job.started_at
+            with self._lock:
+                self.busy -= 1
+                if error is None:
+                    self.completed += 1
+                    self._service_time_avg = 0.8 * self._service_time_avg + 0.2 * service_time
+                else:
+                    self._count_stopped(error)
+
+    def _observe(self, result):
+        """Record the stage timings and token counts of a model generation in METRICS"""
+        METRICS.observe('queue_wait', result['queue_wait'])
+        for stage, seconds in result.get('timings', {}).items():
+            METRICS.observe(stage, seconds)
+        METRICS.inc('prompt_tokens', result.get('prompt_tokens', 0))
+        METRICS.inc('prompt_tokens_evaluated', result.get('prompt_tokens_evaluated', 0))
+        METRICS.inc('completion_tokens', result.get('completion_tokens', 0))
+
+    def _count_stopped(self, error):
+        """Count a job that ended with error (call with self._lock held)"""
+        if isinstance(error, DeadlineExceeded):
+            self.expired += 1
+        elif isinstance(error, GenerationCancelled):
+            self.cancelled += 1
+        else:
+            self.failed += 1
+
+    def shutdown(self):
+        """Stop the worker threads once the queued jobs are done"""
+        for _ in self.threads:
+            self.queue.put((float('inf'), next(self._seq), None))
+
+    def retire(self, successor, timeout=None):
+        """
+        Hand over to successor and drain: jobs submitted from now on go to it, the
+        ones already queued or running here finish first, then the models are unloaded.
+        """
+        with self._lock:
+            self.successor = successor
+        self.shutdown()
+        for thread in self.threads:
+            thread.join(timeout)
+        for model in self.models:
+            model.unload()
+
+    def stats(self):
+        """Return pool counters"""
+        with self._lock:
+            return {
+                "workers": len(self.models),
+                "busy": self.busy,
+                "queued": self.queue.qsize(),
+                "max_queue": self.max_queue,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "expired": self.expired,
+                "avg_service_time": round(self._service_time_avg, 4),
+                "prefetch": dict(self.prefetch_stats, in_flight=len(self._prefetch_jobs),
+                                 stored=len(self._prefetched)),
+            }
+
+    def readiness(self):
+        """
+        Serving state of the pool: 'ready' when some worker's model is loaded,
+        otherwise the furthest along of 'warming', 'loading', 'unloaded' (loads on
+        the next request) and 'failed', with the mean load progress of the models.
+        """
+        states = [model.state for model in self.models]
+        for state in ("ready", "warming", "loading", "unloaded", "failed"):
+            if state in states:
+                break
+        readiness = {
+            "state": state,
+            "progress": round(sum(model.load_progress for model in self.models) / max(len(self.models), 1), 3),
+        }
+        if state == "failed":
+            readiness["error"] = self.models[0].load_error
+        return readiness
+
+    def get_model_info(self):
+        """Model info of the first worker plus pool counters"""
+        info = self.models[0].get_model_info() if self.models else {"status": "no_model"}
+        info["pool"] = self.stats()
+        if self.response_cache is not None:
+            info["cache"] = self.response_cache.stats()
+        if self.semantic_cache is not None:
+            info["semantic_cache"] = self.semantic_cache.stats()
+        if self.sessions is not None:
+            info["sessions"] = self.sessions.stats()
+        return info
+
+def _llama_api(*names):
+    """First of the given low-level llama_cpp functions that exists (names changed across versions)"""
+    import llama_cpp
+    for name in names:
+        func = getattr(llama_cpp, name, None)
+        if func is not None:
+            return func
+    raise Exception(f"llama_cpp provides none of: {', '.join(names)}")
+
+class BatchDecoder:
+    """
+    Multi-sequence greedy decoder on a dedicated llama context.
+
+    Every active request owns a KV sequence slot. The static prompt prefix is
+    evaluated once into its own sequence and copied (shared, not re-evaluated)
+    into each new slot, so a request only evaluates its retrieved examples and
+    query. One llama_decode call advances all active sequences by a token.
+    """
+
+    def __init__(self, ash_model, n_slots, slot_ctx=512, n_batch=512):
+        """
+        Create the context and evaluate the shared prompt prefix.
+
+        Args:
+            ash_model (ASHModel): Loaded model whose weights and tokenizer are used
+            n_slots (int): Maximum number of concurrent sequences
+            slot_ctx (int): KV cells reserved per sequence
+            n_batch (int): Maximum tokens submitted in one decode call
+        """
+        import llama_cpp
+        self.ash_model = ash_model
+        self.llm = ash_model.model
+        self.n_slots = n_slots
+        self.slot_ctx = slot_ctx
+        self.n_batch = n_batch
+        self.prefix_seq = n_slots
+        self.n_vocab = self.llm.n_vocab()
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = slot_ctx * (n_slots + 1)
+        params.n_batch = n_batch
+        params.n_seq_max = n_slots + 1
+        if hasattr(params, 'kv_unified'):
+            # Per-sequence KV streams (the default since llama.cpp b6000) can't seq_cp the shared prefix
+            params.kv_unified = True
+        params.n_threads = ash_model.n_threads
+        params.n_threads_batch = ash_model.n_threads
+        self.ctx = _llama_api('llama_init_from_model', 'llama_new_context_with_model')(self.llm.model, params)
+        if not self.ctx:
+            raise Exception("Failed to create batched llama context")
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, n_slots + 1)
+        self._decode = llama_cpp.llama_decode
+        self._get_logits_ith = llama_cpp.llama_get_logits_ith
+        if hasattr(llama_cpp, 'llama_memory_seq_rm'):
+            memory = llama_cpp.llama_get_memory(self.ctx)
+            self._seq_rm = lambda seq, p0, p1: llama_cpp.llama_memory_seq_rm(memory, seq, p0, p1)
+            self._seq_cp = lambda src, dst, p0, p1: llama_cpp.llama_memory_seq_cp(memory, src, dst, p0, p1)
+        else:
+            seq_rm = _llama_api('llama_kv_self_seq_rm', 'llama_kv_cache_seq_rm')
+            seq_cp = _llama_api('llama_kv_self_seq_cp', 'llama_kv_cache_seq_cp')
+            self._seq_rm = lambda seq, p0, p1: seq_rm(self.ctx, seq, p0, p1)
+            self._seq_cp = lambda src, dst, p0, p1: seq_cp(self.ctx, src, dst, p0, p1)
+
+        self.eog_tokens = {self.llm.token_eos()}
+        for marker in ("<|im_end|>", "<|endoftext|>", "<|eot_id|>"):
+            tokens = self.llm.tokenize(marker.encode('utf-8'), add_bos=False, special=True)
+            if len(tokens) == 1:
+                self.eog_tokens.add(tokens[0])
+
+        self.prefix_tokens = self.llm.tokenize(PROMPT_PREFIX.encode('utf-8'), special=True)
+        for start in range(0, len(self.prefix_tokens), n_batch):
+            chunk = self.prefix_tokens[start:start + n_batch]
+            self._submit([(tok, start + i, self.prefix_seq, False) for i, tok in enumerate(chunk)])
+
+    def _submit(self, entries):
+        """Decode [(token, pos, seq_id, want_logits)]; returns nothing, raises on failure"""
+        batch = self.batch
+        for i, (token, pos, seq_id, want_logits) in enumerate(entries):
+            batch.token[i] = token
+            batch.pos[i] = pos
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = seq_id
+            batch.logits[i] = want_logits
+        batch.n_tokens = len(entries)
+        ret = self._decode(self.ctx, batch)
+        if ret != 0:
+            raise Exception(f"llama_decode failed ({ret})")
+
+    def tokenize(self, prompt):
+        """Tokens of prompt, special tokens included"""
+        return self.llm.tokenize(prompt.encode('utf-8'), special=True)
+
+    def start(self, seq, tokens):
+        """Attach prompt tokens to slot seq, sharing the prefix KV cells; returns how many are shared"""
+        shared = Llama.longest_token_prefix(self.prefix_tokens, tokens[:-1])
+        self._seq_rm(seq, -1, -1)
+        if shared:
+            self._seq_cp(self.prefix_seq, seq, 0, shared)
+        return shared
+
+    def release(self, seq):
+        """Free the KV cells of slot seq"""
+        self._seq_rm(seq, -1, -1)
+
+    def step(self, sequences):
+        """
+        Advance sequences by one decode call.
+
+        Each sequence is a _BatchSequence; those with pending prompt tokens feed
+        (part of) them, the others feed their last sampled token. Returns the
+        sequences that produced a new token, with it appended.
+        """
+        entries = []
+        sampled = []
+        budget = self.n_batch
+        for sequence in sequences:
+            feed = sequence.pending if sequence.pending else [sequence.tokens[-1]]
+            if len(feed) > budget:
+                # Prompt chunk doesn't fit next to the others, feed it next step
+                continue
+            for i, token in enumerate(feed):
+                entries.append((token, sequence.n_past + i, sequence.slot, i == len(feed) - 1))
+            sequence.n_past += len(feed)
+            sequence.pending = []
+            sampled.append((sequence, len(entries) - 1))
+            budget -= len(feed)
+        if not entries:
+            return []
+        self._submit(entries)
+        for sequence, index in sampled:
+            logits = np.ctypeslib.as_array(self._get_logits_ith(self.ctx, index), shape=(self.n_vocab,))
+            sequence.tokens.append(int(np.argmax(logits)))
+        return [sequence for sequence, _ in sampled]
+
+    def close(self):
+        import llama_cpp
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+
+class _BatchSequence:
+    """Decode state of one request inside a BatchScheduler"""
+
+    def __init__(self, job, slot, prompt_tokens, n_past):
+        self.job = job
+        self.slot = slot
+        self.prompt_tokens = prompt_tokens
+        self.pending = prompt_tokens[n_past:]
+        self.prompt_evaluated = len(self.pending)
+        self.n_past = n_past
+        self.tokens = []
+        self.text = b""
+        self.sent = 0
+        self.prepare_time = 0.0
+        self.tokenize_time = 0.0
+        self.examples = None
+        self.eval_start = time.perf_counter()
+        self.first_token_at = None
 
-DEFAULT_PORT = 8765
+    def timings(self):
+        """Stage durations in seconds, as in ASHModel.generate()"""
+        now = time.perf_counter()
+        first_token_at = self.first_token_at or now
+        return {
+            'prepare': self.prepare_time,
+            'tokenize': self.tokenize_time,
+            'prompt_eval': first_token_at - self.eval_start,
+            'decode': now - first_token_at,
+        }
 
-class ASHModel:
+class BatchScheduler(WorkerPool):
     """
-    ASH Model class for handling model loading and command generation.
-    This class can be used independently of the HTTP server.
+    Continuous batching variant of WorkerPool.
+
+    A single scheduler thread per model merges queued requests into one
+    multi-sequence llama batch. New requests join between decode steps as slots
+    free up, and each sequence retires as soon as it emits a newline, an
+    end-of-generation token or max_tokens. When the scheduler is idle, the first
+    request waits up to max_wait seconds for others to batch with.
+
+    Session follow-ups get the conversation in their prompt but no saved KV
+    state: sequences share one context, so the history is evaluated again. Each
+    sequence owns slot_ctx KV cells, so the oldest turns are left out when the
+    prompt plus max_tokens wouldn't fit in them.
     """
-    
-    def __init__(self, model_path=None, n_ctx=2048, n_threads=8, verbose=False):
+
+    def __init__(self, models, max_batch=8, max_wait=0.005, max_tokens=MAX_COMMAND_TOKENS, **kwargs):
         """
-        Initialize the ASH Model.
-        
+        Initialize the scheduler.
+
         Args:
-            model_path (str): Path to the model file. If None, uses default path.
-            n_ctx (int): Context window size (reduced for faster inference)
-            n_threads (int): Number of threads to use (increased for better performance)
-            verbose (bool): Whether to enable verbose output
+            models (list): Loaded ASHModel instances (one scheduler thread each)
+            max_batch (int): Maximum concurrent sequences per model
+            max_wait (float): Seconds an idle scheduler waits to fill a batch
+            max_tokens (int): Maximum generated tokens per request
+            **kwargs: Passed to WorkerPool (max_queue, response_cache, idle_unload, semantic_cache, sessions)
         """
-        self.model_path = model_path or get_model_path()
-        self.n_ctx = n_ctx
-        self.n_threads = n_threads
-        self.verbose = verbose
-        self.model = None
-        self.cli_tools_kb = CLI_TOOLS_KB
-        
-    def load(self):
-        """Load the model"""
-        if not LOCAL_MODEL_AVAILABLE:
-            raise Exception("llama-cpp-python not available. Install with: pip install llama-cpp-python")
-        
-        if not os.path.exists(self.model_path):
-            raise Exception(f"Model not found at: {self.model_path}")
-        
-        print(f'🤖 Loading local model: {self.model_path}')
-        start_time = time.time()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.decode_steps = 0
+        self.batched_tokens = 0
+        super().__init__(models, **kwargs)
+
+    def capacity(self):
+        """Number of sequences the scheduler decodes at once"""
+        return len(self.models) * self.max_batch
+
+    def _next_job(self, block, timeout=None):
+        """Next queued job, None when there is none; raises StopIteration on shutdown"""
         try:
-            self.model = Llama(
-                model_path=self.model_path,
-                n_ctx=self.n_ctx,
-                n_threads=self.n_threads,
-                verbose=self.verbose
-            )
-            end_time = time.time()
-            print(f"✅ Local model loaded successfully in {end_time - start_time:.2f} seconds!")
-            
-            # Warm up the model with a dummy inference to reduce first command latency
-            print("🔥 Warming up model...")
-            warmup_start = time.time()
+            _, _, job = self.queue.get(block=block, timeout=timeout)
+        except queue.Empty:
+            return None
+        if job is None:
+            raise StopIteration
+        return job
+
+    def _admit(self, decoder, model, job, slot):
+        if job.should_stop():
+            error = job.stop_error()
+            job.finish(error=error)
+            with self._lock:
+                self._count_stopped(error)
+            return None
+        job.started_at = time.time()
+        prepare_start = time.perf_counter()
+        try:
+            conversation = job.conversation
+            examples = conversation.examples if conversation is not None else None
+            if examples is None:
+                examples = model.retrieve_examples(job.query)
+            turns = list(conversation.turns) if conversation is not None else []
+            tokenize_start = time.perf_counter()
+            prompt_tokens = decoder.tokenize(model.build_prompt(job.query, turns, examples))
+            while turns and len(prompt_tokens) + self.max_tokens > decoder.slot_ctx:
+                # Forget the oldest turns rather than overflow into the next slot's cells
+                turns = turns[1:]
+                prompt_tokens = decoder.tokenize(model.build_prompt(job.query, turns, examples))
+            if len(prompt_tokens) + self.max_tokens > decoder.slot_ctx:
+                raise Exception(f"Prompt of {len(prompt_tokens)} tokens leaves no room for {self.max_tokens} "
+                                f"generated tokens in a {decoder.slot_ctx}-token slot")
+            shared = decoder.start(slot, prompt_tokens)
+            tokenize_time = time.perf_counter() - tokenize_start
+            if len(prompt_tokens) - shared > decoder.n_batch:
+                raise Exception("Prompt does not fit in one batch")
+        except Exception as e:
+            job.finish(error=e)
+            with self._lock:
+                self.failed += 1
+            return None
+        with self._lock:
+            self.busy += 1
+        sequence = _BatchSequence(job, slot, prompt_tokens, shared)
+        sequence.prepare_time = tokenize_start - prepare_start
+        sequence.tokenize_time = tokenize_time
+        sequence.examples = examples
+        return sequence
+
+    def _retire(self, decoder, sequence, error=None):
+        decoder.release(sequence.slot)
+        job = sequence.job
+        service_time = time.time() - job.started_at
+        if error is None and job.should_stop():
+            error = job.stop_error()
+        if error is None:
+            command = first_line(sequence.text.decode('utf-8', errors='ignore')).strip()
+            result = {
+                'command': command,
+                'cached': False,
+                'prompt_tokens': len(sequence.prompt_tokens),
+                'prompt_tokens_evaluated': sequence.prompt_evaluated,
+                'completion_tokens': len(sequence.tokens),
+                'queue_wait': job.started_at - job.enqueued_at,
+                'started_at': job.started_at,
+                'timings': sequence.timings(),
+            }
+            if job.conversation is not None:
+                result['examples'] = sequence.examples
+            self._observe(result)
+            job.finish(result=result)
+        else:
+            job.finish(error=error)
+        with self._lock:
+            self.busy -= 1
+            if error is None:
+                self.completed += 1
+                self._service_time_avg = 0.8 * self._service_time_avg + 0.2 * service_time
+            else:
+                self._count_stopped(error)
+
+    def _worker(self, model):
+        decoder = None
+        if self._load(model):
             try:
-                self.model("User: test\nCommand:", max_tokens=10, temperature=0.0)
-                warmup_end = time.time()
-                print(f"✅ Model warmed up in {warmup_end - warmup_start:.2f} seconds!")
+                decoder = BatchDecoder(model, self.max_batch)
             except Exception as e:
-                print(f"⚠️  Warm-up failed (non-critical): {e}")
-            
-            return self.model
-        except Exception as e:
-            raise Exception(f"Failed to load model: {e}")
-    
-    def is_loaded(self):
-        """Check if the model is loaded"""
-        return self.model is not None
-    
-    def generate_command(self, query):
+                print(f"⚠️  Continuous batching unavailable, serving requests one at a time: {e}")
+                return super()._worker(model)
+        active = {}  # slot -> _BatchSequence
+        stopping = False
+        try:
+            while not stopping or active:
+                free_slots = [slot for slot in range(self.max_batch) if slot not in active]
+                try:
+                    if not active and not stopping:
+                        # Idle: block for work, then briefly wait for more to batch with
+                        first = self._next_job(block=True, timeout=(self.idle_unload or None) if decoder else None)
+                        if first is None:
+                            # Nobody needed this worker for a while, give its memory back
+                            decoder.close()
+                            decoder = None
+                            model.unload()
+                            continue
+                        if decoder is None:
+                            try:
+                                model.ensure_loaded()
+                                decoder = BatchDecoder(model, self.max_batch)
+                            except Exception as e:
+                                print(f"❌ {e}")
+                                first.finish(error=Exception(f"Model failed to load: {e}"))
+                                with self._lock:
+                                    self.failed += 1
+                                continue
+                        sequence = self._admit(decoder, model, first, free_slots.pop(0))
+                        if sequence:
+                            active[sequence.slot] = sequence
+                        deadline = time.time() + self.max_wait
+                        while free_slots and time.time() < deadline:
+                            job = self._next_job(block=True, timeout=max(deadline - time.time(), 0))
+                            if job is None:
+                                break
+                            sequence = self._admit(decoder, model, job, free_slots.pop(0))
+                            if sequence:
+                                active[sequence.slot] = sequence
+                    elif not stopping:
+                        # Running: admit whatever is already queued between decode steps
+                        while free_slots:
+                            job = self._next_job(block=False)
+                            if job is None:
+                                break
+                            sequence = self._admit(decoder, model, job, free_slots.pop(0))
+                            if sequence:
+                                active[sequence.slot] = sequence
+                except StopIteration:
+                    stopping = True
+                if not active:
+                    continue
+
+                try:
+                    stepped = decoder.step(list(active.values()))
+                except Exception as e:
+                    for sequence in list(active.values()):
+                        self._retire(decoder, sequence, error=Exception(f"Model generation error: {e}"))
+                    active.clear()
+                    continue
+                with self._lock:
+                    self.decode_steps += 1
+                    self.batched_tokens += len(stepped)
+                stepped_at = time.perf_counter()
+                for sequence in stepped:
+                    if sequence.first_token_at is None:
+                        sequence.first_token_at = stepped_at
+                    token = sequence.tokens[-1]
+                    done = token in decoder.eog_tokens or len(sequence.tokens) >= self.max_tokens
+                    if token not in decoder.eog_tokens:
+                        sequence.text += decoder.llm.detokenize([token])
+                        if sequence.job.tokens is not None:
+                            delta = first_line(sequence.text.decode('utf-8', errors='ignore'))[sequence.sent:]
+                            if delta:
+                                sequence.job.on_token(delta)
+                                sequence.sent += len(delta)
+                        # Only the first line is kept, so stop at a newline after some text
+                        done = done or b"\n" in sequence.text.lstrip()
+                    done = done or sequence.job.should_stop()
+                    if done:
+                        del active[sequence.slot]
+                        self._retire(decoder, sequence)
+        finally:
+            if decoder is not None:
+                decoder.close()
+
+    def stats(self):
+        """Return scheduler counters"""
+        stats = super().stats()
+        with self._lock:
+            stats["max_batch"] = self.max_batch
+            stats["decode_steps"] = self.decode_steps
+            stats["avg_batch_size"] = round(self.batched_tokens / self.decode_steps, 2) if self.decode_steps else 0.0
+        return stats
+
+class UnknownModelError(LookupError):
+    """Raised when a model to switch to is neither in the models directory nor a GGUF path"""
+
+class ModelSwitchInProgress(Exception):
+    """Raised when a switch is requested while another one is still loading"""
+
+class ModelRegistry:
+    """
+    The GGUF models under models_dir, and the pool serving the active one.
+
+    switch() builds a pool for another model in the background while the current
+    pool keeps serving. Once every new worker has its model loaded and warmed up,
+    self.pool is swapped in one assignment, so requests from then on use the new
+    model, and the old pool is retired: what it already queued or is running
+    finishes, anything submitted to it late is forwarded, and its models are
+    unloaded only once its workers have drained.
+    """
+
+    def __init__(self, pool_factory, model_path, models_dir=DEFAULT_MODELS_DIR):
         """
-        Generate a command from a natural language query.
-        
+        Initialize the registry and the pool of the starting model.
+
         Args:
-            query (str): Natural language query
-            
-        Returns:
-            str: Generated command
+            pool_factory (callable): Builds the WorkerPool serving a model path
+            model_path (str): Model served at start
+            models_dir (str): Directory scanned for GGUFs
         """
-        if not self.is_loaded():
-            raise Exception("Model is not loaded. Call load() first.")
-        
-        # Build the prompt - keeping it short to fit within context window
-        prompt = f"""You translate natural language to terminal commands. Return only the command, no explanations.
+        self.pool_factory = pool_factory
+        self.models_dir = models_dir
+        self.model_path = model_path
+        self.pool = pool_factory(model_path)
+        self.switching = None  # Path of the model being loaded
+        self.last_switch = None
+        self.switches = 0
+        self._lock = threading.Lock()
 
-Examples:
-User: Show hidden files
-Command: ls -a
+    def available(self):
+        """The GGUFs under models_dir, plus the active model wherever it is"""
+        try:
+            names = sorted(name for name in os.listdir(self.models_dir) if name.endswith('.gguf'))
+        except OSError:
+            names = []
+        paths = [os.path.join(self.models_dir, name) for name in names]
+        active = os.path.abspath(self.model_path)
+        if active not in [os.path.abspath(path) for path in paths]:
+            paths.insert(0, self.model_path)
+        models = []
+        for path in paths:
+            try:
+                size_gb = round(os.path.getsize(path) / (1024**3), 3)
+            except OSError:
+                size_gb = None
+            models.append({
+                "name": os.path.basename(path),
+                "path": path,
+                "size_gb": size_gb,
+                "active": os.path.abspath(path) == active,
+                "loading": self.switching is not None and os.path.abspath(path) == os.path.abspath(self.switching),
+            })
+        return models
 
-User: Find .txt files
-Command: find . -name "*.txt"
+    def resolve(self, model):
+        """Path of model, given as a file name under models_dir (.gguf optional) or a GGUF path"""
+        candidates = [os.path.join(self.models_dir, model), os.path.join(self.models_dir, model + '.gguf')]
+        if os.path.isabs(model) and model.endswith('.gguf'):
+            candidates.insert(0, model)
+        for path in candidates:
+            if os.path.isfile(path):
+                return path
+        raise UnknownModelError(f"No model {model} in {self.models_dir}")
 
-User: {query}
-Command:"""
+    def switch(self, model):
+        """
+        Start switching to model in the background.
+
+        Returns:
+            str: 'active' when it already is the active model, otherwise 'loading'
+
+        Raises:
+            UnknownModelError: model doesn't exist
+            ModelSwitchInProgress: another switch hasn't finished loading
+        """
+        path = self.resolve(model)
+        with self._lock:
+            if self.switching is not None:
+                raise ModelSwitchInProgress(f"Already switching to {os.path.basename(self.switching)}")
+            if os.path.abspath(path) == os.path.abspath(self.model_path):
+                return 'active'
+            self.switching = path
+        threading.Thread(target=self._switch, args=(path,), name="ash-model-switch", daemon=True).start()
+        return 'loading'
+
+    def _switch(self, path):
+        name = os.path.basename(path)
+        print(f"🔀 Loading {name} while {os.path.basename(self.model_path)} keeps serving")
+        start_time = time.time()
         try:
-            response = self.model(
-                prompt,
-                max_tokens=100,
-                temperature=0.0,
-                stop=["\n\n", "User:", "Command:"]
-            )
-            response_text = response['choices'][0]['text'].strip()
-            # Only take the first line (in case model outputs extra text)
-            response_text = response_text.split('\n')[0]
-            return response_text
+            pool = self.pool_factory(path)
+            # The workers load their models in the background
+            while any(model.state in ("unloaded", "loading", "warming") for model in pool.models):
+                time.sleep(0.05)
+            if not any(model.state == "ready" for model in pool.models):
+                pool.retire(None)
+                raise Exception(pool.models[0].load_error if pool.models else "no workers")
         except Exception as e:
-            raise Exception(f"Model generation error: {e}")
-    
-    def get_model_info(self):
-        """Get information about the loaded model"""
-        if not self.is_loaded():
-            return {"status": "not_loaded"}
-        
-        return {
-            "status": "loaded",
-            "model_path": self.model_path,
-            "model_size_gb": os.path.getsize(self.model_path) / (1024**3),
-            "n_ctx": self.n_ctx,
-            "n_threads": self.n_threads,
-            "kb_entries": len(self.cli_tools_kb)
-        }
+            print(f"❌ Switching to {name} failed, still serving {os.path.basename(self.model_path)}: {e}")
+            with self._lock:
+                self.switching = None
+                self.last_switch = {"model": name, "status": "failed", "error": str(e)}
+            return
+        load_time = time.time() - start_time
+        with self._lock:
+            old = self.pool
+            self.pool = pool
+            self.model_path = path
+            self.switching = None
+            self.switches += 1
+        print(f"🔀 Now serving {name} (loaded in {load_time:.2f} seconds), draining the previous model")
+        drain_start = time.time()
+        old.retire(pool)
+        drain_time = time.time() - drain_start
+        print(f"✅ Previous model drained and unloaded in {drain_time:.2f} seconds")
+        with self._lock:
+            self.last_switch = {"model": name, "status": "done", "load_time": round(load_time, 3),
+                                "drain_time": round(drain_time, 3), "finished_at": time.time()}
+
+    def stats(self):
+        """Active model, switch in progress and the outcome of the last switch"""
+        with self._lock:
+            return {
+                "active": os.path.basename(self.model_path),
+                "models_dir": self.models_dir,
+                "switching": os.path.basename(self.switching) if self.switching else None,
+                "switches": self.switches,
+                "last_switch": self.last_switch,
+            }
 
 class ModelHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, ash_model=None, **kwargs):
-        self.ash_model = ash_model
+    # Keep-alive, so long-lived clients reuse one connection
+    protocol_version = "HTTP/1.1"
+    
+    def setup(self):
+        super().setup()
+        # Headers and body are separate writes; without TCP_NODELAY a keep-alive
+        # client waits out Nagle + delayed ACK (~40ms) on every response
+        if self.connection.family in (socket.AF_INET, socket.AF_INET6):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+    
+    def __init__(self, *args, pool=None, resolver=None, registry=None, **kwargs):
+        self._pool = pool
+        self.resolver = resolver
+        self.registry = registry
         super().__init__(*args, **kwargs)
     
+    @property
+    def pool(self):
+        """Pool of the active model, looked up per request so a model switch takes effect at once"""
+        return self.registry.pool if self.registry is not None else self._pool
+    
+    def send_json(self, status, payload, headers=None):
+        """Send a JSON response"""
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    @staticmethod
+    def source_of(result):
+        """Where a pool result's answer came from, as reported to clients and in metrics"""
+        if 'similarity' in result:
+            return 'semantic_cache'
+        if result['cached']:
+            return 'cache'
+        return 'prefetch' if result.get('prefetched') else 'model'
+    
+    def trace_id(self):
+        """Trace id of this request: the client's X-Ash-Trace, a new one with --trace, else None"""
+        trace_id = self.headers.get('X-Ash-Trace')
+        if trace_id and TRACE_ID_PATTERN.fullmatch(trace_id):
+            return trace_id
+        return TRACES.new_id() if TRACES.trace_all else None
+    
+    def record_trace(self, trace_id, query, source, request_start, request_end, serialize_time, result=None, **attrs):
+        """Write the spans of a traced request: the whole request, its generation stages and serialization"""
+        spans = [TRACES.span(trace_id, 'server.request', request_start, request_end - request_start,
+                             query=query, source=source, **attrs)]
+        if result is not None:
+            spans += TRACES.generation_spans(trace_id, result)
+        spans.append(TRACES.span(trace_id, 'server.serialize', request_end - serialize_time, serialize_time))
+        TRACES.write(spans)
+    
+    def client_disconnected(self):
+        """Whether the client closed its end of the connection (it may have pipelined a request)"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and self.connection.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+    
     def do_GET(self):
         import time
         if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            model_info = self.ash_model.get_model_info() if self.ash_model else {"status": "no_model"}
-            response = {'status': 'healthy', 'model': MODEL_PATH, 'model_info': model_info}
-            self.wfile.write(json.dumps(response).encode())
+            model_info = self.pool.get_model_info() if self.pool else {"status": "no_model"}
+            model_path = self.registry.model_path if self.registry else MODEL_PATH
+            response = {'status': 'healthy', 'model': model_path, 'model_info': model_info}
+            if self.pool:
+                # loading / warming / ready / unloaded / failed, with load progress
+                response.update(self.pool.readiness())
+            if self.resolver:
+                response['fast_path'] = self.resolver.stats()
+            self.send_json(200, response)
             return
         
         if self.path == '/shutdown':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            response = {'status': 'shutting down'}
-            self.wfile.write(json.dumps(response).encode())
-            # Shutdown the server in a new thread to avoid blocking
-            threading.Thread(target=self.server.shutdown).start()
+            self.send_json(200, {'status': 'shutting down'})
+            # Shutdown the server (and its other listeners) in a new thread to avoid blocking
+            threading.Thread(target=getattr(self.server, 'stop_all', self.server.shutdown)).start()
+            return
+        
+        if urlparse(self.path).path == '/prefetch':
+            self.send_json(405, {'error': 'Use POST /prefetch'}, headers={'Allow': 'POST'})
+            return
+        
+        if self.path == '/models':
+            if self.registry is None:
+                self.send_json(404, {'error': 'No model registry'})
+                return
+            self.send_json(200, dict(self.registry.stats(), models=self.registry.available()))
             return
         
         if self.path.startswith('/generate'):
@@ -219,71 +3627,804 @@ class ModelHandler(BaseHTTPRequestHandler):
             query = params.get('q', [''])[0]
             
             if not query:
-                self.send_response(400)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                response = {'error': 'Missing query parameter "q"'}
-                self.wfile.write(json.dumps(response).encode())
+                self.send_json(400, {'error': 'Missing query parameter "q"'})
                 return
+            options = self.generation_options(params)
+            if options is None:
+                return
+            use_cache, use_fast_path, timeout = options
+            # Conversation the query continues, so follow-ups keep their context
+            session = params.get('session', [''])[0] or None
+            trace_id = self.trace_id()
             
+            METRICS.inc('in_flight_requests')
+            request_start = time.perf_counter()
+            source = None
             try:
-                request_start = time.time()
-                # Generate response
-                inference_start = time.time()
-                response_text = self.ash_model.generate_command(query)
-                inference_end = time.time()
-                # Send response
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                response = {'command': response_text}
-                self.wfile.write(json.dumps(response).encode())
-                request_end = time.time()
-                print(f"[ash-server] Inference time: {inference_end - inference_start:.2f}s | Total request time: {request_end - request_start:.2f}s")
-                
-            except Exception as e:
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                response = {'error': str(e)}
-                self.wfile.write(json.dumps(response).encode())
+                if parsed_url.path == '/generate/stream':
+                    source = self.handle_stream(query, use_cache, use_fast_path, timeout, session, trace_id)
+                else:
+                    source = self.handle_generate(query, use_cache, use_fast_path, timeout, session, trace_id)
+            finally:
+                request_time = time.perf_counter() - request_start
+                if source is None and trace_id:
+                    # Successful requests were traced by their handler
+                    TRACES.write([TRACES.span(trace_id, 'server.request', time.time() - request_time, request_time,
+                                              query=query, source='error')])
+                source = source or 'error'
+                METRICS.inc('in_flight_requests', -1)
+                METRICS.inc('requests', label=source)
+                METRICS.observe('request', request_time, label=source)
+        elif self.path == '/metrics':
+            self.send_metrics()
         else:
             self.send_response(404)
+            self.send_header('Content-Length', '0')
             self.end_headers()
     
+    def do_POST(self):
+        parsed_url = urlparse(self.path)
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self.send_json(411, {'error': 'Content-Length required'})
+            self.close_connection = True
+            return
+        body = self.rfile.read(length)
+        
+        if parsed_url.path == '/generate/batch':
+            self.handle_batch(body, parse_qs(parsed_url.query))
+        elif parsed_url.path == '/models/switch' and self.registry is not None:
+            self.handle_switch(body)
+        elif parsed_url.path == '/prefetch':
+            self.handle_prefetch(body)
+        else:
+            self.send_json(404, {'error': f'Unknown endpoint {parsed_url.path}'})
+    
+    def handle_switch(self, body):
+        """
+        Answer POST /models/switch ({"model": name}): 202 while the model loads in
+        the background (GET /models shows when it took over), 200 if already active.
+        """
+        try:
+            model = json.loads(body).get('model')
+        except (ValueError, AttributeError):
+            model = None
+        if not isinstance(model, str) or not model:
+            self.send_json(400, {'error': 'Body must be {"model": "<name or path>"}'})
+            return
+        try:
+            status = self.registry.switch(model)
+        except UnknownModelError as e:
+            self.send_json(404, {'error': str(e)})
+            return
+        except ModelSwitchInProgress as e:
+            self.send_json(409, {'error': str(e)})
+            return
+        self.send_json(202 if status == 'loading' else 200, {'status': status, 'model': model})
+    
+    def generation_options(self, params):
+        """
+        Parse the cache, fast_path and timeout parameters of a generation request.
+        
+        Returns:
+            tuple: (use_cache, use_fast_path, timeout), or None after answering 400
+        """
+        use_cache = params.get('cache', ['1'])[0].lower() not in ('0', 'false', 'no', 'off')
+        use_fast_path = params.get('fast_path', ['1'])[0].lower() not in ('0', 'false', 'no', 'off')
+        # Per-request deadline in seconds, capped at REQUEST_TIMEOUT
+        try:
+            timeout = min(float(params.get('timeout', [REQUEST_TIMEOUT])[0]), REQUEST_TIMEOUT)
+        except ValueError:
+            timeout = 0
+        if not timeout > 0:
+            self.send_json(400, {'error': 'Invalid "timeout", expected seconds > 0'})
+            return None
+        return use_cache, use_fast_path, timeout
+    
+    def handle_batch(self, body, params):
+        """
+        Answer POST /generate/batch: a JSON array of queries (or {"queries": [...]})
+        translated in order. Each result has the command and its source, or its own
+        error and HTTP status, so one failed query does not fail the batch.
+        """
+        try:
+            queries = json.loads(body)
+        except ValueError:
+            self.send_json(400, {'error': 'Body must be a JSON array of queries'})
+            return
+        if isinstance(queries, dict):
+            queries = queries.get('queries')
+        if not isinstance(queries, list) or not all(isinstance(q, str) and q for q in queries):
+            self.send_json(400, {'error': 'Body must be a JSON array of non-empty query strings'})
+            return
+        if len(queries) > MAX_BATCH_QUERIES:
+            self.send_json(413, {'error': f'At most {MAX_BATCH_QUERIES} queries per batch'})
+            return
+        options = self.generation_options(params)
+        if options is None:
+            return
+        use_cache, use_fast_path, timeout = options
+        
+        METRICS.inc('in_flight_requests')
+        request_start = time.time()
+        items = [None] * len(queries)
+        try:
+            # Answer high-confidence queries without the model
+            to_generate = []
+            for i, query in enumerate(queries):
+                resolved = self.resolver.resolve(query) if self.resolver and use_fast_path else None
+                if resolved:
+                    items[i] = {'command': resolved['command'], 'cached': False, 'source': 'fast_path'}
+                else:
+                    to_generate.append(i)
+            
+            if to_generate:
+                try:
+                    results = self.pool.generate_batch([queries[i] for i in to_generate], use_cache=use_cache,
+                                                       timeout=timeout, is_disconnected=self.client_disconnected)
+                except ClientDisconnected:
+                    self.close_connection = True
+                    return
+                for i, result in zip(to_generate, results):
+                    if isinstance(result, ServerBusyError):
+                        items[i] = {'error': str(result), 'status': 503, 'retry_after': result.retry_after}
+                    elif isinstance(result, TimeoutError):
+                        items[i] = {'error': str(result), 'status': 504}
+                    elif isinstance(result, Exception):
+                        items[i] = {'error': str(result), 'status': 500}
+                    else:
+                        source = self.source_of(result)
+                        items[i] = {'command': result['command'], 'cached': result['cached'], 'source': source}
+            
+            serialize_start = time.perf_counter()
+            self.send_json(200, {'results': items})
+            METRICS.observe('serialize', time.perf_counter() - serialize_start)
+            failed = sum(1 for item in items if 'error' in item)
+            print(f"[ash-server] Batch of {len(queries)} ({len(to_generate)} generated, {failed} failed) | Total request time: {time.time() - request_start:.6f}s")
+        finally:
+            METRICS.inc('in_flight_requests', -1)
+            for item in items:
+                METRICS.inc('requests', label=item.get('source', 'error') if item else 'error')
+    
+    def resolve_fast_path(self, query, use_fast_path, session):
+        """
+        Fast path answer for query, or None. Follow-ups in a session always go to
+        the model; a first turn answered here still starts the session's history.
+        """
+        if not self.resolver or not use_fast_path or self.pool.continues_session(session):
+            return None
+        resolved = self.resolver.resolve(query)
+        if resolved and session is not None:
+            resolved = self.pool.record_turn(session, query, resolved)
+        return resolved
+    
+    def handle_generate(self, query, use_cache, use_fast_path, timeout, session=None, trace_id=None):
+        """Answer /generate; returns the answer's source, or None when it failed"""
+        try:
+            request_start = time.time()
+            # Answer high-confidence queries without the model
+            resolved = self.resolve_fast_path(query, use_fast_path, session)
+            if resolved:
+                payload = {
+                    'command': resolved['command'],
+                    'cached': False,
+                    'source': 'fast_path',
+                    'confidence': round(resolved['confidence'], 3)
+                }
+                if 'turn' in resolved:
+                    payload.update(session=session, turn=resolved['turn'])
+                serialize_start = time.perf_counter()
+                self.send_json(200, payload)
+                serialize_time = time.perf_counter() - serialize_start
+                METRICS.observe('serialize', serialize_time)
+                request_end = time.time()
+                if trace_id:
+                    self.record_trace(trace_id, query, 'fast_path', request_start, request_end, serialize_time,
+                                      confidence=payload['confidence'])
+                print(f"[ash-server] Fast path (confidence {resolved['confidence']:.2f}) | Total request time: {request_end - request_start:.6f}s")
+                return 'fast_path'
+            
+            # Generate response
+            inference_start = time.time()
+            result = self.pool.generate(query, use_cache=use_cache, timeout=timeout,
+                                        is_disconnected=self.client_disconnected, session=session)
+            inference_end = time.time()
+            # Send response
+            source = self.source_of(result)
+            payload = {'command': result['command'], 'cached': result['cached'], 'source': source}
+            if 'similarity' in result:
+                payload['similar_query'] = result['similar_query']
+                payload['similarity'] = round(result['similarity'], 3)
+            if 'turn' in result:
+                payload.update(session=session, turn=result['turn'])
+            serialize_start = time.perf_counter()
+            self.send_json(200, payload)
+            serialize_time = time.perf_counter() - serialize_start
+            METRICS.observe('serialize', serialize_time)
+            request_end = time.time()
+            if trace_id:
+                self.record_trace(trace_id, query, source, request_start, request_end, serialize_time, result)
+            detail = source
+            if source == 'model':
+                detail = f"model, queue wait: {result['queue_wait']:.3f}s, prompt tokens: {result['prompt_tokens']}, evaluated: {result['prompt_tokens_evaluated']}"
+            print(f"[ash-server] Inference time ({detail}): {inference_end - inference_start:.6f}s | Total request time: {request_end - request_start:.6f}s")
+            return source
+            
+        except ServerBusyError as e:
+            self.send_json(503, {'error': str(e), 'retry_after': e.retry_after},
+                           headers={'Retry-After': str(e.retry_after)})
+        except ClientDisconnected:
+            # Nobody to answer; the generation was abandoned
+            self.close_connection = True
+        except TimeoutError as e:
+            self.send_json(504, {'error': str(e)})
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+        return None
+    
+    def send_metrics(self):
+        """Prometheus text exposition of METRICS plus gauges sampled now"""
+        gauges = [('process_resident_memory_bytes', "Resident memory of the server process", process_rss_bytes())]
+        counters = []
+        if self.pool:
+            stats = self.pool.stats()
+            gauges += [
+                ('queued_requests', "Generations waiting for a worker", stats['queued']),
+                ('busy_workers', "Generations being decoded", stats['busy']),
+                ('model_ready', "1 when a model is loaded and warmed up", int(self.pool.readiness()['state'] == 'ready')),
+            ]
+            counters += [
+                ('rejected_requests', "Requests answered 503 because the queue was full", stats['rejected']),
+                ('cancelled_generations', "Generations cancelled (client went away or superseded prefetch)", stats['cancelled']),
+                ('expired_generations', "Generations abandoned at their deadline", stats['expired']),
+                ('failed_generations', "Generations that raised an error", stats['failed']),
+            ]
+            drafts = [model.draft for model in self.pool.models if model.draft is not None]
+            if drafts:
+                counters += [
+                    ('draft_tokens', "Drafted tokens verified by the main model (speculative decoding)",
+                     sum(draft.verified for draft in drafts)),
+                    ('draft_tokens_accepted', "Drafted tokens the main model accepted",
+                     sum(draft.accepted for draft in drafts)),
+                ]
+            if self.pool.response_cache is not None:
+                gauges.append(('cache_hit_ratio', "Response cache hits per lookup",
+                               round(self.pool.response_cache.stats()['hit_rate'], 6)))
+            if self.pool.semantic_cache is not None:
+                semantic = self.pool.semantic_cache.stats()
+                gauges += [
+                    ('semantic_cache_hit_ratio', "Semantic cache hits per lookup", round(semantic['hit_rate'], 6)),
+                    ('semantic_cache_entries', "Queries in the semantic cache index", semantic['entries']),
+                ]
+            if self.pool.sessions is not None:
+                sessions = self.pool.sessions.stats()
+                gauges += [
+                    ('sessions', "Conversations with history kept", sessions['sessions']),
+                    ('session_state_bytes', "Bytes of session KV state held in memory", sessions['memory_bytes']),
+                ]
+                counters.append(('session_states_spilled', "Session KV states moved to disk", sessions['spills']))
+        if self.registry:
+            counters.append(('model_switches', "Completed switches to another model", self.registry.switches))
+        if self.resolver:
+            gauges.append(('fast_path_hit_ratio', "Queries answered by the fast path per lookup",
+                           round(self.resolver.stats()['hit_rate'], 6)))
+        body = METRICS.render(gauges, counters).encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def handle_prefetch(self, body):
+        """
+        Answer POST /prefetch ({"q": query, "session": id}): start generating a
+        partially typed query in the background so the answer is ready (or already
+        running) when the user presses Enter. Never waits for the model. A newer
+        prefetch supersedes the session's previous one, so each client needs its own id.
+        """
+        try:
+            request = json.loads(body)
+            query, session = request.get('q'), request.get('session')
+        except (ValueError, AttributeError):
+            query = session = None
+        if not isinstance(query, str) or not query or not isinstance(session, str) or not session:
+            self.send_json(400, {'error': 'Body must be {"q": "<query>", "session": "<id>"}'})
+            return
+        if self.resolver and self.resolver.resolve(query):
+            # The fast path answers this instantly anyway
+            status = 'ready'
+        else:
+            status = self.pool.prefetch(query, session)
+        self.send_json(202 if status in ('queued', 'pending') else 200, {'status': status})
+    
+    def send_event(self, data, event=None):
+        """Write one server-sent event"""
+        frame = f"event: {event}\n" if event else ""
+        frame += f"data: {json.dumps(data)}\n\n"
+        self.wfile.write(frame.encode())
+        self.wfile.flush()
+    
+    def handle_stream(self, query, use_cache, use_fast_path, timeout=REQUEST_TIMEOUT, session=None, trace_id=None):
+        """
+        Stream a generation as server-sent events: one {"token": ...} event per
+        generated piece, then a "done" event with the command, source and timings
+        (or an "error" event). Returns the answer's source, or None when it failed.
+        """
+        request_start = time.time()
+        first_token_at = None
+        result = None
+        stream = None
+        pending = []
+        try:
+            resolved = self.resolve_fast_path(query, use_fast_path, session)
+            if resolved:
+                pending.append(resolved['command'])
+                result = {'command': resolved['command'], 'cached': False, 'turn': resolved.get('turn')}
+            else:
+                stream = self.pool.generate_stream(query, use_cache=use_cache, timeout=timeout,
+                                                   is_disconnected=self.client_disconnected, session=session)
+                # Wait for the first piece before committing to a 200 so a full queue still gets a 503
+                try:
+                    pending.append(next(stream))
+                except StopIteration as e:
+                    result = e.value
+                    stream = None
+            first_token_at = time.time()
+        except ServerBusyError as e:
+            self.send_json(503, {'error': str(e), 'retry_after': e.retry_after},
+                           headers={'Retry-After': str(e.retry_after)})
+            return None
+        except ClientDisconnected:
+            self.close_connection = True
+            return None
+        except TimeoutError as e:
+            self.send_json(504, {'error': str(e)})
+            return None
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return None
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        # The stream has no length, so it ends when the connection closes
+        self.send_header('Connection', 'close')
+        self.close_connection = True
+        self.end_headers()
+        serialize_time = 0.0
+        try:
+            try:
+                for piece in pending:
+                    self.send_event({'token': piece})
+                while stream is not None:
+                    try:
+                        piece = next(stream)
+                    except StopIteration as e:
+                        result = e.value
+                        break
+                    write_start = time.perf_counter()
+                    self.send_event({'token': piece})
+                    serialize_time += time.perf_counter() - write_start
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                self.send_event({'error': str(e)}, event='error')
+                return None
+            
+            request_end = time.time()
+            source = 'fast_path' if resolved else self.source_of(result)
+            ttft = first_token_at - request_start
+            done = {
+                'command': result['command'],
+                'cached': result['cached'],
+                'source': source,
+                'time_to_first_token': round(ttft, 6),
+                'total_time': round(request_end - request_start, 6),
+                'completion_tokens': result.get('completion_tokens'),
+            }
+            if result.get('turn'):
+                done.update(session=session, turn=result['turn'])
+            write_start = time.perf_counter()
+            self.send_event(done, event='done')
+            serialize_time += time.perf_counter() - write_start
+            METRICS.observe('serialize', serialize_time)
+            if trace_id:
+                self.record_trace(trace_id, query, source, request_start, time.time(), serialize_time,
+                                  None if resolved else result, time_to_first_token=done['time_to_first_token'])
+            print(f"[ash-server] Streamed ({source}) | Time to first token: {ttft:.6f}s | Total request time: {request_end - request_start:.6f}s")
+            return source
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid-stream
+            return None
+        finally:
+            if stream is not None:
+                # Cancels the generation if it is still running
+                stream.close()
+    
     def log_message(self, format, *args):
         # Suppress HTTP server logs
         pass
 
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix domain socket, readable and writable by the owner only"""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        path = self.server_address
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                raise OSError(f"Another ash server is already listening on {path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Stale socket left behind by a server that didn't shut down cleanly
+                os.unlink(path)
+            finally:
+                probe.close()
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        old_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+# Saved by --autotune, read on later starts
+TUNING_PATH = os.path.join(ASH_HOME, 'tuning.json')
+
+# Fixed query set timed by --autotune (short and long prompts, copied and composed commands)
+AUTOTUNE_QUERIES = [
+    "list files sorted by size",
+    "find all python files modified in the last 2 days",
+    "show the 10 largest directories under /var/log",
+    "count lines in all .js files recursively excluding node_modules",
+    "compress the logs folder into logs.tar.gz",
+    "kill the process listening on port 3000",
+]
+
+def detect_hardware():
+    """
+    CPUs this process may use (affinity and cgroup quota), the physical cores
+    among them and the available RAM in bytes (None when unknown).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        # cgroup v2 CPU quota, e.g. "200000 100000" for two CPUs
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, -(-int(quota) // int(period))))
+    except (OSError, ValueError):
+        pass
+    
+    logical = os.cpu_count() or cpus
+    physical = None
+    try:
+        cores = set()
+        physical_id = None
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'physical id':
+                    physical_id = value.strip()
+                elif key == 'core id':
+                    cores.add((physical_id, value.strip()))
+        physical = len(cores) or None
+    except OSError:
+        pass
+    if physical is None and sys.platform == 'darwin':
+        import subprocess
+        try:
+            physical = int(subprocess.run(['sysctl', '-n', 'hw.physicalcpu'], capture_output=True,
+                                          text=True, check=True).stdout)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            pass
+    # Hyperthreads share a core's execution units, so count usable cores, not CPUs
+    threads_per_core = max(1, round(logical / physical)) if physical else 1
+    
+    memory = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    if memory is None and sys.platform == 'darwin':
+        import subprocess
+        try:
+            memory = int(subprocess.run(['sysctl', '-n', 'hw.memsize'], capture_output=True,
+                                        text=True, check=True).stdout)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            pass
+    return {
+        "cpus": cpus,
+        "physical_cores": max(1, cpus // threads_per_core),
+        "threads_per_core": threads_per_core,
+        "memory_available": memory,
+    }
+
+def default_threads():
+    """Thread count without a tuning profile: one per usable physical core"""
+    return detect_hardware()["physical_cores"]
+
+def load_tuning_profile(model_path, path=TUNING_PATH):
+    """
+    The --autotune profile for model_path, or None when there is none or it was
+    tuned for another model or CPU budget.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        fingerprint = file_fingerprint(model_path)[:16]
+    except OSError:
+        return None
+    if profile.get("model_fingerprint") != fingerprint:
+        print(f"⚠️  Ignoring {path}: tuned for another model (run ash-server --autotune again)")
+        return None
+    if profile.get("hardware", {}).get("cpus") != detect_hardware()["cpus"]:
+        print(f"⚠️  Ignoring {path}: tuned for a different number of CPUs (run ash-server --autotune again)")
+        return None
+    return profile
+
+def autotune(model_path=None, path=TUNING_PATH, repeats=2, retrieval_k=3):
+    """
+    Pick n_threads, n_batch and n_ctx for this machine and save them to path.
+    
+    n_ctx is sized to the longest prompt of AUTOTUNE_QUERIES plus the completion
+    and some headroom, instead of the 2048 default. n_threads is then timed over
+    the physical/logical core counts, and n_batch at the fastest thread count.
+    
+    Args:
+        model_path (str): Model to tune for. If None, uses default path.
+        path (str): Where to save the profile
+        repeats (int): Timed passes over AUTOTUNE_QUERIES per candidate
+        retrieval_k (int): Retrieval setting the server runs with (affects prompt length)
+        
+    Returns:
+        dict: The saved profile
+    """
+    model_path = model_path or get_model_path()
+    hardware = detect_hardware()
+    memory = f"{hardware['memory_available'] / 1024**3:.1f} GB" if hardware['memory_available'] else "unknown"
+    print(f"🔧 Hardware: {hardware['cpus']} CPUs, {hardware['physical_cores']} physical cores, {memory} RAM available")
+    model_size = os.path.getsize(model_path)
+    if hardware['memory_available'] and hardware['memory_available'] < model_size * 1.2:
+        print(f"⚠️  Only {memory} available for a {model_size / 1024**3:.1f} GB model, expect paging")
+    kb_index = KBIndex.load_or_build(CLI_TOOLS_KB) if retrieval_k > 0 and NUMPY_AVAILABLE else None
+    results = []
+    
+    def measure(n_threads, n_batch, n_ctx):
+        model = ASHModel(model_path=model_path, n_threads=n_threads, n_batch=n_batch, n_ctx=n_ctx,
+                         use_cache=False, kb_index=kb_index, retrieval_k=retrieval_k if kb_index else 0)
+        model.load()
+        try:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for query in AUTOTUNE_QUERIES:
+                    model.generate(query, use_cache=False)
+            latency = (time.perf_counter() - start) / (repeats * len(AUTOTUNE_QUERIES))
+        finally:
+            model.unload()
+        results.append({"n_threads": n_threads, "n_batch": n_batch, "n_ctx": n_ctx, "mean_latency": round(latency, 4)})
+        print(f"   n_threads={n_threads:<3} n_batch={n_batch:<4} n_ctx={n_ctx:<5} {latency * 1000:8.1f} ms/query")
+        return latency
+    
+    # Context: the longest prompt, 100 generated tokens and room for longer queries
+    sizing = ASHModel(model_path=model_path, n_ctx=2048, n_threads=hardware['physical_cores'],
+                      use_cache=False, kb_index=kb_index, retrieval_k=retrieval_k if kb_index else 0)
+    sizing.load()
+    try:
+        longest = max(sizing.count_tokens(sizing.build_prompt(query)) for query in AUTOTUNE_QUERIES)
+    finally:
+        sizing.unload()
+    n_ctx = min(2048, -(-(longest + 100 + 256) // 256) * 256)
+    print(f"🔧 Longest prompt is {longest} tokens, using n_ctx={n_ctx}")
+    
+    thread_candidates = sorted({max(1, hardware['physical_cores'] // 2), min(4, hardware['physical_cores']),
+                                hardware['physical_cores'], hardware['cpus']})
+    best_threads = min(thread_candidates, key=lambda n_threads: measure(n_threads, 512, n_ctx))
+    timings = {512: min(r["mean_latency"] for r in results if r["n_threads"] == best_threads)}
+    for n_batch in (64, 128, 256):
+        timings[n_batch] = measure(best_threads, n_batch, n_ctx)
+    best_batch = min(timings, key=timings.get)
+    
+    profile = {
+        "version": 1,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "model": os.path.basename(model_path),
+        "model_fingerprint": file_fingerprint(model_path)[:16],
+        "hardware": hardware,
+        "n_threads": best_threads,
+        "n_batch": best_batch,
+        "n_ctx": n_ctx,
+        "mean_latency": round(timings[best_batch], 4),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+    print(f"✅ Tuned: n_threads={best_threads}, n_batch={best_batch}, n_ctx={n_ctx} "
+          f"({timings[best_batch] * 1000:.1f} ms/query), saved to {path}")
+    return profile
+
 def load_model():
     """Load the model once (legacy function for backward compatibility)"""
     ash_model = ASHModel()
     ash_model.load()
     return ash_model.model
 
-def run_server(port=DEFAULT_PORT, model_path=None):
-    """Run the model server"""
-    ash_model = ASHModel(model_path=model_path)
-    ash_model.load()
+def run_server(port=DEFAULT_PORT, model_path=None, use_cache=True, cache_size=1024,
+               cache_ttl=7 * 24 * 3600, cache_path=DEFAULT_CACHE_PATH, retrieval_k=3,
+               example_token_budget=160, use_fast_path=True, fast_path_threshold=0.85,
+               rules_path=USER_RULES_PATH, workers=1, n_threads=8, n_ctx=2048, n_batch=512, max_queue=16,
+               max_batch=1, max_batch_wait=0.005, socket_path=None,
+               idle_unload=DEFAULT_IDLE_UNLOAD, use_mlock=False, prefault=True, constrained=False,
+               prompt_lookup=False, draft_model_path=None, draft_tokens=8, semantic_cache=False,
+               semantic_model_path=None, semantic_threshold=None, semantic_cache_size=100000,
+               session_memory=256, session_ttl=1800, models_dir=DEFAULT_MODELS_DIR, trace=False):
+    """Run the model server. It listens right away; the workers load the models in the background."""
+    resolved_model_path = model_path or get_model_path()
+    if trace:
+        TRACES.trace_all = True
+        print(f"🔍 Tracing every request to {TRACES.path}")
+    embedder = None
+    if use_cache and (semantic_cache or semantic_model_path):
+        if not NUMPY_AVAILABLE:
+            print("⚠️  NumPy not available, semantic cache disabled")
+        else:
+            embedder = HashingEmbedder()
+            if semantic_model_path:
+                try:
+                    embedder = GGUFEmbedder(semantic_model_path)
+                except Exception as e:
+                    print(f"⚠️  Embedding model unavailable, using hashed word features (non-critical): {e}")
+    kb_index = None
+    if retrieval_k > 0:
+        if NUMPY_AVAILABLE:
+            index_start = time.time()
+            kb_index = KBIndex.load_or_build(CLI_TOOLS_KB)
+            print(f"✅ KB index ready ({kb_index.n_docs} entries, {len(kb_index.vocab)} terms) in {time.time() - index_start:.3f} seconds")
+        else:
+            print("⚠️  NumPy not available, few-shot example retrieval disabled")
+    sessions = None
+    if session_memory > 0:
+        sessions = SessionStore(memory_budget=int(session_memory * 1024 * 1024), ttl=session_ttl)
+    # Split the thread budget between workers so they don't oversubscribe the CPU
+    threads_per_worker = max(1, n_threads // max(workers, 1))
+    
+    def create_pool(model_path):
+        """Workers and caches for model_path (caches are per model, sessions and the KB index shared)"""
+        response_cache = None
+        if use_cache:
+            response_cache = ResponseCache(
+                max_entries=cache_size,
+                ttl=cache_ttl,
+                persist_path=model_cache_path(cache_path, model_path) if cache_path else None,
+                namespace=os.path.basename(model_path)
+            )
+        semantic = None
+        if embedder is not None:
+            semantic = SemanticCache(
+                embedder,
+                threshold=semantic_threshold,
+                max_entries=semantic_cache_size,
+                persist_path=model_cache_path(DEFAULT_SEMANTIC_CACHE_PATH, model_path) if cache_path else None,
+                namespace=os.path.basename(model_path)
+            )
+            print(f"✅ Semantic cache ready ({embedder.name}, similarity >= {semantic.threshold})")
+        models = []
+        for i in range(max(workers, 1)):
+            ash_model = ASHModel(
+                model_path=model_path,
+                n_threads=threads_per_worker,
+                n_ctx=n_ctx,
+                n_batch=n_batch,
+                response_cache=None,
+                use_cache=False,
+                kb_index=kb_index,
+                retrieval_k=retrieval_k if kb_index else 0,
+                example_token_budget=example_token_budget,
+                use_mlock=use_mlock,
+                prefault=prefault,
+                constrained=constrained,
+                prompt_lookup=prompt_lookup,
+                draft_model_path=draft_model_path,
+                draft_tokens=draft_tokens
+            )
+            if workers > 1:
+                print(f"👷 Worker {i + 1}/{workers} ({threads_per_worker} threads)")
+            models.append(ash_model)
+        if max_batch > 1:
+            pool = BatchScheduler(models, max_batch=max_batch, max_wait=max_batch_wait,
+                                  max_queue=max_queue, response_cache=response_cache,
+                                  idle_unload=idle_unload, semantic_cache=semantic, sessions=sessions)
+            print(f"📦 Continuous batching: up to {max_batch} sequences per worker")
+            return pool
+        return WorkerPool(models, max_queue=max_queue, response_cache=response_cache,
+                          idle_unload=idle_unload, semantic_cache=semantic, sessions=sessions)
+    
+    registry = ModelRegistry(create_pool, resolved_model_path, models_dir=models_dir)
+    if sessions:
+        print(f"💬 Sessions keep up to {session_memory:g} MB of KV state in memory, the rest spills to {SESSION_STATE_DIR}")
+    if idle_unload:
+        print(f"💤 Models unload after {idle_unload:g}s idle and reload on the next request")
+    
+    resolver = None
+    if use_fast_path:
+        resolver = FastPathResolver.from_files(
+            [rules_path, FAST_PATH_RULES_PATH],
+            kb=CLI_TOOLS_KB,
+            threshold=fast_path_threshold
+        )
+        print(f"✅ Fast path ready ({len(resolver.phrases)} intent phrases, {len(resolver.patterns)} patterns)")
     
     # Create custom handler with model
     class HandlerWithModel(ModelHandler):
         def __init__(self, *args, **kwargs):
-            super().__init__(*args, ash_model=ash_model, **kwargs)
+            super().__init__(*args, resolver=resolver, registry=registry, **kwargs)
     
-    server = HTTPServer(('localhost', port), HandlerWithModel)
+    server = ThreadingHTTPServer(('localhost', port), HandlerWithModel)
+    servers = [server]
+    if socket_path:
+        unix_server = ThreadingUnixHTTPServer(socket_path, HandlerWithModel)
+        threading.Thread(target=unix_server.serve_forever, name="ash-unix-server", daemon=True).start()
+        servers.append(unix_server)
     
-    print(f"🚀 ash Model Server running on http://localhost:{port}")
+    def stop_all():
+        for listener in servers:
+            listener.shutdown()
+    for listener in servers:
+        listener.stop_all = stop_all
+    
+    print(f"🚀 ash Model Server running on http://localhost:{port} (model loading in the background)")
+    if socket_path:
+        print(f"🔌 Also listening on unix socket {socket_path}")
     print("📝 Endpoints:")
-    print(f"   GET /health - Check server status")
-    print(f"   GET /generate?q=<query> - Generate command")
+    print("   GET /health - Check server status and model readiness (loading/warming/ready)")
+    print("   GET /generate?q=<query>[&cache=0][&fast_path=0][&timeout=<seconds>][&session=<id>] - Generate command")
+    print("   GET /generate/stream?q=<query> - Stream the command as server-sent events")
+    print("   POST /generate/batch - Generate commands for a JSON array of queries, in order")
+    print("   POST /prefetch - Start generating a partially typed query for a session in the background")
+    print(f"   GET /models - Models under {models_dir} and the active one")
+    print("   POST /models/switch - Load another model in the background and switch to it")
+    print("   GET /metrics - Prometheus metrics (latency histograms per stage, queue depth, memory)")
     print("🛑 Press Ctrl+C to stop the server")
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\n🛑 Shutting down server...")
-        server.shutdown()
+    finally:
+        for listener in servers:
+            listener.server_close()
+        pool = registry.pool
+        pool.shutdown()
+        if pool.response_cache:
+            pool.response_cache.save()
+        if pool.semantic_cache:
+            pool.semantic_cache.save()
+        if sessions:
+            sessions.close()
 
 def main():
     import sys
@@ -296,6 +4437,77 @@ def main():
                        help='Path to the local model file (.gguf)')
     parser.add_argument('--stop', action='store_true',
                        help='Request the server to shut down')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Disable the response cache')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                       help='Maximum number of cached responses (default: 1024)')
+    parser.add_argument('--cache-ttl', type=float, default=7 * 24 * 3600,
+                       help='Seconds before a cached response expires, 0 for never (default: 7 days)')
+    parser.add_argument('--cache-path', type=str, default=DEFAULT_CACHE_PATH,
+                       help=f'File to persist the response cache to (suffixed per model), empty to keep it in memory (default: {DEFAULT_CACHE_PATH})')
+    parser.add_argument('--semantic-cache', action='store_true',
+                       help='Also answer queries similar to previously answered ones from cache '
+                            '(by shared words only, unless --semantic-cache-model gives an embedding model)')
+    parser.add_argument('--semantic-cache-model', type=str, default=None, metavar='PATH',
+                       help='GGUF embedding model for the semantic cache (implies --semantic-cache; '
+                            'default: hashed word features, which match wording, not meaning)')
+    parser.add_argument('--semantic-threshold', type=float, default=None,
+                       help='Minimum cosine similarity for a semantic cache hit (default: 0.9 with a model, 0.8 without)')
+    parser.add_argument('--semantic-cache-size', type=int, default=100000,
+                       help='Maximum number of queries in the semantic cache (default: 100000)')
+    parser.add_argument('--session-memory', type=float, default=256, metavar='MB',
+                       help='Memory for the KV state of sessions (/generate?session=<id>) before it spills '
+                            'to disk, 0 to ignore session ids (default: 256)')
+    parser.add_argument('--session-ttl', type=float, default=1800, metavar='SECONDS',
+                       help='Forget sessions idle this long, 0 to keep them (default: 1800)')
+    parser.add_argument('--models-dir', type=str, default=DEFAULT_MODELS_DIR, metavar='DIR',
+                       help=f'Directory of GGUFs listed by /models and switchable at runtime (default: {DEFAULT_MODELS_DIR})')
+    parser.add_argument('--trace', action='store_true',
+                       help=f'Record spans of every request to {TRACE_PATH}, not only of those sent with an '
+                            'X-Ash-Trace id (ASH_TRACE=1 in the shell); see scripts/ash_trace.py')
+    parser.add_argument('--retrieval-k', type=int, default=3,
+                       help='Number of KB entries to pick few-shot examples from, 0 to disable (default: 3)')
+    parser.add_argument('--example-token-budget', type=int, default=160,
+                       help='Maximum prompt tokens spent on retrieved examples (default: 160)')
+    parser.add_argument('--no-fast-path', action='store_true',
+                       help='Always use the model, even for queries the fast-path rules can answer')
+    parser.add_argument('--fast-path-threshold', type=float, default=0.85,
+                       help='Minimum confidence for a fast-path answer (default: 0.85)')
+    parser.add_argument('--rules-path', type=str, default=USER_RULES_PATH,
+                       help=f'User fast-path rules file, takes precedence over the built-in rules (default: {USER_RULES_PATH})')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                       help='Number of model workers serving requests in parallel (default: 1)')
+    parser.add_argument('--threads', type=int, default=None,
+                       help='Total CPU threads, split evenly between workers (default: tuned, or one per physical core)')
+    parser.add_argument('--n-ctx', type=int, default=None,
+                       help='Context size in tokens (default: tuned, or 2048)')
+    parser.add_argument('--n-batch', type=int, default=None,
+                       help='Prompt tokens evaluated per batch (default: tuned, or 512)')
+    parser.add_argument('--autotune', action='store_true',
+                       help=f'Benchmark thread, batch and context settings on this machine, save the best to {TUNING_PATH} and exit')
+    parser.add_argument('--max-queue', type=int, default=16,
+                       help='Requests allowed to wait for a worker before answering 503 (default: 16)')
+    parser.add_argument('--max-batch', type=int, default=1,
+                       help='Decode up to this many requests together per worker (continuous batching), 1 to disable. Not combinable with --constrained or speculative decoding; session follow-ups evaluate their history again (default: 1)')
+    parser.add_argument('--max-batch-wait', type=float, default=0.005,
+                       help='Seconds an idle worker waits to fill a batch (default: 0.005)')
+    parser.add_argument('--socket', nargs='?', const=DEFAULT_SOCKET_PATH, default=None, metavar='PATH',
+                       help=f'Also listen on a Unix domain socket (default path: {DEFAULT_SOCKET_PATH})')
+    parser.add_argument('--idle-unload', type=float, default=DEFAULT_IDLE_UNLOAD, metavar='SECONDS',
+                       help=f'Unload the model after this many idle seconds and reload it on the next request, 0 to keep it loaded (default: {DEFAULT_IDLE_UNLOAD})')
+    parser.add_argument('--mlock', action='store_true',
+                       help='Lock the model weights in RAM while loaded (may need a higher ulimit -l)')
+    parser.add_argument('--no-prefault', action='store_true',
+                       help='Do not read the model file into the page cache before loading it')
+    parser.add_argument('--constrained', action='store_true',
+                       help='Constrain output to a single-line shell command grammar (checks the 32 likeliest tokens per step, the whole vocabulary only when none fits)')
+    speculative = parser.add_mutually_exclusive_group()
+    speculative.add_argument('--prompt-lookup', action='store_true',
+                            help='Speculative decoding with drafts copied from the prompt and KB examples')
+    speculative.add_argument('--draft-model', type=str, default=None, metavar='PATH',
+                            help='Speculative decoding with a small GGUF (same vocabulary) as the draft model')
+    parser.add_argument('--draft-tokens', type=int, default=8,
+                       help='Maximum tokens drafted per speculative decoding step (default: 8)')
     # Note: --help is automatically added by argparse
     
     # Handle legacy positional argument for port
@@ -324,13 +4536,68 @@ def main():
     if args.model_path and not os.path.exists(args.model_path):
         print(f"❌ Model file not found: {args.model_path}")
         sys.exit(1)
-    
+    if args.draft_model and not os.path.exists(args.draft_model):
+        print(f"❌ Draft model file not found: {args.draft_model}")
+        sys.exit(1)
+    # The batch decoder samples greedily from its own context: no grammar, no drafts
+    unbatchable = [flag for flag, enabled in (('--constrained', args.constrained),
+                                              ('--prompt-lookup', args.prompt_lookup),
+                                              ('--draft-model', args.draft_model)) if enabled]
+    if args.max_batch > 1 and unbatchable:
+        print(f"❌ --max-batch can't be combined with {', '.join(unbatchable)}")
+        sys.exit(1)
+
     # Check if llama-cpp-python is available for model operations
     if not LOCAL_MODEL_AVAILABLE:
         print("❌ llama-cpp-python not available. Install with: pip install llama-cpp-python")
         sys.exit(1)
     
-    run_server(port=args.port, model_path=args.model_path)
+    if args.autotune:
+        autotune(args.model_path, retrieval_k=args.retrieval_k)
+        return
+    
+    # Explicit flags win over the --autotune profile, which wins over the defaults
+    profile = load_tuning_profile(args.model_path or get_model_path()) or {}
+    if profile:
+        print(f"🔧 Using tuning profile {TUNING_PATH} (n_threads={profile['n_threads']}, "
+              f"n_batch={profile['n_batch']}, n_ctx={profile['n_ctx']})")
+    
+    run_server(
+        port=args.port,
+        model_path=args.model_path,
+        use_cache=not args.no_cache,
+        cache_size=args.cache_size,
+        cache_ttl=args.cache_ttl,
+        cache_path=args.cache_path or None,
+        retrieval_k=args.retrieval_k,
+        example_token_budget=args.example_token_budget,
+        use_fast_path=not args.no_fast_path,
+        fast_path_threshold=args.fast_path_threshold,
+        rules_path=args.rules_path,
+        workers=args.workers,
+        n_threads=args.threads or profile.get('n_threads') or default_threads(),
+        n_ctx=args.n_ctx or profile.get('n_ctx') or 2048,
+        n_batch=args.n_batch or profile.get('n_batch') or 512,
+        max_queue=args.max_queue,
+        max_batch=args.max_batch,
+        max_batch_wait=args.max_batch_wait,
+        socket_path=args.socket,
+        idle_unload=args.idle_unload,
+        use_mlock=args.mlock,
+        prefault=not args.no_prefault,
+        constrained=args.constrained,
+        prompt_lookup=args.prompt_lookup,
+        draft_model_path=args.draft_model,
+        draft_tokens=args.draft_tokens,
+        semantic_cache=args.semantic_cache,
+        semantic_model_path=args.semantic_cache_model,
+        semantic_threshold=args.semantic_threshold,
+        semantic_cache_size=args.semantic_cache_size,
+        session_memory=args.session_memory,
+        session_ttl=args.session_ttl,
+        models_dir=args.models_dir,
+        trace=args.trace
+    )
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
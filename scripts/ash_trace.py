@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+ash-trace: where the time of traced requests went.
+
+With ASH_TRACE=1 in the shell, every translation gets a trace id that the
+client passes to the server, and the shell, the client and the server each
+append their spans to ~/.ash/traces/trace.jsonl (ash-server --trace traces
+every request, without client spans unless the client traces too). This
+summarizes the slowest requests by stage and writes Chrome trace-event JSON
+(open it in chrome://tracing or https://ui.perfetto.dev) with one timeline per
+request.
+
+    python scripts/ash_trace.py                  # 10 slowest requests
+    python scripts/ash_trace.py --top 3 --chrome trace.json
+    python scripts/ash_trace.py --trace <id>     # one request's spans
+"""
+
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ash'))
+from client import TRACE_PATH, TRACE_BACKUPS
+
+# Columns of the summary, in the order a request goes through them
+STAGES = [
+    ('shell.translate', 'shell'),
+    ('client.startup', 'startup'),
+    ('client.local_lookup', 'local'),
+    ('client.request', 'client'),
+    ('server.request', 'server'),
+    ('server.queue_wait', 'queue'),
+    ('server.prepare', 'prepare'),
+    ('server.tokenize', 'tokenize'),
+    ('server.prompt_eval', 'prompt'),
+    ('server.decode', 'decode'),
+    ('server.serialize', 'write'),
+]
+# Lanes of a request's timeline
+PROCS = ('shell', 'client', 'server')
+
+
+def load_spans(path):
+    """Spans from the trace file and its rotated backups, oldest first"""
+    spans = []
+    for name in [f"{path}.{i}" for i in range(TRACE_BACKUPS, 0, -1)] + [path]:
+        try:
+            with open(name, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash or a concurrent rotation
+                        continue
+                    if isinstance(span, dict) and 'trace' in span and 'ts' in span:
+                        spans.append(span)
+        except OSError:
+            continue
+    return spans
+
+
+def group_traces(spans):
+    """
+    Requests, slowest first: dicts with the trace id, query, source, start,
+    total seconds (first span start to last span end) and the trace's spans.
+    """
+    by_trace = defaultdict(list)
+    for span in spans:
+        by_trace[span['trace']].append(span)
+    traces = []
+    for trace_id, trace_spans in by_trace.items():
+        trace_spans.sort(key=lambda span: span['ts'])
+        start = trace_spans[0]['ts']
+        end = max(span['ts'] + span['dur'] for span in trace_spans)
+        attrs = {}
+        for span in trace_spans:
+            for key in ('query', 'source'):
+                if span.get('attrs', {}).get(key) is not None:
+                    attrs.setdefault(key, span['attrs'][key])
+        traces.append({'trace': trace_id, 'query': attrs.get('query', ''), 'source': attrs.get('source', ''),
+                       'start': start, 'total': end - start, 'spans': trace_spans})
+    traces.sort(key=lambda trace: trace['total'], reverse=True)
+    return traces
+
+
+def stage_times(trace):
+    """Seconds per stage of a request (summed if a stage ran more than once)"""
+    times = defaultdict(float)
+    for span in trace['spans']:
+        times[span['name']] += span['dur']
+    return times
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def print_summary(traces, top):
+    """The slowest requests by stage, then each stage's p50 / p95 over all requests"""
+    header = f"{'trace':<16} {'total':>8}" + "".join(f" {label:>8}" for _, label in STAGES) + "  source    query"
+    print(f"🐢 {min(top, len(traces))} slowest of {len(traces)} traced requests (milliseconds)")
+    print(header)
+    for trace in traces[:top]:
+        times = stage_times(trace)
+        cells = "".join(f" {times[name] * 1000:>8.1f}" if name in times else f" {'-':>8}" for name, _ in STAGES)
+        print(f"{trace['trace'][:16]:<16} {trace['total'] * 1000:>8.1f}{cells}  {trace['source']:<9} {trace['query'][:60]}")
+
+    print()
+    print(f"{'stage':<20} {'requests':>8} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    all_times = [stage_times(trace) for trace in traces]
+    for name, _ in STAGES:
+        values = [times[name] for times in all_times if name in times]
+        if values:
+            print(f"{name:<20} {len(values):>8} {percentile(values, 0.5) * 1000:>9.2f} {percentile(values, 0.95) * 1000:>9.2f}")
+    # Time between the client sending and the server starting/finishing: connection and transfer
+    hops = [times['client.request'] - times['server.request'] for times in all_times
+            if 'client.request' in times and 'server.request' in times]
+    if hops:
+        print(f"{'(http hop)':<20} {len(hops):>8} {percentile(hops, 0.5) * 1000:>9.2f} {percentile(hops, 0.95) * 1000:>9.2f}")
+
+
+def print_trace(trace):
+    """Every span of one request, relative to its start"""
+    print(f"Trace {trace['trace']}: {trace['query']!r} ({trace['source'] or 'no server span'}), "
+          f"{trace['total'] * 1000:.1f} ms")
+    for span in trace['spans']:
+        offset = (span['ts'] - trace['start']) * 1000
+        attrs = " ".join(f"{key}={value}" for key, value in span.get('attrs', {}).items() if key != 'query')
+        print(f"  +{offset:>9.2f} ms {span['dur'] * 1000:>9.2f} ms  {span['name']:<20} {attrs}")
+
+
+def chrome_trace(traces):
+    """
+    Chrome trace-event JSON: one process per request (named after its query),
+    with the shell, client and server spans on their own thread each, so
+    nested stages stack into a flame chart.
+    """
+    events = []
+    for pid, trace in enumerate(sorted(traces, key=lambda trace: trace['start']), start=1):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': f"{trace['trace'][:8]} {trace['query'][:60]}"}})
+        for tid, proc in enumerate(PROCS, start=1):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': proc}})
+        for span in trace['spans']:
+            proc = span.get('proc', 'server')
+            events.append({
+                'name': span['name'],
+                'cat': proc,
+                'ph': 'X',
+                'ts': round(span['ts'] * 1e6, 1),
+                'dur': round(span['dur'] * 1e6, 1),
+                'pid': pid,
+                'tid': PROCS.index(proc) + 1 if proc in PROCS else len(PROCS) + 1,
+                'args': dict(span.get('attrs', {}), pid=span.get('pid')),
+            })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize traced ash requests (ASH_TRACE=1)")
+    parser.add_argument('--file', default=TRACE_PATH, help=f'Trace file (default: {TRACE_PATH})')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest requests to show (default: 10)')
+    parser.add_argument('--trace', metavar='ID', help='Show the spans of one request (an id prefix is enough)')
+    parser.add_argument('--chrome', metavar='PATH', help='Write Chrome trace-event JSON of the shown requests')
+    args = parser.parse_args()
+
+    traces = group_traces(load_spans(args.file))
+    if args.trace:
+        traces = [trace for trace in traces if trace['trace'].startswith(args.trace)]
+    if not traces:
+        print(f"❌ No traced requests in {args.file}. Set ASH_TRACE=1 in the shell (or run ash-server --trace).")
+        sys.exit(1)
+
+    if args.trace:
+        for trace in traces:
+            print_trace(trace)
+    else:
+        print_summary(traces, args.top)
+
+    if args.chrome:
+        shown = traces if args.trace else traces[:args.top]
+        with open(args.chrome, 'w', encoding='utf-8') as f:
+            json.dump(chrome_trace(shown), f)
+        print(f"✅ Wrote {len(shown)} requests to {args.chrome}")
+
+
+if __name__ == "__main__":
+    main()
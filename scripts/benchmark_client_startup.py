@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Cold-start cost of ash-client: module import time and the wall time of a
+complete `client.py --ping` run against a running server.
+
+Pass a git revision to compare its client.py with the working tree, e.g.
+    python scripts/benchmark_client_startup.py HEAD~1
+"""
+
+import os
+import sys
+import time
+import subprocess
+import tempfile
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLIENT_PATH = os.path.join(REPO_ROOT, 'ash', 'client.py')
+
+
+def import_time(client_path, runs):
+    """Median seconds to import the client module in a fresh interpreter"""
+    code = (
+        "import sys, time; sys.path.insert(0, sys.argv[1]); "
+        "start = time.perf_counter(); import client; print(time.perf_counter() - start)"
+    )
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code, os.path.dirname(client_path)],
+                                capture_output=True, text=True, check=True).stdout
+        times.append(float(output))
+    return sorted(times)[len(times) // 2]
+
+
+def ping_time(client_path, runs):
+    """Median wall seconds of `client.py --ping`, interpreter start-up included"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, client_path, '--ping'], capture_output=True)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def client_at(revision, directory):
+    """Write client.py as of a git revision into directory"""
+    source = subprocess.run(['git', '-C', REPO_ROOT, 'show', f'{revision}:ash/client.py'],
+                            capture_output=True, text=True, check=True).stdout
+    path = os.path.join(directory, 'client.py')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(source)
+    return path
+
+
+def main():
+    runs = int(os.environ.get('RUNS', '20'))
+    clients = [('working tree', CLIENT_PATH)]
+    with tempfile.TemporaryDirectory() as directory:
+        if len(sys.argv) > 1:
+            clients.insert(0, (sys.argv[1], client_at(sys.argv[1], directory)))
+
+        print(f"{'client':>14} {'import (ms)':>12} {'--ping (ms)':>12}")
+        for name, path in clients:
+            try:
+                imported = import_time(path, runs)
+            except subprocess.CalledProcessError as e:
+                print(f"❌ {name}: import failed: {e.stderr.strip().splitlines()[-1]}")
+                continue
+            print(f"{name:>14} {imported * 1000:>12.1f} {ping_time(path, runs) * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
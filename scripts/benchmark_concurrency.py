@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Throughput vs latency benchmark for a running ash server.
+
+Runs the test_data queries from 1, 4 and 16 concurrent clients with the
+response cache and fast path disabled, so every request hits the model.
+Compare a server started with --max-batch 1 against one with --max-batch 16.
+"""
+
+import sys
+import json
+import time
+import threading
+import urllib.request
+import urllib.parse
+from pathlib import Path
+
+
+def load_queries():
+    """All queries from tests/test_data"""
+    queries = []
+    test_data = Path(__file__).parent.parent / "tests" / "test_data"
+    for json_file in sorted(test_data.glob("*.json")):
+        with open(json_file, 'r', encoding='utf-8') as f:
+            queries.extend(case["query"] for case in json.load(f))
+    return queries
+
+
+def run_clients(server_url, queries, concurrency):
+    """Send every query once from `concurrency` clients; returns (latencies, errors, wall time)"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = list(queries)
+
+    def client():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                query = remaining.pop()
+            params = urllib.parse.urlencode({"q": query, "cache": 0, "fast_path": 0})
+            start = time.time()
+            try:
+                with urllib.request.urlopen(f"{server_url}/generate?{params}", timeout=120) as response:
+                    response.read()
+                with lock:
+                    latencies.append(time.time() - start)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.time() - start
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def main():
+    server_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8765"
+    queries = load_queries()
+    print(f"{len(queries)} queries against {server_url}")
+    print(f"{'clients':>8} {'req/s':>8} {'p50 (s)':>8} {'p90 (s)':>8} {'p99 (s)':>8} {'errors':>7}")
+    for concurrency in (1, 4, 16):
+        latencies, errors, wall = run_clients(server_url, queries, concurrency)
+        print(f"{concurrency:>8} {len(latencies) / wall:>8.2f} {percentile(latencies, 50):>8.3f} "
+              f"{percentile(latencies, 90):>8.3f} {percentile(latencies, 99):>8.3f} {len(errors):>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Free vs grammar-constrained decoding on the tests/test_data corpus.
+
+Loads the model once per mode and generates every query with the response
+cache off, reporting generated tokens, latency and accuracy for each.
+    python scripts/benchmark_constrained.py [/path/to/model.gguf]
+"""
+
+import os
+import sys
+import json
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / 'ash'))
+sys.path.insert(0, str(REPO_ROOT / 'tests'))
+from server import ASHModel
+from run_tests import command_matches
+
+
+def load_cases():
+    """(query, expected commands) for every case in tests/test_data"""
+    cases = []
+    for json_file in sorted((REPO_ROOT / 'tests' / 'test_data').glob('*.json')):
+        with open(json_file, 'r', encoding='utf-8') as f:
+            for case in json.load(f):
+                expected = case['expected']
+                cases.append((case['query'], [expected] if isinstance(expected, str) else expected))
+    return cases
+
+
+def run(model_path, cases, constrained):
+    """Generate every case; returns (mean completion tokens, mean seconds, p90 seconds, accuracy)"""
+    model = ASHModel(model_path=model_path, use_cache=False, constrained=constrained)
+    model.load()
+    tokens = []
+    latencies = []
+    passed = 0
+    try:
+        for query, expected in cases:
+            start = time.perf_counter()
+            result = model.generate(query, use_cache=False)
+            latencies.append(time.perf_counter() - start)
+            tokens.append(result['completion_tokens'])
+            passed += command_matches(result['command'], expected)
+    finally:
+        model.unload()
+    latencies.sort()
+    return (sum(tokens) / len(tokens), sum(latencies) / len(latencies),
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))], passed / len(cases))
+
+
+def main():
+    model_path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('ASH_MODEL_PATH')
+    cases = load_cases()
+    limit = int(os.environ.get('LIMIT', '0'))
+    if limit:
+        cases = cases[:limit]
+    print(f"{len(cases)} queries")
+    print(f"{'decoding':>12} {'tokens':>8} {'mean (ms)':>10} {'p90 (ms)':>10} {'accuracy':>9}")
+    baseline = None
+    for name, constrained in (('free', False), ('constrained', True)):
+        tokens, mean, p90, accuracy = run(model_path, cases, constrained)
+        print(f"{name:>12} {tokens:>8.1f} {mean * 1000:>10.1f} {p90 * 1000:>10.1f} {accuracy * 100:>8.1f}%")
+        if baseline is None:
+            baseline = mean
+        else:
+            print(f"\nLatency change: {(mean - baseline) / baseline * 100:+.1f}%")
+
+
+if __name__ == "__main__":
+    main()
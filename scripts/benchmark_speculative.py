@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Speculative decoding on the tests/test_data corpus: plain decoding vs prompt
+lookup, and vs a draft GGUF when one is given.
+
+Reports decode speed (generated tokens per second after the first token), mean
+and median latency, draft acceptance rate and accuracy for each mode.
+    python scripts/benchmark_speculative.py [/path/to/model.gguf] [/path/to/draft.gguf]
+"""
+
+import os
+import sys
+import time
+import statistics
+
+from benchmark_constrained import load_cases, command_matches, ASHModel
+
+
+def run(model_path, cases, **options):
+    """Generate every case; returns (decode tokens/s, mean seconds, p50 seconds, acceptance rate, accuracy)"""
+    model = ASHModel(model_path=model_path, use_cache=False, **options)
+    model.load()
+    tokens = 0
+    decode_time = 0.0
+    latencies = []
+    passed = 0
+    try:
+        for query, expected in cases:
+            start = time.perf_counter()
+            result = model.generate(query, use_cache=False)
+            latencies.append(time.perf_counter() - start)
+            # The first token comes out of prompt evaluation, the rest out of decoding
+            tokens += max(result['completion_tokens'] - 1, 0)
+            decode_time += result['timings']['decode']
+            passed += command_matches(result['command'], expected)
+        acceptance = model.draft.stats()['acceptance_rate'] if model.draft is not None else None
+    finally:
+        model.unload()
+    return (tokens / decode_time if decode_time else 0.0, sum(latencies) / len(latencies),
+            statistics.median(latencies), acceptance, passed / len(cases))
+
+
+def main():
+    model_path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('ASH_MODEL_PATH')
+    draft_path = sys.argv[2] if len(sys.argv) > 2 else None
+    draft_tokens = int(os.environ.get('DRAFT_TOKENS', '8'))
+    cases = load_cases()
+    limit = int(os.environ.get('LIMIT', '0'))
+    if limit:
+        cases = cases[:limit]
+    modes = [('plain', {}), ('prompt-lookup', {'prompt_lookup': True, 'draft_tokens': draft_tokens})]
+    if draft_path:
+        modes.append(('draft-model', {'draft_model_path': draft_path, 'draft_tokens': draft_tokens}))
+
+    print(f"{len(cases)} queries, up to {draft_tokens} drafted tokens per step")
+    print(f"{'decoding':>14} {'decode tok/s':>13} {'mean (ms)':>10} {'p50 (ms)':>9} {'accepted':>9} {'accuracy':>9} {'speedup':>8}")
+    baseline = None
+    for name, options in modes:
+        speed, mean, p50, acceptance, accuracy = run(model_path, cases, **options)
+        baseline = baseline or speed
+        accepted = f"{acceptance * 100:.1f}%" if acceptance is not None else "-"
+        speedup = f"{speed / baseline:.2f}x" if baseline else "-"
+        print(f"{name:>14} {speed:>13.1f} {mean * 1000:>10.1f} {p50 * 1000:>9.1f} {accepted:>9} {accuracy * 100:>8.1f}% {speedup:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Offline accuracy vs latency sweep over models, thread counts and prompt templates.
+
+Every configuration (GGUF x n_threads x prompt variant) loads ASHModel in its
+own process, with no server or HTTP in the way, runs the tests/test_data corpus
+through it and is scored with run_tests.py's command_matches. The report has
+score, p50/p95 latency, tokens/sec, load time and peak RSS per configuration,
+with the Pareto frontier of score vs p50 latency marked.
+
+    python scripts/benchmark_sweep.py --models models/ --threads 4 8 --prompts prompts.json --output sweep.json
+
+prompts.json names prompt variants; each may replace the static prompt prefix
+and/or the per-query template (which must contain {query}):
+
+    {"terse": {"prefix": "Translate to a shell command.\\n\\n", "query_template": "Q: {query}\\nA:"}}
+
+The server's own prompt is always included as "default". Configurations run
+--jobs at a time; parallel runs share the CPUs, so keep jobs x threads within
+the core count or the latencies are inflated.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import itertools
+import contextlib
+import multiprocessing
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_ROOT, 'ash'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'tests'))
+import server
+from run_tests import command_matches, load_test_cases, percentile
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_config(job):
+    """
+    Load one configuration in this (fresh) process and run the corpus through it.
+
+    Args:
+        job (tuple): (config dict, test cases, n_ctx, retrieval_k)
+
+    Returns:
+        dict: The config with its metrics and per-query results, or with 'error'
+    """
+    config, cases, n_ctx, retrieval_k = job
+    # One process per configuration, so the prompt can be swapped module-wide
+    server.PROMPT_PREFIX = config['prefix']
+    server.QUERY_TEMPLATE = config['query_template']
+    report = {key: config[key] for key in ('model', 'n_threads', 'prompt')}
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            model = server.ASHModel(model_path=config['model_path'], n_threads=config['n_threads'], n_ctx=n_ctx,
+                                    use_cache=False, retrieval_k=retrieval_k)
+            model.load()
+    except Exception as e:
+        report['error'] = str(e)
+        report['log'] = log.getvalue()[-2000:]
+        return report
+
+    results = []
+    latencies = []
+    totals = {'completion_tokens': 0, 'prompt_tokens_evaluated': 0, 'decode': 0.0, 'prompt_eval': 0.0}
+    earned = 0
+    total_points = 0
+    for case in cases:
+        expected = case['expected'] if isinstance(case['expected'], list) else [case['expected']]
+        points = case.get('points', 3)
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(log):
+                output = model.generate(case['query'], use_cache=False)
+            command = output['command']
+        except Exception as e:
+            output = {}
+            command = ""
+            print(f"⚠️  {config['name']}: {case['query']!r} failed: {e}", file=sys.stderr)
+        latency = time.perf_counter() - start
+        passed = command_matches(command, expected)
+        total_points += points
+        earned += points if passed else 0
+        latencies.append(latency)
+        for key in ('completion_tokens', 'prompt_tokens_evaluated'):
+            totals[key] += output.get(key, 0)
+        for stage in ('decode', 'prompt_eval'):
+            totals[stage] += output.get('timings', {}).get(stage, 0.0)
+        results.append({'query': case['query'], 'file_name': case.get('file_name'), 'command': command,
+                        'passed': passed, 'latency': round(latency, 4)})
+    with contextlib.redirect_stdout(log):
+        model.unload()
+
+    report.update({
+        'score': round(100.0 * earned / total_points, 2) if total_points else 0.0,
+        'passed': sum(1 for result in results if result['passed']),
+        'cases': len(results),
+        'p50': round(percentile(latencies, 50), 4),
+        'p95': round(percentile(latencies, 95), 4),
+        'decode_tokens_per_second': round(totals['completion_tokens'] / totals['decode'], 1) if totals['decode'] else 0.0,
+        'prompt_tokens_per_second': round(totals['prompt_tokens_evaluated'] / totals['prompt_eval'], 1) if totals['prompt_eval'] else 0.0,
+        'load_time': round(model.load_time or 0.0, 3),
+        'peak_rss': peak_rss(),
+        'results': results,
+    })
+    return report
+
+
+def pareto_frontier(reports):
+    """Mark reports no other one beats on both score (higher) and p50 latency (lower)"""
+    ok = [report for report in reports if 'error' not in report]
+    for report in ok:
+        report['pareto'] = not any(
+            other['score'] >= report['score'] and other['p50'] <= report['p50']
+            and (other['score'] > report['score'] or other['p50'] < report['p50'])
+            for other in ok
+        )
+
+
+def load_prompts(path):
+    """Prompt variants: the server's prompt as "default", plus those in the JSON file at path"""
+    prompts = {'default': {'prefix': server.PROMPT_PREFIX, 'query_template': server.QUERY_TEMPLATE}}
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            for name, variant in json.load(f).items():
+                prompt = {'prefix': variant.get('prefix', server.PROMPT_PREFIX),
+                          'query_template': variant.get('query_template', server.QUERY_TEMPLATE)}
+                if '{query}' not in prompt['query_template']:
+                    raise ValueError(f"Prompt {name!r}: query_template must contain {{query}}")
+                prompts[name] = prompt
+    return prompts
+
+
+def model_paths(paths):
+    """GGUF files given directly or found in the given directories"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.gguf')))
+        else:
+            found.append(path)
+    return found
+
+
+def print_table(reports):
+    print(f"\n{'':2}{'model':<42} {'threads':>7} {'prompt':<12} {'score':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} "
+          f"{'tok/s':>7} {'load (s)':>8} {'RSS (MB)':>9}")
+    for report in reports:
+        if 'error' in report:
+            print(f"  {report['model'][:42]:<42} {report['n_threads']:>7} {report['prompt'][:12]:<12} ❌ {report['error']}")
+            continue
+        mark = "★ " if report['pareto'] else "  "
+        print(f"{mark}{report['model'][:42]:<42} {report['n_threads']:>7} {report['prompt'][:12]:<12} "
+              f"{report['score']:>5.1f}% {report['p50'] * 1000:>9.1f} {report['p95'] * 1000:>9.1f} "
+              f"{report['decode_tokens_per_second']:>7.1f} {report['load_time']:>8.2f} {report['peak_rss'] / 1024**2:>9.0f}")
+    print("\n★ Pareto frontier: no other configuration scores higher at a lower p50 latency")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy vs latency sweep over models, threads and prompts")
+    parser.add_argument('--models', nargs='+', default=None,
+                        help='GGUF files or directories of them (default: the server\'s model)')
+    parser.add_argument('--threads', nargs='+', type=int, default=None,
+                        help='n_threads values (default: one per physical core)')
+    parser.add_argument('--prompts', help='JSON file of extra prompt variants (see the module docstring)')
+    parser.add_argument('--n-ctx', type=int, default=2048, help='Context size (default: 2048)')
+    parser.add_argument('--retrieval-k', type=int, default=3,
+                        help='KB entries to pick few-shot examples from, 0 to disable (default: 3)')
+    parser.add_argument('--category', action='append',
+                        help='Only run this test_data file (e.g. basic), may be repeated')
+    parser.add_argument('--limit', type=int, help='Only run the first N test cases')
+    parser.add_argument('--jobs', type=int, default=1, help='Configurations run in parallel (default: 1)')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    if not server.LOCAL_MODEL_AVAILABLE:
+        print("❌ llama-cpp-python not available. Install with: pip install llama-cpp-python")
+        sys.exit(1)
+    models = model_paths(args.models or [server.get_model_path()])
+    missing = [path for path in models if not os.path.exists(path)]
+    if missing or not models:
+        print(f"❌ Model not found: {', '.join(missing) or 'no .gguf files'}")
+        sys.exit(1)
+    hardware = server.detect_hardware()
+    threads = args.threads or [hardware['physical_cores']]
+    prompts = load_prompts(args.prompts)
+
+    cases = sorted(load_test_cases(), key=lambda case: (case['file_name'], case['query']))
+    if args.category:
+        cases = [case for case in cases if case['file_name'] in args.category]
+    if args.limit:
+        cases = cases[:args.limit]
+    if not cases:
+        print("❌ No test cases selected")
+        sys.exit(1)
+
+    configs = [
+        dict(prompts[prompt], name=f"{os.path.basename(model_path)}/t{n_threads}/{prompt}",
+             model=os.path.basename(model_path), model_path=model_path, n_threads=n_threads, prompt=prompt)
+        for model_path, n_threads, prompt in itertools.product(models, threads, prompts)
+    ]
+    jobs = max(1, min(args.jobs, len(configs)))
+    if jobs * max(threads) > hardware['cpus']:
+        print(f"⚠️  {jobs} jobs x {max(threads)} threads oversubscribe {hardware['cpus']} CPUs, latencies will be inflated")
+    print(f"🔬 {len(configs)} configurations x {len(cases)} test cases, {jobs} at a time")
+
+    reports = []
+    # A fresh process per configuration: its own prompt globals and peak RSS
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=jobs, maxtasksperchild=1) as pool:
+        work = [(config, cases, args.n_ctx, args.retrieval_k) for config in configs]
+        for report in pool.imap_unordered(run_config, work):
+            reports.append(report)
+            if 'error' in report:
+                print(f"❌ {report['model']} t{report['n_threads']} {report['prompt']}: {report['error']}")
+            else:
+                print(f"✅ {report['model']} t{report['n_threads']} {report['prompt']}: {report['score']:.1f}%, "
+                      f"p50 {report['p50'] * 1000:.0f} ms")
+
+    pareto_frontier(reports)
+    reports.sort(key=lambda report: ('error' in report, -report.get('score', 0), report.get('p50', 0)))
+    print_table(reports)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'hardware': hardware,
+                'n_ctx': args.n_ctx,
+                'retrieval_k': args.retrieval_k,
+                'cases': len(cases),
+                'prompts': prompts,
+                'configs': reports,
+            }, f, indent=2)
+        print(f"\n💾 Report written to {args.output}")
+    sys.exit(0 if any('error' not in report for report in reports) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Round-trip latency of a running ash server over TCP vs its Unix domain socket.
+
+Each request opens a new connection, like one ash-client invocation does.
+Start the server with --socket to expose both transports.
+"""
+
+import os
+import sys
+import time
+import socket
+import http.client
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ash'))
+from client import UnixHTTPConnection, SOCKET_PATH
+
+
+def measure(make_connection, path, n):
+    """Median and p99 round-trip seconds of n GET requests"""
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        connection = make_connection()
+        connection.request('GET', path)
+        connection.getresponse().read()
+        connection.close()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[min(n - 1, int(n * 0.99))]
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    # /health answers without touching the model; /generate for pwd is answered by the fast path
+    paths = ['/health', '/generate?q=show+current+directory']
+    transports = [('tcp', lambda: http.client.HTTPConnection('localhost', port, timeout=5))]
+    if os.path.exists(SOCKET_PATH):
+        transports.append(('unix', lambda: UnixHTTPConnection(SOCKET_PATH, timeout=5)))
+    else:
+        print(f"⚠️  {SOCKET_PATH} not found, start ash-server with --socket to compare")
+
+    print(f"{'transport':>10} {'endpoint':>40} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for name, make_connection in transports:
+        for path in paths:
+            try:
+                p50, p99 = measure(make_connection, path, n)
+            except (OSError, socket.timeout) as e:
+                print(f"❌ {name} {path}: {e}")
+                continue
+            print(f"{name:>10} {path:>40} {p50 * 1000:>9.3f} {p99 * 1000:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
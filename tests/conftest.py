@@ -0,0 +1,130 @@
+"""
+Shared fixtures: a stub llama-cpp so ASHModel, the pools and the registry run
+without a GGUF model.
+"""
+
+import os
+import sys
+import time
+import types
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ash'))
+import server
+
+
+class StubLlamaState:
+    """Stands in for llama_cpp.LlamaState"""
+
+    def __init__(self, input_ids, scores, n_tokens, llama_state, llama_state_size, seed):
+        self.input_ids = input_ids
+        self.scores = scores
+        self.n_tokens = n_tokens
+        self.llama_state = llama_state
+        self.llama_state_size = llama_state_size
+        self.seed = seed
+
+
+class StubLlama:
+    """
+    Llama look-alike that answers "<model name> <query>" for the last query in
+    the prompt. Tokens are the prompt's bytes.
+
+    Class attributes (each test gets its own subclass):
+        gate (threading.Event): When set to an event, generations wait for it
+        queries (list): Queries generated, in order
+        closed (list): Names of closed models
+        broken (set): Model file names that fail to load
+    """
+
+    gate = None
+    queries = None
+    closed = None
+    broken = None
+
+    def __init__(self, model_path, n_ctx=2048, **kwargs):
+        self.name = os.path.splitext(os.path.basename(model_path))[0]
+        if os.path.basename(model_path) in self.broken:
+            raise ValueError(f"cannot load {model_path}")
+        self._input_ids = []
+        self.n_tokens = 0
+
+    @staticmethod
+    def longest_token_prefix(a, b):
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return list(text)
+
+    def reset(self):
+        self._input_ids = []
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        self._input_ids = list(tokens)
+        self.n_tokens = len(tokens)
+
+    def save_state(self):
+        return StubLlamaState(np.array(self._input_ids, dtype=np.intc), np.zeros((4, 8), dtype=np.single),
+                              self.n_tokens, b"kv" * 64, 128, 0)
+
+    def load_state(self, state):
+        self._input_ids = [int(token) for token in state.input_ids]
+        self.n_tokens = state.n_tokens
+
+    def __call__(self, prompt, stopping_criteria=None, stream=False, **kwargs):
+        query = prompt.rsplit("User: ", 1)[-1].split("\n")[0]
+        self.queries.append(query)
+        if self.gate is not None:
+            self.gate.wait(10)
+        if stopping_criteria is not None:
+            stopping_criteria(self._input_ids, None)
+        self.eval(self.tokenize(prompt.encode('utf-8')))
+        text = f"{self.name} {query}"
+        if stream:
+            return iter([{'choices': [{'text': word + " "}]} for word in text.split()])
+        return {'choices': [{'text': text}], 'usage': {'completion_tokens': len(text.split())}}
+
+    def close(self):
+        self.closed.append(self.name)
+
+
+@pytest.fixture
+def stub_llama(monkeypatch, tmp_path):
+    """A fresh StubLlama class, installed as server.Llama"""
+    llama = type('StubLlama', (StubLlama,), {'gate': None, 'queries': [], 'closed': [], 'broken': set()})
+    monkeypatch.setattr(server, 'Llama', llama, raising=False)
+    monkeypatch.setattr(server, 'LOCAL_MODEL_AVAILABLE', True)
+    monkeypatch.setattr(server, 'StoppingCriteriaList', lambda criteria: (lambda ids, logits: any(
+        criterion(ids, logits) for criterion in criteria)), raising=False)
+    monkeypatch.setattr(server, 'PREFIX_STATE_DIR', str(tmp_path / 'kvcache'))
+    # read_llama_state builds llama_cpp.LlamaState
+    monkeypatch.setitem(sys.modules, 'llama_cpp', types.SimpleNamespace(LlamaState=StubLlamaState))
+    return llama
+
+
+@pytest.fixture
+def make_model(tmp_path, stub_llama):
+    """Builds an (unloaded) ASHModel on a placeholder GGUF named name in tmp_path"""
+    def make(name='a.gguf'):
+        path = tmp_path / name
+        if not path.exists():
+            path.write_bytes(b"GGUF")
+        return server.ASHModel(model_path=str(path), use_cache=False, retrieval_k=0, prefault=False)
+    return make
+
+
+def wait_until(condition, timeout=5.0):
+    """Poll condition until it holds, failing the test after timeout seconds"""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("condition not reached in time")
+        time.sleep(0.01)
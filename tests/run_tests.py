@@ -2,19 +2,32 @@
 """
 Ash Model Test Runner - Simplified
 Runs all test cases and provides PASS/FAIL statistics.
+
+Benchmark mode replays the test_data corpus against a running server:
+    python tests/run_tests.py bench --concurrency 8 --rate 20 --duration 60 --output bench.json
+    python tests/run_tests.py compare baseline.json bench.json --threshold 0.1
 """
 
+import argparse
 import json
 import os
 import sys
 import time
+import threading
 import requests
+from datetime import datetime
 from pathlib import Path
 
+DEFAULT_SERVER_URL = "http://localhost:8765"
+# Latency percentiles reported by the benchmark
+PERCENTILES = (50, 90, 99)
+# An error rate this much above the baseline's is a regression regardless of --threshold
+ERROR_RATE_TOLERANCE = 0.01
+
 def check_server(server_url):
     """Check if the Ash server is running."""
     try:
-        response = requests.get(f"{server_url}/ping", timeout=5)
+        response = requests.get(f"{server_url}/health", timeout=5)
         return response.status_code == 200
     except:
         return False
@@ -38,6 +51,30 @@ def generate_command(server_url, query):
         print(f"Error: {e}")
         return "", 0.0
 
+def generate_commands_batch(server_url, queries):
+    """
+    Generate commands for many queries with one POST /generate/batch.
+    
+    Returns:
+        list: (command, seconds) per query; the batch's time is split evenly
+    """
+    try:
+        start_time = time.time()
+        response = requests.post(f"{server_url}/generate/batch", json=queries, timeout=120)
+        elapsed = (time.time() - start_time) / max(len(queries), 1)
+        if response.status_code != 200:
+            print(f"Error: HTTP {response.status_code}: {response.text.strip()}")
+            return [("", elapsed)] * len(queries)
+        commands = []
+        for item in response.json()["results"]:
+            if "error" in item:
+                print(f"Error: {item['error']}")
+            commands.append((item.get("command", ""), elapsed))
+        return commands
+    except Exception as e:
+        print(f"Error: {e}")
+        return [("", 0.0)] * len(queries)
+
 def normalize_command(command):
     """Normalize command for comparison."""
     if not command:
@@ -72,8 +109,15 @@ def load_test_cases(test_data_dir="test_data"):
     
     return test_cases
 
-def run_tests(server_url):
-    """Run all test cases."""
+def run_tests(server_url, batch_size=0):
+    """
+    Run all test cases.
+    
+    Args:
+        server_url (str): Server to test
+        batch_size (int): Send queries in batches of this size over /generate/batch
+                          (0 = one /generate request per query)
+    """
     print("Loading test cases...")
     test_cases = load_test_cases()
     print(f"Total test cases: {len(test_cases)}")
@@ -86,6 +130,13 @@ def run_tests(server_url):
     earned_points = 0
     inference_times = []
     
+    batched = {}
+    if batch_size > 0:
+        for start in range(0, len(test_cases), batch_size):
+            chunk = [case["query"] for case in test_cases[start:start + batch_size]]
+            for offset, answer in enumerate(generate_commands_batch(server_url, chunk)):
+                batched[start + offset] = answer
+    
     for i, test_case in enumerate(test_cases, 1):
         query = test_case["query"]
         expected = test_case["expected"]
@@ -95,7 +146,10 @@ def run_tests(server_url):
         if isinstance(expected, str):
             expected = [expected]
         
-        actual_command, inference_time = generate_command(server_url, query)
+        if batch_size > 0:
+            actual_command, inference_time = batched[i - 1]
+        else:
+            actual_command, inference_time = generate_command(server_url, query)
         passed = command_matches(actual_command, expected)
         
         total_points += points
@@ -109,6 +163,14 @@ def run_tests(server_url):
         if not passed:
             print(f"     Expected: {expected}")
             print(f"     Actual:   {actual_command}")
+        
+        results.append({
+            'query': query,
+            'file_name': file_name,
+            'passed': passed,
+            'command': actual_command,
+            'inference_time': inference_time
+        })
     
     return {
         'total_tests': len(test_cases),
@@ -128,6 +190,7 @@ def print_stats(stats):
     avg_time = sum(stats['inference_times']) / len(stats['inference_times']) if stats['inference_times'] else 0
     
     print(f"Tests:           {stats['total_tests']}")
+    print(f"Passed:          {stats['passed_tests']}/{stats['total_tests']}")
     print(f"Points Earned:   {stats['earned_points']}/{stats['total_points']}")
     print(f"Score:           {pass_rate:.1f}%")
     print(f"Avg Time:        {avg_time:.3f}s")
@@ -139,11 +202,284 @@ def print_stats(stats):
         print(f"\n⚠️  Test suite failed ({pass_rate:.1f}%)")
         return 1
 
+def percentile(values, pct):
+    """Nearest-rank percentile of values (0.0 when empty)."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def distribution(values):
+    """Percentiles, mean and max of a list of seconds."""
+    summary = {f"p{pct}": percentile(values, pct) for pct in PERCENTILES}
+    summary['mean'] = sum(values) / len(values) if values else 0.0
+    summary['max'] = max(values) if values else 0.0
+    return summary
+
+def stream_command(server_url, query, use_cache, use_fast_path, timeout):
+    """
+    Generate a command over /generate/stream.
+    
+    Returns:
+        tuple: (command, source, seconds to the first token, total seconds)
+    """
+    start_time = time.time()
+    first_token = None
+    params = {"q": query, "cache": int(use_cache), "fast_path": int(use_fast_path), "timeout": timeout}
+    with requests.get(f"{server_url}/generate/stream", params=params, stream=True, timeout=timeout + 5) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text.strip()}")
+        event = "message"
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[len("data:"):])
+                if event == "error":
+                    raise RuntimeError(data.get("error", "stream error"))
+                if event == "done":
+                    return data.get("command", ""), data.get("source"), first_token, time.time() - start_time
+                if first_token is None:
+                    first_token = time.time() - start_time
+            elif not line:
+                event = "message"
+    raise RuntimeError("stream ended without a done event")
+
+def fetch_command(server_url, query, use_cache, use_fast_path, timeout):
+    """
+    Generate a command over /generate; the whole response counts as the first token.
+    
+    Returns:
+        tuple: (command, source, seconds to the first token, total seconds)
+    """
+    start_time = time.time()
+    params = {"q": query, "cache": int(use_cache), "fast_path": int(use_fast_path), "timeout": timeout}
+    response = requests.get(f"{server_url}/generate", params=params, timeout=timeout + 5)
+    elapsed = time.time() - start_time
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.text.strip()}")
+    data = response.json()
+    return data.get("command", ""), data.get("source"), elapsed, elapsed
+
+def run_benchmark(server_url, concurrency=1, rate=None, duration=None, use_cache=False,
+                  use_fast_path=False, stream=True, timeout=30):
+    """
+    Replay the test_data corpus against a running server.
+    
+    Args:
+        server_url (str): Server to benchmark
+        concurrency (int): Number of clients sending requests in parallel
+        rate (float): Target requests per second across all clients (None = as fast as possible)
+        duration (float): Seconds to keep replaying the corpus (None = one pass)
+        use_cache (bool): Allow answers from the server's response cache
+        use_fast_path (bool): Allow answers from the server's fast path
+        stream (bool): Use /generate/stream so time-to-first-token can be measured
+        timeout (int): Per-request deadline passed to the server, in seconds
+        
+    Returns:
+        dict: Benchmark configuration, per-request records and summary
+    """
+    test_cases = load_test_cases()
+    if not test_cases:
+        raise RuntimeError("no test cases found")
+    send = stream_command if stream else fetch_command
+    lock = threading.Lock()
+    records = []
+    next_index = [0]
+    
+    start_time = time.time()
+    
+    def claim():
+        # Next request index and its scheduled start, or None when the run is over
+        with lock:
+            index = next_index[0]
+            if duration is None and index >= len(test_cases):
+                return None
+            next_index[0] += 1
+        scheduled = start_time + index / rate if rate else time.time()
+        if duration is not None and scheduled - start_time >= duration:
+            return None
+        return index, scheduled
+    
+    def client():
+        while True:
+            claimed = claim()
+            if claimed is None:
+                return
+            index, scheduled = claimed
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            test_case = test_cases[index % len(test_cases)]
+            expected = test_case["expected"]
+            if isinstance(expected, str):
+                expected = [expected]
+            record = {'query': test_case["query"], 'file_name': test_case.get("file_name", "unknown")}
+            # With a target rate, latency counts from the scheduled start so a slow
+            # server is not hidden by clients that fell behind the schedule
+            lag = max(0.0, time.time() - scheduled) if rate else 0.0
+            try:
+                command, source, ttft, total = send(server_url, test_case["query"], use_cache, use_fast_path, timeout)
+                record.update({
+                    'ok': True,
+                    'command': command,
+                    'source': source,
+                    'passed': command_matches(command, expected),
+                    'ttft': None if ttft is None else lag + ttft,
+                    'latency': lag + total
+                })
+            except Exception as e:
+                record.update({'ok': False, 'error': str(e)})
+            with lock:
+                records.append(record)
+    
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.time() - start_time
+    
+    succeeded = [r for r in records if r['ok']]
+    sources = {}
+    for record in succeeded:
+        sources[record['source']] = sources.get(record['source'], 0) + 1
+    summary = {
+        'requests': len(records),
+        'errors': len(records) - len(succeeded),
+        'error_rate': (len(records) - len(succeeded)) / len(records) if records else 0.0,
+        'throughput': len(succeeded) / wall_time if wall_time > 0 else 0.0,
+        'wall_time': wall_time,
+        'accuracy': sum(1 for r in succeeded if r['passed']) / len(succeeded) if succeeded else 0.0,
+        'latency': distribution([r['latency'] for r in succeeded]),
+        'ttft': distribution([r['ttft'] for r in succeeded if r['ttft'] is not None]),
+        'sources': sources
+    }
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'server_url': server_url,
+            'concurrency': concurrency,
+            'rate': rate,
+            'duration': duration,
+            'cache': use_cache,
+            'fast_path': use_fast_path,
+            'stream': stream,
+            'timeout': timeout
+        },
+        'summary': summary,
+        'requests': records
+    }
+
+def print_benchmark(report):
+    """Print a benchmark summary."""
+    config = report['config']
+    summary = report['summary']
+    print("\n" + "=" * 60)
+    print("⏱️  BENCHMARK RESULTS")
+    print("=" * 60)
+    print(f"Server:          {config['server_url']}")
+    rate = f"{config['rate']} req/s" if config['rate'] else "unlimited"
+    duration = f"{config['duration']}s" if config['duration'] else "one pass"
+    print(f"Load:            {config['concurrency']} clients, {rate}, {duration}")
+    print(f"Requests:        {summary['requests']} in {summary['wall_time']:.1f}s")
+    print(f"Throughput:      {summary['throughput']:.2f} req/s")
+    print(f"Error Rate:      {summary['error_rate'] * 100:.1f}% ({summary['errors']} errors)")
+    print(f"Accuracy:        {summary['accuracy'] * 100:.1f}%")
+    for name in ('latency', 'ttft'):
+        values = summary[name]
+        label = "Latency" if name == 'latency' else "TTFT"
+        print(f"{label + ':':16s} " + "  ".join(f"p{pct} {values[f'p{pct}'] * 1000:.1f}ms" for pct in PERCENTILES)
+              + f"  max {values['max'] * 1000:.1f}ms")
+    if summary['sources']:
+        print("Sources:         " + ", ".join(f"{source}: {count}" for source, count in sorted(summary['sources'].items())))
+
+def compare_reports(baseline, current, threshold):
+    """
+    Compare two benchmark reports.
+    
+    Args:
+        baseline (dict): Reference benchmark report
+        current (dict): New benchmark report
+        threshold (float): Allowed relative slowdown, e.g. 0.1 for 10%
+        
+    Returns:
+        list: (metric, baseline value, current value, regressed) tuples
+    """
+    rows = []
+    for name in ('latency', 'ttft'):
+        for pct in PERCENTILES:
+            key = f"p{pct}"
+            before = baseline['summary'][name][key]
+            after = current['summary'][name][key]
+            rows.append((f"{name} {key}", before, after, before > 0 and after > before * (1 + threshold)))
+    before = baseline['summary']['throughput']
+    after = current['summary']['throughput']
+    rows.append(("throughput", before, after, after < before * (1 - threshold)))
+    before = baseline['summary']['error_rate']
+    after = current['summary']['error_rate']
+    rows.append(("error rate", before, after, after > before + ERROR_RATE_TOLERANCE))
+    return rows
+
+def print_comparison(rows, threshold):
+    """Print a baseline comparison; returns the exit code."""
+    print(f"{'metric':14s} {'baseline':>12s} {'current':>12s} {'change':>9s}")
+    for metric, before, after, regressed in rows:
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        status = "❌" if regressed else "✅"
+        print(f"{metric:14s} {before:>12.4f} {after:>12.4f} {change:>9s} {status}")
+    regressions = [row[0] for row in rows if row[3]]
+    if regressions:
+        print(f"\n⚠️  Regressions past {threshold * 100:.0f}%: {', '.join(regressions)}")
+        return 1
+    print("\n🎉 No regressions")
+    return 0
+
 def main():
     """Main function."""
-    server_url = "http://localhost:8765"
+    parser = argparse.ArgumentParser(description="Ash model test runner and benchmark")
+    parser.add_argument("--server", default=DEFAULT_SERVER_URL, help="Server URL")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="Send test queries in batches of this size over POST /generate/batch")
+    subparsers = parser.add_subparsers(dest="mode")
+    bench = subparsers.add_parser("bench", help="Replay the test corpus under load and report latency")
+    bench.add_argument("--concurrency", type=int, default=1, help="Parallel clients")
+    bench.add_argument("--rate", type=float, help="Target requests per second across all clients")
+    bench.add_argument("--duration", type=float, help="Seconds to keep replaying the corpus (default: one pass)")
+    bench.add_argument("--cache", action="store_true", help="Allow answers from the response cache")
+    bench.add_argument("--fast-path", action="store_true", help="Allow answers from the fast path")
+    bench.add_argument("--no-stream", action="store_true", help="Use /generate instead of /generate/stream")
+    bench.add_argument("--timeout", type=int, default=30, help="Per-request deadline in seconds")
+    bench.add_argument("--output", help="Write the report as JSON to this file")
+    compare = subparsers.add_parser("compare", help="Fail when a benchmark regressed against a baseline")
+    compare.add_argument("baseline", help="Baseline benchmark JSON")
+    compare.add_argument("current", help="New benchmark JSON")
+    compare.add_argument("--threshold", type=float, default=0.1, help="Allowed relative slowdown (default: 0.1)")
+    args = parser.parse_args()
+    
+    if args.mode == "compare":
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.current, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        sys.exit(print_comparison(compare_reports(baseline, current, args.threshold), args.threshold))
+    
+    if not check_server(args.server):
+        print(f"❌ Ash server is not running at {args.server}")
+        sys.exit(1)
+    
+    if args.mode == "bench":
+        report = run_benchmark(args.server, concurrency=args.concurrency, rate=args.rate,
+                               duration=args.duration, use_cache=args.cache, use_fast_path=args.fast_path,
+                               stream=not args.no_stream, timeout=args.timeout)
+        print_benchmark(report)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"\n💾 Report written to {args.output}")
+        sys.exit(1 if report['summary']['errors'] == report['summary']['requests'] else 0)
     
-    stats = run_tests(server_url)
+    stats = run_tests(args.server, batch_size=args.batch_size)
     exit_code = print_stats(stats)
     sys.exit(exit_code)
 
@@ -0,0 +1,92 @@
+"""
+BatchScheduler admission against a stub decoder: a prompt plus max_tokens must
+fit in the sequence's slot_ctx KV cells.
+"""
+
+import sys
+import threading
+
+import pytest
+
+import server
+
+
+class StubDecoder:
+    """BatchDecoder look-alike with byte tokens and no shared prefix"""
+
+    def __init__(self, slot_ctx, n_batch=4096):
+        self.slot_ctx = slot_ctx
+        self.n_batch = n_batch
+        self.started = {}
+
+    def tokenize(self, prompt):
+        return list(prompt.encode('utf-8'))
+
+    def start(self, seq, tokens):
+        self.started[seq] = tokens
+        return 0
+
+
+def make_scheduler(max_tokens):
+    """A BatchScheduler with no worker threads, enough to call _admit()"""
+    scheduler = server.BatchScheduler.__new__(server.BatchScheduler)
+    scheduler.max_tokens = max_tokens
+    scheduler._lock = threading.Lock()
+    scheduler.busy = 0
+    scheduler.failed = 0
+    return scheduler
+
+
+def conversation(n_turns):
+    session = server.Session("s")
+    session.turns = [(f"query number {i}", f"echo {i}") for i in range(n_turns)]
+    session.examples = ""
+    return session
+
+
+def test_prompts_within_the_slot_are_admitted_whole(make_model):
+    model = make_model()
+    scheduler = make_scheduler(max_tokens=32)
+    decoder = StubDecoder(slot_ctx=8192)
+    job = server.GenerationJob("list files", conversation=conversation(3))
+    sequence = scheduler._admit(decoder, model, job, 0)
+    assert sequence is not None
+    assert sequence.prompt_tokens == decoder.tokenize(model.build_prompt("list files", job.conversation.turns, ""))
+
+
+def test_oldest_turns_are_dropped_to_fit_the_slot(make_model):
+    model = make_model()
+    scheduler = make_scheduler(max_tokens=32)
+    turns = conversation(8).turns
+    fits = len(StubDecoder(0).tokenize(model.build_prompt("list files", turns[-2:], ""))) + 32
+    decoder = StubDecoder(slot_ctx=fits)
+    job = server.GenerationJob("list files", conversation=conversation(8))
+
+    sequence = scheduler._admit(decoder, model, job, 1)
+    assert len(sequence.prompt_tokens) + scheduler.max_tokens <= decoder.slot_ctx
+    assert sequence.prompt_tokens == decoder.tokenize(model.build_prompt("list files", turns[-2:], ""))
+    assert decoder.started[1] == sequence.prompt_tokens
+    assert scheduler.busy == 1
+    # The session keeps its full history
+    assert job.conversation.turns == turns
+
+
+def test_query_that_cannot_fit_is_rejected(make_model):
+    model = make_model()
+    scheduler = make_scheduler(max_tokens=32)
+    decoder = StubDecoder(slot_ctx=len(StubDecoder(0).tokenize(model.build_prompt("list files", [], ""))) + 31)
+    job = server.GenerationJob("list files", conversation=conversation(2))
+
+    assert scheduler._admit(decoder, model, job, 0) is None
+    assert "leaves no room for 32 generated tokens" in str(job.error)
+    assert decoder.started == {}
+    assert scheduler.failed == 1 and scheduler.busy == 0
+
+
+def test_options_the_scheduler_cannot_honour_are_rejected(monkeypatch, capsys):
+    for flags in (['--constrained'], ['--prompt-lookup'], ['--constrained', '--prompt-lookup']):
+        monkeypatch.setattr(sys, 'argv', ['server.py', '--max-batch', '4'] + flags)
+        with pytest.raises(SystemExit) as exit_info:
+            server.main()
+        assert exit_info.value.code == 1
+        assert f"--max-batch can't be combined with {', '.join(flags)}" in capsys.readouterr().out
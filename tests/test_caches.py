@@ -0,0 +1,106 @@
+"""
+Response cache and semantic cache, with a stub embedder in place of a real model.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ash'))
+import client
+import server
+
+
+def test_client_normalizes_queries_like_the_server():
+    queries = ["list files", "  list   files?? ", "What time is it?!", "cd ..", "ls -la .", "", "  ?! "]
+    for query in queries:
+        assert client.normalize_query(query) == server.normalize_query(query)
+
+
+class Clock:
+    """Replaces time.time() in the server module"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = server.ResponseCache(max_entries=2)
+    cache.put("list files", "ls")
+    cache.put("show disk usage", "df -h")
+    assert cache.get("list files") == "ls"
+    cache.put("current directory", "pwd")
+    assert cache.get("show disk usage") is None
+    assert cache.get("list files") == "ls"
+    assert cache.get("current directory") == "pwd"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_response_cache_evicts_by_bytes():
+    cache = server.ResponseCache(max_entries=100, max_bytes=2 * (server.ResponseCache.ENTRY_OVERHEAD + 22))
+    for i in range(3):
+        cache.put(f"query {i}", f"echo {i:>10}")
+    assert "query 0" not in cache
+    assert "query 1" in cache and "query 2" in cache
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_response_cache_expires_entries(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'time', clock)
+    cache = server.ResponseCache(ttl=60)
+    cache.put("list files", "ls")
+    clock.now += 59
+    assert cache.get("list files") == "ls"
+    clock.now += 2
+    assert "list files" not in cache
+    assert cache.get("list files") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_response_cache_persists_per_model(monkeypatch, tmp_path):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'time', clock)
+    path = str(tmp_path / 'responses.json')
+    a_path = server.model_cache_path(path, '/models/a.gguf')
+    b_path = server.model_cache_path(path, '/models/b.gguf')
+    assert a_path != b_path
+
+    a = server.ResponseCache(ttl=60, persist_path=a_path, namespace='a.gguf')
+    a.put("list files", "ls")
+    clock.now += 30
+    a.put("current directory", "pwd")
+    a.save()
+    b = server.ResponseCache(ttl=60, persist_path=b_path, namespace='b.gguf')
+    b.put("list files", "ls -1")
+    b.save()
+
+    clock.now += 40
+    a = server.ResponseCache(ttl=60, persist_path=a_path, namespace='a.gguf')
+    assert a.get("list files") is None  # expired while the server was down
+    assert a.get("current directory") == "pwd"
+    assert server.ResponseCache(ttl=60, persist_path=b_path, namespace='b.gguf').get("list files") == "ls -1"
+
+
+def test_semantic_cache_matches_rewordings_and_evicts_least_recently_used(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'time', clock)
+    cache = server.SemanticCache(server.HashingEmbedder(), max_entries=2)
+    cache.put("show disk usage", "df -h")
+    clock.now += 1
+    cache.put("list running processes", "ps aux")
+    clock.now += 1
+    assert cache.get("show the disk usage")['command'] == "df -h"
+    clock.now += 1
+    cache.put("print working directory", "pwd")
+    assert cache.get("list running processes") is None
+    assert cache.get("show disk usage")['command'] == "df -h"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_semantic_cache_rejects_neighbours_with_other_literals():
+    cache = server.SemanticCache(server.HashingEmbedder(), threshold=0.5)
+    cache.put("delete file foo.txt", "rm foo.txt")
+    assert cache.get("delete file bar.txt") is None
@@ -0,0 +1,41 @@
+"""
+Fast-path rules against the test corpus, which they are held out from: no
+intent phrase may be a corpus query, and every corpus query the fast path
+answers must be answered correctly.
+"""
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ash'))
+sys.path.insert(0, os.path.dirname(__file__))
+import server
+from run_tests import command_matches, load_test_cases
+
+
+def corpus_key(query):
+    return server.normalize_query(query).lower()
+
+
+def load_rules():
+    with open(server.FAST_PATH_RULES_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_intent_phrases_are_not_corpus_queries():
+    corpus = {corpus_key(case['query']) for case in load_test_cases()}
+    leaked = [phrase for intent in load_rules()['intents'] for phrase in intent['phrases']
+              if corpus_key(phrase) in corpus]
+    assert leaked == []
+
+
+def test_fast_path_answers_are_correct_on_corpus():
+    resolver = server.FastPathResolver([load_rules()], kb=server.CLI_TOOLS_KB)
+    wrong = []
+    for case in load_test_cases():
+        expected = case['expected'] if isinstance(case['expected'], list) else [case['expected']]
+        result = resolver.resolve(case['query'])
+        if result and not command_matches(result['command'], expected):
+            wrong.append((case['query'], result['command']))
+    assert wrong == []
@@ -0,0 +1,70 @@
+"""
+HTTP endpoints of ModelHandler, served from a stub-model WorkerPool.
+"""
+
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import server
+from conftest import wait_until
+
+
+@pytest.fixture
+def served_pool(make_model, stub_llama):
+    """A WorkerPool with a loaded stub model behind ModelHandler on an ephemeral port"""
+    pool = server.WorkerPool([make_model()])
+    wait_until(lambda: pool.models[0].state == "ready")
+    del stub_llama.queries[:]
+
+    class Handler(server.ModelHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, pool=pool, **kwargs)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('localhost', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield pool, httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+    pool.shutdown()
+
+
+def call(port, method, path, payload=None):
+    connection = http.client.HTTPConnection('localhost', port, timeout=5)
+    try:
+        body = json.dumps(payload).encode() if payload is not None else None
+        connection.request(method, path, body=body, headers={'Content-Type': 'application/json'} if body else {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'null'), response.getheader('Allow')
+    finally:
+        connection.close()
+
+
+def test_prefetch_is_a_post_with_a_session(served_pool):
+    _, port = served_pool
+    status, _, allow = call(port, 'GET', '/prefetch?q=list+files&session=a')
+    assert (status, allow) == (405, 'POST')
+    for payload in ({'q': 'list files'}, {'q': 'list files', 'session': ''}, {'session': 'a'}, ['list files']):
+        assert call(port, 'POST', '/prefetch', payload)[0] == 400
+
+
+def test_prefetches_of_different_sessions_do_not_cancel_each_other(served_pool, stub_llama):
+    pool, port = served_pool
+    stub_llama.gate = threading.Event()
+    blocker = pool.submit(server.GenerationJob("blocker"))
+    wait_until(lambda: pool.busy == 1)
+
+    assert call(port, 'POST', '/prefetch', {'q': 'list files', 'session': 'a'})[:2] == (202, {'status': 'queued'})
+    assert call(port, 'POST', '/prefetch', {'q': 'show disk usage', 'session': 'b'})[:2] == (202, {'status': 'queued'})
+    assert call(port, 'POST', '/prefetch', {'q': 'show disk usage', 'session': 'b'})[:2] == (202, {'status': 'pending'})
+    stub_llama.gate.set()
+    blocker.wait()
+    wait_until(lambda: pool.stats()["prefetch"]["in_flight"] == 0)
+    assert pool.stats()["cancelled"] == 0
+    assert set(stub_llama.queries) == {"blocker", "list files", "show disk usage"}
@@ -0,0 +1,106 @@
+"""
+WorkerPool scheduling and hand-over on a stub llama-cpp (see conftest.py).
+"""
+
+import threading
+
+import pytest
+
+import server
+from conftest import wait_until
+
+
+def ready_pool(make_model, stub_llama, name='a.gguf', **kwargs):
+    """A one-worker pool whose model has loaded and warmed up"""
+    pool = server.WorkerPool([make_model(name)], **kwargs)
+    wait_until(lambda: pool.models[0].state == "ready")
+    del stub_llama.queries[:]
+    return pool
+
+
+def test_queued_jobs_run_by_priority(make_model, stub_llama):
+    pool = ready_pool(make_model, stub_llama)
+    stub_llama.gate = threading.Event()
+    blocker = pool.submit(server.GenerationJob("blocker"))
+    wait_until(lambda: pool.busy == 1)
+
+    jobs = [
+        pool.submit(server.GenerationJob("prefetch", priority=server.WorkerPool.PREFETCH_PRIORITY, session="s")),
+        pool.submit(server.GenerationJob("batch", priority=server.WorkerPool.BATCH_PRIORITY)),
+        pool.submit(server.GenerationJob("interactive 1")),
+        pool.submit(server.GenerationJob("interactive 2")),
+    ]
+    stub_llama.gate.set()
+    for job in [blocker] + jobs:
+        job.wait()
+    # Interactive requests first (in arrival order), then batches, then prefetches
+    assert stub_llama.queries == ["blocker", "interactive 1", "interactive 2", "batch", "prefetch"]
+    pool.shutdown()
+
+
+def test_full_queue_rejects_with_retry_after(make_model, stub_llama):
+    pool = ready_pool(make_model, stub_llama, max_queue=1)
+    stub_llama.gate = threading.Event()
+    pool.submit(server.GenerationJob("running"))
+    wait_until(lambda: pool.busy == 1)
+    pool.submit(server.GenerationJob("queued"))
+    with pytest.raises(server.ServerBusyError):
+        pool.submit(server.GenerationJob("rejected"))
+    assert pool.stats()["rejected"] == 1
+    stub_llama.gate.set()
+    pool.shutdown()
+
+
+def test_retire_drains_queued_jobs_and_forwards_new_ones(make_model, stub_llama):
+    old = ready_pool(make_model, stub_llama, name='a.gguf')
+    new = ready_pool(make_model, stub_llama, name='b.gguf')
+    stub_llama.gate = threading.Event()
+    running = old.submit(server.GenerationJob("running"))
+    wait_until(lambda: old.busy == 1)
+    queued = old.submit(server.GenerationJob("queued"))
+
+    retiring = threading.Thread(target=old.retire, args=(new,))
+    retiring.start()
+    wait_until(lambda: old.successor is new)
+    late = old.submit(server.GenerationJob("late"))
+    stub_llama.gate.set()
+    retiring.join(5)
+    assert not retiring.is_alive()
+
+    # Work the old pool had accepted finishes on the old model, later work on the new one
+    assert running.wait()['command'] == "a running"
+    assert queued.wait()['command'] == "a queued"
+    assert late.wait()['command'] == "b late"
+    # Unloaded only after its workers drained
+    assert stub_llama.closed == ["a"]
+    assert old.models[0].state == "unloaded"
+    assert all(not thread.is_alive() for thread in old.threads)
+    assert new.generate("list files", use_cache=False)['command'] == "b list files"
+    new.shutdown()
+
+
+def test_cached_answers_skip_the_queue(make_model, stub_llama):
+    pool = ready_pool(make_model, stub_llama, response_cache=server.ResponseCache())
+    assert pool.generate("list files")['cached'] is False
+    assert pool.generate("list files?")['cached'] is True
+    assert stub_llama.queries == ["list files"]
+    pool.shutdown()
+
+
+def test_generation_stops_at_the_end_of_the_command_line(make_model, stub_llama, monkeypatch):
+    model = make_model()
+    model.load()
+    drawn = []
+
+    def chatty(self, prompt, stopping_criteria=None, stream=False, **kwargs):
+        assert stream and 'stop' not in kwargs
+        for token in ["\n", "ls", " -la", "\n", "User", ":"]:
+            drawn.append(token)
+            yield {'choices': [{'text': token, 'finish_reason': None}]}
+
+    monkeypatch.setattr(stub_llama, '__call__', chatty)
+    result = model.generate("list files", use_cache=False)
+    # Nothing is decoded after the newline that ends the command
+    assert result['command'] == "ls -la"
+    assert drawn == ["\n", "ls", " -la", "\n"]
+    assert result['completion_tokens'] == 4
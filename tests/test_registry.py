@@ -0,0 +1,69 @@
+"""
+ModelRegistry switching between stub models: a failed load leaves the active
+pool serving, a successful one hands over and unloads the old model.
+"""
+
+import threading
+
+import pytest
+
+import server
+from conftest import wait_until
+
+
+def make_registry(make_model, tmp_path):
+    for name in ('a.gguf', 'b.gguf', 'broken.gguf'):
+        make_model(name)
+    registry = server.ModelRegistry(lambda path: server.WorkerPool([server.ASHModel(
+        model_path=path, use_cache=False, retrieval_k=0, prefault=False)]),
+        str(tmp_path / 'a.gguf'), models_dir=str(tmp_path))
+    wait_until(lambda: registry.pool.models[0].state == "ready")
+    return registry
+
+
+def test_failed_switch_keeps_the_active_pool(make_model, stub_llama, tmp_path):
+    stub_llama.broken.add('broken.gguf')
+    registry = make_registry(make_model, tmp_path)
+    pool = registry.pool
+
+    assert registry.switch('broken') == 'loading'
+    wait_until(lambda: registry.last_switch is not None)
+    stats = registry.stats()
+    assert stats["last_switch"]["status"] == "failed"
+    assert "cannot load" in stats["last_switch"]["error"]
+    assert stats["active"] == 'a.gguf' and stats["switching"] is None and stats["switches"] == 0
+    assert registry.pool is pool
+    assert pool.generate("list files", use_cache=False)['command'] == "a list files"
+    # A later switch is not blocked by the failed one
+    assert registry.switch('b') == 'loading'
+    wait_until(lambda: registry.last_switch["model"] == 'b.gguf')
+    registry.pool.shutdown()
+
+
+def test_switch_hands_over_and_unloads_the_old_model(make_model, stub_llama, tmp_path):
+    registry = make_registry(make_model, tmp_path)
+    old = registry.pool
+    assert registry.switch('a.gguf') == 'active'
+
+    assert registry.switch('b') == 'loading'
+    assert [model["loading"] for model in registry.available()] == [False, True, False]
+    wait_until(lambda: registry.last_switch is not None)
+    assert registry.last_switch["status"] == "done"
+    assert registry.stats()["active"] == 'b.gguf' and registry.switches == 1
+    assert registry.pool.generate("list files", use_cache=False)['command'] == "b list files"
+    assert old.generate("show disk usage", use_cache=False)['command'] == "b show disk usage"
+    assert stub_llama.closed == ["a"]
+    registry.pool.shutdown()
+
+
+def test_unknown_model_and_concurrent_switch_are_rejected(make_model, stub_llama, tmp_path):
+    registry = make_registry(make_model, tmp_path)
+    with pytest.raises(server.UnknownModelError):
+        registry.switch('missing')
+    stub_llama.gate = threading.Event()  # holds b's warm-up
+    registry.switch('b')
+    with pytest.raises(server.ModelSwitchInProgress):
+        registry.switch('broken')
+    stub_llama.gate.set()
+    wait_until(lambda: registry.last_switch is not None)
+    registry.pool.shutdown()
@@ -0,0 +1,84 @@
+"""
+SessionStore checkout, spilling and expiry, with stub llama states.
+"""
+
+import numpy as np
+
+import server
+from conftest import StubLlamaState
+from test_caches import Clock
+
+
+def make_state(n_tokens=16, kv_bytes=1024):
+    return StubLlamaState(np.arange(n_tokens, dtype=np.intc), np.zeros((1, 8), dtype=np.single),
+                          n_tokens, bytes(range(256)) * (kv_bytes // 256), kv_bytes, 0)
+
+
+def test_checkout_creates_the_session():
+    store = server.SessionStore(spill_dir=None)
+    session = store.checkout("s1")
+    assert session.turns == [] and session.state is None
+    assert not store.has_turns("s1")
+    assert store.record("s1", "list files", "ls") == 1
+    assert store.has_turns("s1")
+    assert store.checkout("s1") is session
+
+
+def test_states_over_budget_spill_and_are_restored(stub_llama, tmp_path):
+    spill_dir = str(tmp_path / 'sessions')
+    state = make_state()
+    store = server.SessionStore(memory_budget=int(1.5 * server.SessionStore.state_size(state)), spill_after=0,
+                                spill_dir=spill_dir)
+    store.record("s1", "list files", "ls", state=state, state_key="k1")
+    store.record("s2", "show disk usage", "df -h", state=make_state(), state_key="k2")
+
+    # The least recently used state went to disk
+    stats = store.stats()
+    assert stats["spills"] == 1 and stats["states_spilled"] == 1 and stats["states_in_memory"] == 1
+    assert stats["memory_bytes"] <= store.memory_budget
+    spill_path = store._sessions["s1"].spill_path
+    assert spill_path.startswith(spill_dir)
+
+    session = store.checkout("s1")
+    assert store.restores == 1
+    assert session.spill_path is None
+    assert session.state_key == "k1"
+    assert session.state.llama_state == state.llama_state
+    assert list(session.state.input_ids) == list(state.input_ids)
+    assert not (tmp_path / 'sessions' / spill_path.rsplit('/', 1)[-1]).exists()
+    # s2 made room for it
+    assert store._sessions["s2"].spill_path is not None
+    store.close()
+    assert list((tmp_path / 'sessions').iterdir()) == []
+
+
+def test_idle_states_spill_and_idle_sessions_expire(stub_llama, monkeypatch, tmp_path):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'time', clock)
+    store = server.SessionStore(ttl=60, spill_after=10, spill_dir=str(tmp_path))
+    store.record("s1", "list files", "ls", state=make_state(), state_key="k1")
+    clock.now += 11
+    store.checkout("s2")
+    assert store._sessions["s1"].spill_path is not None
+    assert store.stats()["memory_bytes"] == 0
+
+    clock.now += 60
+    store.checkout("s2")
+    assert "s1" not in store._sessions
+    assert store.expired == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_unreadable_spilled_state_is_dropped(stub_llama, tmp_path):
+    store = server.SessionStore(memory_budget=0, spill_after=0, spill_dir=str(tmp_path))
+    store.record("s1", "list files", "ls", state=make_state(), state_key="k1")
+    store.checkout("s2")
+    spill_path = store._sessions["s1"].spill_path
+    with open(spill_path, 'r+b') as f:
+        f.truncate(64)
+
+    session = store.checkout("s1")
+    assert session.state is None and session.state_key is None and session.spill_path is None
+    assert session.turns == [("list files", "ls")]  # history survives, only the KV state is lost
+    assert store.restores == 0
+    assert list(tmp_path.iterdir()) == []
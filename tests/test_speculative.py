@@ -0,0 +1,60 @@
+"""
+SpeculativeDraft bookkeeping: acceptance counting and the adaptive draft length.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ash'))
+import server
+
+
+class FixedDraft(server.SpeculativeDraft):
+    """Always proposes the tokens 100, 101, 102, ..."""
+
+    def draft(self, input_ids):
+        return list(range(100, 100 + self.num_pred_tokens))
+
+
+def verify(draft, input_ids, accepted=None):
+    """
+    Draft a continuation of input_ids and return the tokens the main model goes on
+    from: its first `accepted` drafted tokens (all when None), then one of its own.
+    """
+    proposal = [int(token) for token in draft(input_ids)]
+    return input_ids + proposal[:accepted] + [7]
+
+
+def test_rejected_drafts_shrink_to_one_token():
+    draft = FixedDraft(num_pred_tokens=8)
+    input_ids = [1, 2, 3]
+    for _ in range(10):
+        input_ids = verify(draft, input_ids, accepted=0)
+    assert draft.draft_length == 1
+    assert len(draft(input_ids)) == 1
+    assert draft.accepted == 0
+    assert draft.stats()["acceptance_rate"] == 0.0
+
+
+def test_accepted_drafts_grow_back_to_the_limit():
+    draft = FixedDraft(num_pred_tokens=8)
+    draft.draft_length = 1
+    input_ids = [1, 2, 3]
+    lengths = []
+    for _ in range(6):
+        input_ids = verify(draft, input_ids)
+        lengths.append(draft.draft_length)
+    # The length used by each call, grown by the previous call's full acceptance
+    assert lengths == [1, 3, 5, 7, 8, 8]
+    assert draft.stats()["acceptance_rate"] == 1.0
+
+
+def test_prompt_lookup_falls_back_to_the_kb_examples():
+    draft = server.PromptLookupDraft(num_pred_tokens=3, max_ngram_size=2)
+    draft.set_corpus([[50, 51, 52, 53, 54]])
+    # Copied from the prompt when the suffix occurred there before
+    assert list(draft(np.array([1, 2, 3, 4, 2, 3], dtype=np.intc))) == [4, 2, 3]
+    # Otherwise continued as in the KB examples
+    assert list(draft(np.array([1, 2, 3, 51, 52], dtype=np.intc))) == [53, 54]